@@ -0,0 +1,170 @@
+from multiqc.modules.base_module import BaseMultiqcModule
+from multiqc.plots import bargraph, linegraph
+import json
+from xml.sax.saxutils import escape
+
+#colors of the pipeline steps in the timeline, in order of their first command
+STEP_COLORS = ["#1f77b4","#ff7f0e","#2ca02c","#d62728","#9467bd","#8c564b","#e377c2","#7f7f7f","#bcbd22","#17becf"]
+#points in the core utilization plot
+NUM_BINS = 200
+
+class MultiqcModule(BaseMultiqcModule):
+    def __init__(self):
+        # Initialise the parent object
+        super(MultiqcModule, self).__init__(name='Pipeline Performance', anchor='performance',
+        href="",
+        info="shows the run time, cpu time and memory of the commands run by the pipeline steps.")
+        self.mod_data = dict()
+        ###performance.json is written from the pipeline trace (pipeline_trace.jsonl) before multiqc runs
+        path_file = None
+        for f in self.find_log_files('performance/json'):
+            path_file = f['fn']
+        if path_file is None:
+            raise UserWarning
+
+        with open(path_file,"r") as pf:
+            perf_json = json.load(pf)
+        commands = perf_json["commands"]
+        if len(commands) == 0:
+            raise UserWarning
+
+        self.add_section(
+            name = 'Timeline',
+            anchor = 'performance_timeline',
+            description = 'Time span of each step per replicate, steps run for the whole genome are in the "genome" row. Hover over a bar for its commands.',
+            content = get_timeline_html(commands,perf_json["samples"])
+        )
+        step_totals = get_step_totals(commands)
+        self.add_section(
+            name = 'Steps',
+            anchor = 'performance_steps',
+            description = 'Elapsed time (first command start to last command end), summed cpu time and peak memory of the commands of each step. A step with much less cpu time than elapsed time times the core budget is not using the cores it was given.',
+            plot = bargraph.plot(
+                [dict((s,{"elapsed":t["elapsed"]}) for s,t in step_totals.items()),
+                 dict((s,{"cpu_time":t["cpu_time"]}) for s,t in step_totals.items()),
+                 dict((s,{"max_rss_mb":t["max_rss_mb"]}) for s,t in step_totals.items())],
+                [{"elapsed":{"name":"Elapsed (s)"}},{"cpu_time":{"name":"CPU time (s)"}},{"max_rss_mb":{"name":"Peak RSS (MB)"}}],
+                {"id":"performance_steps_plot","title":"Pipeline Performance: Steps","cpswitch":False,
+                 "data_labels":[{"name":"Elapsed","ylab":"Seconds"},{"name":"CPU time","ylab":"Seconds"},{"name":"Peak RSS","ylab":"MB"}]})
+        )
+        sample_steps = get_sample_step_times(commands)
+        if sample_steps:
+            self.add_section(
+                name = 'Replicates',
+                anchor = 'performance_replicates',
+                description = 'Wall time of the commands run for each replicate, by step. Replicates with a much longer bar than the others are the slow samples.',
+                plot = bargraph.plot(sample_steps,get_step_order(commands),
+                    {"id":"performance_replicates_plot","title":"Pipeline Performance: Replicates","ylab":"Seconds","cpswitch_c_active":True})
+            )
+        self.add_section(
+            name = 'Core Utilization',
+            anchor = 'performance_cores',
+            description = 'Cores used by the running commands (their cpu time spread over their wall time) against the core budget of the genome.',
+            plot = linegraph.plot(get_core_usage(commands,perf_json["num_cores"]),
+                {"id":"performance_cores_plot","title":"Pipeline Performance: Core Utilization","xlab":"Minutes","ylab":"Cores","ymin":0})
+        )
+
+def get_step(command):
+    return command["step"] if command["step"] else "other"
+
+#Steps in order of their first command
+def get_step_order(commands):
+    steps = []
+    for command in sorted(commands,key=lambda c: c["start"]):
+        if get_step(command) not in steps:
+            steps.append(get_step(command))
+    return steps
+
+#{step:{"elapsed","cpu_time","max_rss_mb"}}
+def get_step_totals(commands):
+    spans = {}
+    totals = {}
+    for command in commands:
+        step = get_step(command)
+        end = command["start"]+command["wall_time"]
+        if step not in totals:
+            spans[step] = [command["start"],end]
+            totals[step] = {"cpu_time":0.0,"max_rss_mb":0.0}
+        spans[step] = [min(spans[step][0],command["start"]),max(spans[step][1],end)]
+        totals[step]["cpu_time"] += command["cpu_time"]
+        totals[step]["max_rss_mb"] = max(totals[step]["max_rss_mb"],command["max_rss_kb"]/1024.0)
+    for step in totals:
+        totals[step]["elapsed"] = spans[step][1]-spans[step][0]
+    return totals
+
+#{replicate:{step:summed wall time}} of the commands that belong to a replicate
+def get_sample_step_times(commands):
+    sample_steps = {}
+    for command in commands:
+        if command["sample"] is None:
+            continue
+        steps = sample_steps.setdefault(command["sample"],{})
+        steps[get_step(command)] = steps.get(get_step(command),0.0)+command["wall_time"]
+    return sample_steps
+
+#Cores busy over the run: each command's cpu time is spread evenly over its wall time
+#Returns linegraph data {"Cores used":{minute:cores},"Core budget":{minute:cores}}
+def get_core_usage(commands,num_cores):
+    run_start = min(c["start"] for c in commands)
+    run_end = max(c["start"]+c["wall_time"] for c in commands)
+    bin_size = max(run_end-run_start,1.0)/NUM_BINS
+    busy = [0.0]*NUM_BINS
+    for command in commands:
+        if command["wall_time"] <= 0:
+            continue
+        cores = command["cpu_time"]/command["wall_time"]
+        start = command["start"]-run_start
+        end = start+command["wall_time"]
+        for b in range(int(start/bin_size),min(NUM_BINS,int(end/bin_size)+1)):
+            overlap = min(end,(b+1)*bin_size)-max(start,b*bin_size)
+            if overlap > 0:
+                busy[b] += cores*overlap/bin_size
+    used = {}
+    budget = {}
+    for b in range(NUM_BINS):
+        minute = round((b+0.5)*bin_size/60.0,2)
+        used[minute] = round(busy[b],2)
+        budget[minute] = num_cores
+    return {"Cores used":used,"Core budget":budget}
+
+#Gantt style svg: one row per replicate plus a "genome" row, one bar per step from its first command start to last command end
+def get_timeline_html(commands,samples):
+    step_order = get_step_order(commands)
+    colors = dict((step,STEP_COLORS[i%len(STEP_COLORS)]) for i,step in enumerate(step_order))
+    rows = ["genome"]+list(samples)
+    run_start = min(c["start"] for c in commands)
+    run_end = max(c["start"]+c["wall_time"] for c in commands)
+    run_length = max(run_end-run_start,1.0)
+    bars = {}
+    for command in commands:
+        row = command["sample"] if command["sample"] in samples else "genome"
+        key = (row,get_step(command))
+        end = command["start"]+command["wall_time"]
+        if key not in bars:
+            bars[key] = [command["start"],end,0,0.0]
+        bars[key] = [min(bars[key][0],command["start"]),max(bars[key][1],end),bars[key][2]+1,bars[key][3]+command["cpu_time"]]
+    label_width = 150
+    plot_width = 800
+    row_height = 20
+    height = row_height*(len(rows)+2)
+    svg = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" font-size="11" font-family="sans-serif">'%(label_width+plot_width+10,height)]
+    for i,row in enumerate(rows):
+        y = i*row_height
+        svg.append('<text x="0" y="%d">%s</text>'%(y+14,escape(row)))
+        for step in step_order:
+            if (row,step) not in bars:
+                continue
+            start,end,count,cpu = bars[(row,step)]
+            x = label_width+plot_width*(start-run_start)/run_length
+            width = max(1.0,plot_width*(end-start)/run_length)
+            svg.append('<rect x="%.1f" y="%d" width="%.1f" height="%d" fill="%s"><title>%s %s: %.1f s, %d commands, %.1f cpu s</title></rect>'%(x,y+3,width,row_height-6,colors[step],escape(row),escape(step),end-start,count,cpu))
+    #time axis and step legend
+    y = len(rows)*row_height
+    svg.append('<text x="%d" y="%d">0 min</text>'%(label_width,y+14))
+    svg.append('<text x="%d" y="%d" text-anchor="end">%.1f min</text>'%(label_width+plot_width,y+14,run_length/60.0))
+    x = label_width
+    for step in step_order:
+        svg.append('<rect x="%d" y="%d" width="10" height="10" fill="%s"/><text x="%d" y="%d">%s</text>'%(x,y+row_height+4,colors[step],x+14,y+row_height+13,escape(step)))
+        x += 20+7*len(step)
+    svg.append('</svg>')
+    return "\n".join(svg)
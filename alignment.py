@@ -4,6 +4,12 @@ import os,sys,subprocess
 import shutil
 import tarfile
 import json
+import scheduler
+import index_cache
+import qc_stage
+import checkpoint
+import workdir
+import pipeline_trace
 
 #hisat2 has problems with spaces in filenames
 #prevent spaces in filenames. if one exists link the file to a no-space version.
@@ -18,14 +24,20 @@ def link_space(file_path):
     return result
 
 #pretty simple: its for prokaryotes in that parameters will be attuned to give best performance and no tophat
-def run_alignment(genome_list, condition_dict, parameters, output_dir, job_data, pipeline_log): 
+#qc: QCStage that runs fastqc/samtools stats/samstat. If not given the QC tools run inline and are finished on return
+def run_alignment(genome_list, condition_dict, parameters, output_dir, job_data, pipeline_log, qc=None): 
     #modifies condition_dict sub replicates to include 'bowtie' dict recording output files
+    max_cores = scheduler.get_core_budget(job_data)
+    join_qc = qc is None
+    if join_qc:
+        qc = qc_stage.QCStage(0)
     for genome in genome_list:
         genome_link = genome["genome_link"]
         ###TODO: testing samstat dict for putting the samstat reports in the same portion in the multiqc report
         samstat_dict = {}
         samstat_dict["reports"] = []
         final_cleanup=[]
+        index_lock = None
         if "hisat_index" in genome and genome["hisat_index"]:
             archive = tarfile.open(genome["hisat_index"])
             indices = [os.path.join(output_dir,os.path.basename(x)) for x in archive.getnames()]
@@ -36,7 +48,7 @@ def run_alignment(genome_list, condition_dict, parameters, output_dir, job_data,
             if num_parts > 0:
                 tar_cmd += ["--strip-components",str(num_parts)]
             print (" ".join(tar_cmd))
-            subprocess.check_call(tar_cmd)
+            pipeline_trace.check_call(tar_cmd)
             index_prefix = os.path.join(output_dir, os.path.basename(genome["hisat_index"]).replace(".ht2.tar","")) #somewhat fragile convention. tar prefix is underlying index prefix
             if not os.path.exists(index_prefix+".1.ht2"):
                 print("hisant indices were not unpacked correctly: %s"%index_prefix)
@@ -46,100 +58,197 @@ def run_alignment(genome_list, condition_dict, parameters, output_dir, job_data,
             thread_count= parameters.get("hisat2",{}).get("-p",0)
         else:
             #cmd=["hisat2","--dta-cufflinks", "-x", genome_link, "--no-spliced-alignment"] 
+            #reuses an index from the shared cache if one is configured, otherwise builds next to genome_link
             try:
-                bowtie_build_cmd = ["bowtie2-build", genome_link, genome_link]
-                print(" ".join(bowtie_build_cmd))
-                pipeline_log.append(" ".join(bowtie_build_cmd))
-                subprocess.check_call(["bowtie2-build", genome_link, genome_link])
+                index_prefix,index_lock = index_cache.get_bowtie2_index(genome_link, job_data, max_cores, pipeline_log)
             except Exception as err:
                 sys.stderr.write("bowtie build failed: %s %s\n"%(err, genome_link))
-                os.exit(1)
-            cmd=["bowtie2", "-x", genome_link]
+                sys.exit(1)
+            cmd=["bowtie2", "-x", index_prefix]
             thread_count= parameters.get("bowtie2",{}).get("-p",0)
-        if thread_count == 0:
-            thread_count=2 #multiprocessing.cpu_count()
-        cmd+=["-p",str(thread_count)]
-        scount = 0 #used in modifying labels for the samstat reports
+        #split the core budget between replicates aligned at the same time
+        replicate_list = []
         for condition in condition_dict:
-            rcount=0
-            for r in condition_dict[condition]["replicates"]:
-                scount+=1
-                cur_cleanup=[]
-                rcount+=1
-                target_dir=r["target_dir"]
-                fastqc_cmd=["fastqc","--outdir",target_dir]
-                samstat_cmd=["samstat"]
-                cur_cmd=list(cmd)
-                if "read2" in r:
-                    cur_cmd+=["-1",link_space(r["read1"])," -2",link_space(r["read2"])]
-                    name1=os.path.splitext(os.path.basename(r["read1"]))[0].replace(" ","")
-                    name2=os.path.splitext(os.path.basename(r["read2"]))[0].replace(" ","")
-                    sam_file=os.path.join(target_dir,name1+"_"+name2+".sam")
-                    fastqc_cmd+=[r["read1"],r["read2"]]
-                else:
-                    cur_cmd+=[" -U",link_space(r["read1"])]
-                    name1=os.path.splitext(os.path.basename(r["read1"]))[0].replace(" ","")
-                    sam_file=os.path.join(target_dir,name1+".sam")
-                    fastqc_cmd+=[r["read1"]]
-                cur_cleanup.append(sam_file)
-                bam_file=sam_file[:-4]+".bam"
-                samstat_cmd.append(bam_file)
-                r[genome["genome"]]={}
-                r[genome["genome"]]["bam"]=bam_file
-                r[genome["genome"]]["fastqc"] = bam_file.replace(".bam","_fastqc.html") 
-                cur_cmd+=["-S",sam_file]
-                if not os.path.exists(r[genome["genome"]]["fastqc"]):
-                    print " ".join(fastqc_cmd)
-                    pipeline_log.append(" ".join(fastqc_cmd))
-                    subprocess.check_call(fastqc_cmd)
-                if os.path.exists(bam_file):
-                    sys.stderr.write(bam_file+" alignments file already exists. skipping\n")
-                else:
-                    print cur_cmd
-                    if job_data.get("recipe","RNA-Rocket") == "Host":
-                        alignment_log = bam_file.replace("bam","hisat") 
-                    else:
-                        alignment_log = bam_file.replace("bam","bowtie") 
-                    with open(alignment_log,"w") as al:
-                        pipeline_log.append(" ".join(cur_cmd))
-                        subprocess.check_call(cur_cmd,stdout=al,stderr=al) #call bowtie2 or hisat2
-                samtools_threads = parameters.get("samtools",{}).get("-@",1)
-                if not os.path.exists(bam_file):
-                    pipeline_log.append("samtools view -Su "+sam_file+" | samtools sort -o - - -@ "+str(samtools_threads)+" > "+bam_file)
-                    subprocess.check_call("samtools view -Su "+sam_file+" | samtools sort -o - - -@ "+str(samtools_threads)+" > "+bam_file, shell=True)#convert to bam
-                    pipeline_log.append("samtools index "+bam_file)
-                    subprocess.check_call("samtools index "+bam_file, shell=True)
-                    #subprocess.check_call('samtools view -S -b %s > %s' % (sam_file, bam_file+".tmp"), shell=True)
-                    #subprocess.check_call('samtools sort %s %s' % (bam_file+".tmp", bam_file), shell=True)
-                print " ".join(samstat_cmd)
-                stats_cmd = ["samtools","stats","--threads",str(samtools_threads),bam_file]
-                stats_outfile = bam_file.replace("bam","samtools_stats")
-                #TODO: issue with the -@ in stats cmd???
-                if not os.path.exists(stats_outfile):
-                    pipeline_log.append(" ".join(stats_cmd))
-                    with open(stats_outfile,"w") as o:
-                        subprocess.check_call(stats_cmd,stdout=o)
-                r[genome["genome"]]["avg_read_length"] = get_average_read_length_per_file(stats_outfile)
-                samstat_file = bam_file+".samstat.html"
-                #mod_samstat_file = os.path.join(os.path.dirname(bam_file),"Samstat_"+os.path.basename(bam_file)+".samstat_mqc.html")
-                mod_samstat_file = os.path.join(os.path.dirname(bam_file),"Samstat_"+os.path.basename(bam_file)+".samstat.html")
-                print(mod_samstat_file)
-                r[genome["genome"]]["samstat"] = mod_samstat_file
-                samstat_dict["reports"].append(mod_samstat_file)
-                if not os.path.exists(samstat_file):
-                    pipeline_log.append(" ".join(samstat_cmd))
-                    subprocess.check_call(samstat_cmd)
-                #if not os.path.exists(mod_samstat_file):
-                modify_samstat_for_multiqc(samstat_file,scount)
-                for garbage in cur_cleanup:
-                    subprocess.call(["rm", garbage])
+            replicate_list += condition_dict[condition]["replicates"]
+        num_workers,thread_count = scheduler.split_cores(max_cores,len(replicate_list),thread_count)
+        cmd+=["-p",str(thread_count)]
+        samtools_threads = parameters.get("samtools",{}).get("-@",thread_count)
+        #samtools sort memory per thread (-m) and temporary file directory (-T), samtools defaults otherwise
+        sort_options = {"-m":parameters.get("samtools",{}).get("-m",None),"-T":parameters.get("samtools",{}).get("-T",None)}
+        align_args = []
+        for scount,r in enumerate(replicate_list): #scount is used in modifying labels for the samstat reports
+            align_args.append((genome,r,cmd,scount+1,samtools_threads,sort_options,job_data,qc))
+        print("Aligning %d replicates, %d at a time with %d threads each"%(len(replicate_list),num_workers,thread_count))
+        #each replicate returns its own commands so pipeline_log keeps the replicate order
+        try:
+            for replicate_log,samstat_report in scheduler.run_parallel(align_replicate,align_args,num_workers):
+                pipeline_log.extend(replicate_log)
+                samstat_dict["reports"].append(samstat_report)
+        finally:
+            index_cache.release_index(index_lock)
         ###write out samstat json file
-        os.chdir(genome["output"])
-        with open("samstat.json","w") as so:
+        with workdir.genome_dir(genome).open("samstat.json","w") as so:
             so.write(json.dumps(samstat_dict))
         ###cleanup files
         for garbage in final_cleanup:
             subprocess.call(["rm", garbage])
+    if join_qc:
+        qc.join(pipeline_log)
+
+#Runs the aligner and samtools sort/index for one replicate, fastqc/samtools stats/samstat are submitted to qc
+#cmd is the aligner command for the genome, the read arguments are added here
+#Safe to run in a thread: only touches this replicate's directory and entry in condition_dict
+#Returns (list of commands run, samstat report for the multiqc samstat module)
+def align_replicate(genome, r, cmd, scount, samtools_threads, sort_options, job_data, qc):
+    #streaming pipes the aligner straight into samtools sort, set "stream_alignment": false to write the sam file first
+    stream_alignment = job_data.get("stream_alignment",True)
+    replicate_log = []
+    cur_cleanup=[]
+    target_dir=r["target_dir"]
+    fastqc_cmd=["fastqc","--outdir",target_dir]
+    cur_cmd=list(cmd)
+    if "read2" in r:
+        cur_cmd+=["-1",link_space(r["read1"])," -2",link_space(r["read2"])]
+        name1=os.path.splitext(os.path.basename(r["read1"]))[0].replace(" ","")
+        name2=os.path.splitext(os.path.basename(r["read2"]))[0].replace(" ","")
+        sam_file=os.path.join(target_dir,name1+"_"+name2+".sam")
+        fastqc_cmd+=[r["read1"],r["read2"]]
+    else:
+        cur_cmd+=[" -U",link_space(r["read1"])]
+        name1=os.path.splitext(os.path.basename(r["read1"]))[0].replace(" ","")
+        sam_file=os.path.join(target_dir,name1+".sam")
+        fastqc_cmd+=[r["read1"]]
+    bam_file=sam_file[:-4]+".bam"
+    r[genome["genome"]]={}
+    r[genome["genome"]]["bam"]=bam_file
+    r[genome["genome"]]["fastqc"] = bam_file.replace(".bam","_fastqc.html") 
+    #the alignment is redone unless the checkpoint manifest has it complete for the same reads, reference and options
+    manifest = checkpoint.get_manifest(genome["output"],job_data)
+    align_step = "align "+bam_file
+    align_inputs = [r["read1"],r["read2"]] if "read2" in r else [r["read1"]]
+    align_inputs.append(genome["hisat_index"] if genome.get("hisat_index",None) else genome["genome"])
+    align_outputs = [bam_file,bam_file+".bai"]
+    align_params = checkpoint.get_command_params(cur_cmd)+["stream" if stream_alignment else "sam"]
+    align_tools = [cur_cmd[0],"samtools"]
+    if not stream_alignment:
+        cur_cmd+=["-S",sam_file]
+        cur_cleanup.append(sam_file)
+    if not os.path.exists(r[genome["genome"]]["fastqc"]):
+        qc.submit((genome["genome"],scount,0),run_fastqc,fastqc_cmd)
+    if manifest.is_complete(align_step,align_inputs,align_outputs,align_params,align_tools):
+        sys.stderr.write(bam_file+" alignments file already exists. skipping\n")
+    else:
+        #samtools stats and samstat reports of an earlier bam would be reused by run_bam_qc
+        for stale_qc in [bam_file.replace("bam","samtools_stats"),bam_file+".samstat.html"]:
+            if os.path.exists(stale_qc):
+                os.remove(stale_qc)
+        print(cur_cmd)
+        if job_data.get("recipe","RNA-Rocket") == "Host":
+            alignment_log = bam_file.replace("bam","hisat") 
+        else:
+            alignment_log = bam_file.replace("bam","bowtie") 
+        if stream_alignment:
+            sort_cmd = stream_align_and_sort(cur_cmd,bam_file,alignment_log,samtools_threads,sort_options)
+            replicate_log.append(" ".join(cur_cmd)+" 2> "+alignment_log+" | "+" ".join(sort_cmd))
+        else:
+            with open(alignment_log,"w") as al:
+                replicate_log.append(" ".join(cur_cmd))
+                pipeline_trace.check_call(cur_cmd,stdout=al,stderr=al) #call bowtie2 or hisat2
+            replicate_log.append("samtools view -Su "+sam_file+" | samtools sort -o - - -@ "+str(samtools_threads)+" > "+bam_file)
+            pipeline_trace.check_call("samtools view -Su "+sam_file+" | samtools sort -o - - -@ "+str(samtools_threads)+" > "+bam_file, shell=True)#convert to bam
+        replicate_log.append("samtools index "+bam_file)
+        pipeline_trace.check_call("samtools index "+bam_file, shell=True)
+        manifest.record(align_step,align_inputs,align_outputs,align_params,align_tools)
+        #subprocess.check_call('samtools view -S -b %s > %s' % (sam_file, bam_file+".tmp"), shell=True)
+        #subprocess.check_call('samtools sort %s %s' % (bam_file+".tmp", bam_file), shell=True)
+    stats_outfile = bam_file.replace("bam","samtools_stats")
+    #only the average read length (stringtie -> prepDE.py) is needed downstream, don't wait on samtools stats for it
+    r[genome["genome"]]["avg_read_length"] = get_average_read_length(bam_file,stats_outfile)
+    #mod_samstat_file = os.path.join(os.path.dirname(bam_file),"Samstat_"+os.path.basename(bam_file)+".samstat_mqc.html")
+    mod_samstat_file = os.path.join(os.path.dirname(bam_file),"Samstat_"+os.path.basename(bam_file)+".samstat.html")
+    print(mod_samstat_file)
+    r[genome["genome"]]["samstat"] = mod_samstat_file
+    qc.submit((genome["genome"],scount,1),run_bam_qc,bam_file,stats_outfile,samtools_threads,scount)
+    for garbage in cur_cleanup:
+        subprocess.call(["rm", garbage])
+    return replicate_log,mod_samstat_file
+
+def run_fastqc(fastqc_cmd):
+    print(" ".join(fastqc_cmd))
+    pipeline_trace.check_call(fastqc_cmd)
+    return [" ".join(fastqc_cmd)]
+
+#Runs samtools stats and samstat on a finished bam file and prepares the samstat report for multiqc
+#Returns the list of commands run
+def run_bam_qc(bam_file, stats_outfile, samtools_threads, scount):
+    qc_log = []
+    samstat_cmd=["samstat",bam_file]
+    print(" ".join(samstat_cmd))
+    stats_cmd = ["samtools","stats","--threads",str(samtools_threads),bam_file]
+    #TODO: issue with the -@ in stats cmd???
+    if not os.path.exists(stats_outfile):
+        qc_log.append(" ".join(stats_cmd))
+        with open(stats_outfile,"w") as o:
+            pipeline_trace.check_call(stats_cmd,stdout=o)
+    samstat_file = bam_file+".samstat.html"
+    if not os.path.exists(samstat_file):
+        qc_log.append(" ".join(samstat_cmd))
+        pipeline_trace.check_call(samstat_cmd)
+    #if not os.path.exists(mod_samstat_file):
+    modify_samstat_for_multiqc(samstat_file,scount)
+    return qc_log
+
+#Pipes the aligner output (sam on stdout) directly into samtools sort, no sam file is written
+#The aligner's stderr still goes to alignment_log for the multiqc bowtie2/hisat2 modules
+#samtools sort writes to a temporary name that is renamed on success, so a killed job never leaves a partial bam that later runs would skip
+#Returns the samtools sort command for the pipeline log
+def stream_align_and_sort(align_cmd, bam_file, alignment_log, samtools_threads, sort_options):
+    tmp_bam = bam_file+".tmp"
+    sort_cmd = ["samtools","sort","-@",str(samtools_threads),"-O","bam","-o",tmp_bam]
+    if sort_options.get("-m",None):
+        sort_cmd += ["-m",str(sort_options["-m"])]
+    sort_tmp_dir = sort_options.get("-T",None) or os.path.dirname(bam_file)
+    sort_cmd += ["-T",os.path.join(sort_tmp_dir,os.path.basename(bam_file)+".sort"),"-"]
+    with open(alignment_log,"w") as al:
+        align_proc = pipeline_trace.Popen(align_cmd,stdout=subprocess.PIPE,stderr=al)
+        sort_proc = pipeline_trace.Popen(sort_cmd,stdin=align_proc.stdout)
+        #close our copy of the pipe so the aligner gets SIGPIPE if samtools sort dies
+        align_proc.stdout.close()
+        sort_status = pipeline_trace.wait(sort_proc)
+        align_status = pipeline_trace.wait(align_proc)
+    if align_status != 0 or sort_status != 0:
+        if os.path.exists(tmp_bam):
+            os.remove(tmp_bam)
+        if align_status != 0:
+            raise subprocess.CalledProcessError(align_status," ".join(align_cmd))
+        raise subprocess.CalledProcessError(sort_status," ".join(sort_cmd))
+    os.rename(tmp_bam,bam_file)
+    return sort_cmd
+
+#Average read length for prepDE.py without running samtools stats on the whole bam
+#Uses the samtools stats output if an earlier run left one, otherwise averages the first num_reads primary alignments
+def get_average_read_length(bam_file, stats_file, num_reads=100000):
+    if os.path.exists(stats_file):
+        avg_length = get_average_read_length_per_file(stats_file)
+        if avg_length:
+            return avg_length
+    view_cmd = pipeline_trace.Popen(["samtools","view","-F","0x900",bam_file],stdout=subprocess.PIPE)
+    total_length = 0
+    count = 0
+    for line in view_cmd.stdout:
+        seq = line.split(b"\t",10)[9]
+        if seq == b"*":
+            continue
+        total_length += len(seq)
+        count += 1
+        if count >= num_reads:
+            break
+    view_cmd.stdout.close()
+    view_cmd.kill()
+    pipeline_trace.wait(view_cmd)
+    if count == 0:
+        return "0"
+    return str(int(round(float(total_length)/count)))
 
 #Reads the output from samtools stat and grabs the average read length value
 def get_average_read_length_per_file(stats_file):
@@ -155,7 +264,7 @@ def get_average_read_length_per_file(stats_file):
 #Then goes through and removes all content other than the intro statistics and base quality distribution by position
 def modify_samstat_for_multiqc(samstat_filename,count):
     sed_cmd = ["sed","-i","/body {/,/}/ d;",samstat_filename]
-    subprocess.check_call(sed_cmd)
+    pipeline_trace.check_call(sed_cmd)
     #out_samstat = os.path.join(os.path.dirname(samstat_filename),"Samstat_"+os.path.basename(samstat_filename.replace(".html","_mqc.html")))    
     out_samstat = os.path.join(os.path.dirname(samstat_filename),"Samstat_"+os.path.basename(samstat_filename))    
     mqc_id = os.path.basename(out_samstat).split(".")[0]
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+import os,sys
+import hashlib
+import marshal
+
+#On-disk cache of the annotation step indices built by feature_counter.parse_annotation
+#One file per (gff contents, feature type, id attribute, strandedness), so a host run counting 15 feature types
+#and a bacterial run counting genes share the entries they have in common
+#Layout: <cache_dir>/<gff sha1>/<type key>.marshal, stored in a shared directory when "annotation_cache" is set in job_data
+#(or PROK_TUXEDO_ANNOTATION_CACHE), otherwise in <gff>.idx next to the annotation. "annotation_cache": false turns it off
+#Bump INDEX_VERSION whenever the index layout changes, older entries are then ignored
+INDEX_VERSION = 1
+#marshal files are only readable by the python version that wrote them
+INDEX_SUFFIX = ".py%d.v%d.marshal"%(sys.version_info[0],INDEX_VERSION)
+
+#(realpath,size,mtime) -> sha1, so the gff is hashed once per process
+gff_key_memo = {}
+
+def get_cache_dir(job_data, gff_file):
+    cache_dir = job_data.get("annotation_cache",os.environ.get("PROK_TUXEDO_ANNOTATION_CACHE",None))
+    if cache_dir is False or cache_dir == "":
+        return None
+    if not cache_dir:
+        return os.path.realpath(gff_file)+".idx"
+    return cache_dir
+
+def get_gff_key(gff_file):
+    st = os.stat(gff_file)
+    memo_key = (os.path.realpath(gff_file),st.st_size,st.st_mtime)
+    if memo_key not in gff_key_memo:
+        sha = hashlib.sha1()
+        with open(gff_file,"rb") as gf:
+            for chunk in iter(lambda: gf.read(1<<20),b""):
+                sha.update(chunk)
+        gff_key_memo[memo_key] = sha.hexdigest()
+    return gff_key_memo[memo_key]
+
+#Feature types are free text in the gff, so the file name uses a hash of the type parameters
+def get_index_file(cache_dir, gff_key, feature_type, id_attr, stranded):
+    type_key = hashlib.sha1(("%s\0%s\0%d"%(feature_type,id_attr,int(stranded))).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir,gff_key,type_key+INDEX_SUFFIX)
+
+#Step sets are stored once in a list and referenced by position, the same way build_steps shares identical sets
+def encode_index(ids, steps):
+    set_pos = {}
+    sets = []
+    encoded_steps = {}
+    for key,(starts,step_sets) in steps.items():
+        positions = []
+        for fs in step_sets:
+            if fs not in set_pos:
+                set_pos[fs] = len(sets)
+                sets.append(tuple(fs))
+            positions.append(set_pos[fs])
+        encoded_steps[key] = (list(starts),positions)
+    return {"ids":list(ids),"sets":sets,"steps":encoded_steps}
+
+def decode_index(encoded):
+    sets = [frozenset(s) for s in encoded["sets"]]
+    steps = {}
+    for key,(starts,positions) in encoded["steps"].items():
+        steps[key] = (starts,[sets[p] for p in positions])
+    return encoded["ids"],steps
+
+#Returns (sorted feature ids, steps) for one feature type, or None if it isn't cached
+#Unreadable entries are treated as missing and get rebuilt
+def load_index(cache_dir, gff_key, feature_type, id_attr, stranded):
+    index_file = get_index_file(cache_dir,gff_key,feature_type,id_attr,stranded)
+    if not os.path.exists(index_file):
+        return None
+    try:
+        with open(index_file,"rb") as idx:
+            return decode_index(marshal.load(idx))
+    except (IOError,OSError,EOFError,ValueError,TypeError,KeyError):
+        sys.stderr.write("Ignoring unreadable annotation index %s\n"%index_file)
+        return None
+
+#Writes the index for one feature type. The file is renamed into place, so other jobs never read a partial index
+#A read-only annotation directory only disables caching
+def store_index(cache_dir, gff_key, feature_type, id_attr, stranded, ids, steps):
+    index_file = get_index_file(cache_dir,gff_key,feature_type,id_attr,stranded)
+    tmp_file = "%s.%d.tmp"%(index_file,os.getpid())
+    try:
+        try:
+            os.makedirs(os.path.dirname(index_file))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(index_file)):
+                raise
+        with open(tmp_file,"wb") as idx:
+            marshal.dump(encode_index(ids,steps),idx)
+        os.rename(tmp_file,index_file)
+    except (IOError,OSError) as e:
+        sys.stderr.write("Could not cache annotation index %s: %s\n"%(index_file,str(e)))
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
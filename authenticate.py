@@ -9,6 +9,8 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 #TODO: figure out KB_authentication procedure
 
+LOG = sys.stderr
+
 def createTSVGet(api_url=None):
     if api_url == None:
         api_url="https://www.patricbrc.org/api/"
@@ -33,7 +35,7 @@ def authenticateByFile(tokenFile=None, Session=None):
 
 
 def authenticateByEnv(Session):
-    if os.environ.has_key("KB_AUTH_TOKEN"):
+    if "KB_AUTH_TOKEN" in os.environ:
         LOG.write("reading auth key from environment\n")
         authenticateByString(os.environ.get('KB_AUTH_TOKEN'), Session)
         return True
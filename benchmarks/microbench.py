@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import os,sys,time
+import json
+import math
+import shutil
+import argparse
+import itertools
+import subprocess
+
+#Micro-benchmarks of the pure python hot paths: the counts matrices, prepDE.py parsing and clustering, cuffdiff to
+#gene matrix, the heatmap gene selection, the gmx file and the samstat rewrite
+#Each function runs in this process on generated fixtures (synthetic_data.py), rounds times, and its min/median/mean
+#time is reported, like pytest-benchmark does. Benchmarks run at every combination of --features and --samples they
+#scale with (the ones that don't depend on the samples run once per feature count):
+#  python benchmarks/microbench.py --output before.json
+#  python benchmarks/microbench.py --baseline before.json
+#  python benchmarks/microbench.py --full --benchmarks create_counts_table,prepDE
+#With --baseline, the benchmarks whose min time grew by more than --tolerance are listed and the exit code is 1
+#prepDE.py does its work when it's loaded, so it runs as a command and its times include the interpreter start
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+PREPDE_SCRIPT = os.path.join(REPO_DIR,"prepDE.py")
+DEFAULT_FEATURES = "1000,10000"
+DEFAULT_SAMPLES = "10,100"
+FULL_FEATURES = "1000,10000,100000"
+FULL_SAMPLES = "10,100,1000"
+#differences below this many seconds are timer noise, not regressions
+MIN_REGRESSION_SECONDS = 0.001
+CONDITIONS = ["cond1","cond2"]
+
+sys.path.insert(0,REPO_DIR)
+sys.path.insert(0,BENCHMARK_DIR)
+import synthetic_data
+#subsystems first: prok_tuxedo and subsystems import each other
+import subsystems
+import prok_tuxedo
+import prep_diffexp_files
+import alignment
+
+timer = getattr(time,"perf_counter",time.time)
+
+#Generated inputs, one directory per kind and size under work_dir, reused by later runs
+#Each kind returns a json description of its files, written last so an interrupted generation starts over
+class Fixtures(object):
+    def __init__(self, work_dir, seed=0):
+        self.work_dir = work_dir
+        self.seed = seed
+
+    def get(self, kind, features, samples=0, contrasts=0):
+        name = "%s_f%d_s%d_c%d"%(kind,features,samples,contrasts)
+        fixture_dir = os.path.join(self.work_dir,name)
+        done_file = os.path.join(fixture_dir,"fixture.json")
+        if not os.path.exists(done_file):
+            if os.path.isdir(fixture_dir):
+                shutil.rmtree(fixture_dir)
+            os.makedirs(fixture_dir)
+            start = time.time()
+            fixture = getattr(self,"make_"+kind)(fixture_dir,features,samples,contrasts)
+            with open(done_file,"w") as o:
+                json.dump(fixture,o)
+            print("generated %s in %.1fs"%(name,time.time()-start))
+        with open(done_file,"r") as f:
+            return json.load(f)
+
+    def expression(self, features, host):
+        genes,contig_lengths = synthetic_data.make_genes(features,host,self.seed)
+        expression = synthetic_data.make_expression(genes,CONDITIONS,self.seed)
+        transcript_expression = {}
+        for g in genes:
+            for transcript_id in g[5]:
+                transcript_expression[transcript_id] = expression[g[4]]
+        return genes,expression,transcript_expression
+
+    #samples alternate between the conditions, like make_dataset spreads them
+    def replicate_dirs(self, fixture_dir, samples):
+        for s in range(samples):
+            condition = CONDITIONS[s%len(CONDITIONS)]
+            sample_dir = os.path.join(fixture_dir,condition,"S%d"%(s+1))
+            os.makedirs(sample_dir)
+            yield s,condition,sample_dir
+
+    #htseq-count files of every sample and the genome/condition_dict create_counts_table(_host) reads them from
+    def make_counts(self, fixture_dir, features, samples, contrasts, host=False):
+        genes,expression,transcript_expression = self.expression(features,host)
+        genome = {"genome":os.path.join(fixture_dir,"genome.fna"),"output":os.path.join(fixture_dir,"output")}
+        os.makedirs(genome["output"])
+        condition_dict = dict((condition,{"replicates":[]}) for condition in CONDITIONS)
+        for s,condition,sample_dir in self.replicate_dirs(fixture_dir,samples):
+            rep = {}
+            sample_seed = self.seed*100003+s
+            if host:
+                rep["gene_counts"] = os.path.join(sample_dir,"S%d.gene.counts"%(s+1))
+                rep["transcript_counts"] = os.path.join(sample_dir,"S%d.transcript.counts"%(s+1))
+                synthetic_data.write_counts_file(rep["gene_counts"],[g[4] for g in genes],expression,condition,features*100,sample_seed)
+                synthetic_data.write_counts_file(rep["transcript_counts"],sorted(transcript_expression),transcript_expression,condition,features*100,sample_seed)
+            else:
+                rep["counts"] = os.path.join(sample_dir,"S%d.counts"%(s+1))
+                synthetic_data.write_counts_file(rep["counts"],[g[4] for g in genes],expression,condition,features*100,sample_seed)
+            condition_dict[condition]["replicates"].append({genome["genome"]:rep})
+        items = features*samples
+        if host:
+            items += len(transcript_expression)*samples
+        return {"genome":genome,"condition_dict":condition_dict,"items":items}
+
+    def make_counts_host(self, fixture_dir, features, samples, contrasts):
+        return self.make_counts(fixture_dir,features,samples,contrasts,True)
+
+    #StringTie gtfs of every sample and the prepDE.py input list, host-like genes so there are transcripts to cluster
+    def make_gtfs(self, fixture_dir, features, samples, contrasts):
+        genes,expression,transcript_expression = self.expression(features,True)
+        all_expression = dict(expression)
+        all_expression.update(transcript_expression)
+        input_file = os.path.join(fixture_dir,"prepDE_input.txt")
+        with open(input_file,"w") as o:
+            for s,condition,sample_dir in self.replicate_dirs(fixture_dir,samples):
+                gtf = os.path.join(sample_dir,"S%d.gtf"%(s+1))
+                synthetic_data.write_stringtie_gtf(gtf,genes,all_expression,condition,100,self.seed*100003+s)
+                o.write("S%d\t%s\n"%(s+1,gtf))
+        return {"input":input_file,"items":len(transcript_expression)*samples}
+
+    #one cuffdiff gene_exp.diff testing every gene in each of the condition pairs
+    def make_cuffdiff(self, fixture_dir, features, samples, contrasts):
+        num_conditions = 2
+        while num_conditions*(num_conditions-1)//2 < contrasts:
+            num_conditions += 1
+        conditions = ["cond%d"%(c+1) for c in range(num_conditions)]
+        diff_file = os.path.join(fixture_dir,"gene_exp.diff")
+        synthetic_data.write_cuffdiff_file(diff_file,["gene%d"%g for g in range(features)],conditions,self.seed)
+        return {"diff_files":[diff_file],"items":features*num_conditions*(num_conditions-1)//2}
+
+    #DESeq2 results of each contrast, the genome top_diffexp_genes and write_gmx_file read them from
+    def make_contrasts(self, fixture_dir, features, samples, contrasts):
+        genome = {"output":os.path.join(fixture_dir,"output"),"diff_exp_contrasts":[]}
+        os.makedirs(genome["output"])
+        for c in range(contrasts):
+            contrast_file = os.path.join(genome["output"],"cond1_vs_cond%d.htseq.Genes.deseq2"%(c+2))
+            synthetic_data.write_deseq2_contrast(contrast_file,["gene%d"%g for g in range(features)],self.seed*7919+c)
+            genome["diff_exp_contrasts"].append(contrast_file)
+        return {"genome":genome,"items":features*contrasts}
+
+    def make_samstat(self, fixture_dir, features, samples, contrasts):
+        html_file = os.path.join(fixture_dir,"S1.bam.samstat.html")
+        synthetic_data.write_samstat_html(html_file,features,self.seed)
+        with open(html_file,"r") as hf:
+            items = sum(1 for line in hf)
+        return {"html":html_file,"items":items}
+
+#Benchmarks: each setup(fixtures,scale,args) returns (func to time, items it processes, reset) where reset (or None)
+#puts the inputs back before each round, outside the timed part
+def setup_create_counts_table(fixtures, scale, args):
+    fixture = fixtures.get("counts",scale["features"],scale["samples"])
+    job_data = {"max_cores":args.threads}
+    run = lambda: prep_diffexp_files.create_counts_table([dict(fixture["genome"])],fixture["condition_dict"],job_data)
+    return run,fixture["items"],None
+
+def setup_create_counts_table_host(fixtures, scale, args):
+    fixture = fixtures.get("counts_host",scale["features"],scale["samples"])
+    job_data = {"max_cores":args.threads}
+    run = lambda: prep_diffexp_files.create_counts_table_host([dict(fixture["genome"])],fixture["condition_dict"],job_data)
+    return run,fixture["items"],None
+
+def get_prepde_setup(cluster):
+    def setup_prepde(fixtures, scale, args):
+        fixture = fixtures.get("gtfs",scale["features"],scale["samples"])
+        output_dir = os.path.join(os.path.dirname(fixture["input"]),"prepDE_cluster" if cluster else "prepDE")
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        cmd = [sys.executable,PREPDE_SCRIPT,"-i",fixture["input"],"-l","100","-g","gene_counts","-t","transcript_counts","-P",str(args.threads)]
+        if cluster:
+            cmd += ["-c"]
+        def run():
+            with open(os.devnull,"w") as devnull:
+                subprocess.check_call(cmd,cwd=output_dir,stdout=devnull)
+        return run,fixture["items"],None
+    return setup_prepde
+
+def setup_cuffdiff_to_genematrix(fixtures, scale, args):
+    #python2 only (print statement)
+    import cuffdiff_to_genematrix
+    fixture = fixtures.get("cuffdiff",scale["features"],contrasts=scale["contrasts"])
+    output_file = os.path.join(os.path.dirname(fixture["diff_files"][0]),"gene_matrix.txt")
+    return lambda: cuffdiff_to_genematrix.main(fixture["diff_files"],output_file),fixture["items"],None
+
+def setup_top_diffexp_genes(fixtures, scale, args):
+    fixture = fixtures.get("contrasts",scale["features"],contrasts=scale["contrasts"])
+    return lambda: prok_tuxedo.top_diffexp_genes([dict(fixture["genome"])],{}),fixture["items"],None
+
+def setup_write_gmx_file(fixtures, scale, args):
+    fixture = fixtures.get("contrasts",scale["features"],contrasts=scale["contrasts"])
+    return lambda: prok_tuxedo.write_gmx_file([dict(fixture["genome"])]),fixture["items"],None
+
+#modify_samstat_for_multiqc edits the report in place, each round starts from a fresh copy
+def setup_modify_samstat(fixtures, scale, args):
+    fixture = fixtures.get("samstat",scale["features"])
+    round_dir = os.path.join(os.path.dirname(fixture["html"]),"round")
+    round_html = os.path.join(round_dir,os.path.basename(fixture["html"]))
+    def reset():
+        if os.path.isdir(round_dir):
+            shutil.rmtree(round_dir)
+        os.makedirs(round_dir)
+        shutil.copy(fixture["html"],round_html)
+    return lambda: alignment.modify_samstat_for_multiqc(round_html,1),fixture["items"],reset
+
+#name -> (setup, scale options it depends on, item name)
+BENCHMARKS = [
+    ("create_counts_table",setup_create_counts_table,["features","samples"],"counts"),
+    ("create_counts_table_host",setup_create_counts_table_host,["features","samples"],"counts"),
+    ("prepDE",get_prepde_setup(False),["features","samples"],"transcripts"),
+    ("prepDE_cluster",get_prepde_setup(True),["features","samples"],"transcripts"),
+    ("cuffdiff_to_genematrix",setup_cuffdiff_to_genematrix,["features","contrasts"],"tests"),
+    ("top_diffexp_genes",setup_top_diffexp_genes,["features","contrasts"],"genes"),
+    ("write_gmx_file",setup_write_gmx_file,["features","contrasts"],"genes"),
+    ("modify_samstat_for_multiqc",setup_modify_samstat,["features"],"lines"),
+]
+SCALE_KEYS = ["features","samples","contrasts"]
+
+def median(values):
+    values = sorted(values)
+    middle = len(values)//2
+    return values[middle] if len(values)%2 else (values[middle-1]+values[middle])/2.0
+
+def get_stats(times):
+    mean = sum(times)/len(times)
+    stddev = math.sqrt(sum((t-mean)**2 for t in times)/(len(times)-1)) if len(times) > 1 else 0.0
+    return {"rounds":len(times),"min":min(times),"max":max(times),"mean":mean,"median":median(times),"stddev":stddev}
+
+#Times func rounds times after one warmup call, stopping early once max_time seconds are spent (at least one round)
+def time_rounds(func, reset, rounds, max_time):
+    if reset:
+        reset()
+    func()
+    times = []
+    spent = 0.0
+    while len(times) < rounds and (not times or spent < max_time):
+        if reset:
+            reset()
+        start = timer()
+        func()
+        times.append(timer()-start)
+        spent += times[-1]
+    return times
+
+#Scales each benchmark runs at: the product of the options it depends on, the others at their first value
+#Scales over max_cells (features x samples) are left out, their fixtures are too large to generate by default
+def get_scales(depends, values, max_cells):
+    scales = []
+    for combo in itertools.product(*[values[k] if k in depends else values[k][:1] for k in SCALE_KEYS]):
+        scale = dict(zip(SCALE_KEYS,combo))
+        for key in SCALE_KEYS:
+            if key not in depends:
+                scale[key] = None
+        if max_cells and "samples" in depends and scale["features"]*scale["samples"] > max_cells:
+            continue
+        if scale not in scales:
+            scales.append(scale)
+    return scales
+
+def run_benchmarks(args):
+    if args.full:
+        args.features = FULL_FEATURES
+        args.samples = FULL_SAMPLES
+    values = {"features":[int(v) for v in args.features.split(",")],"samples":[int(v) for v in args.samples.split(",")],
+              "contrasts":[int(v) for v in args.contrasts.split(",")]}
+    names = [b[0] for b in BENCHMARKS] if args.benchmarks == "all" else args.benchmarks.split(",")
+    unknown = [n for n in names if n not in [b[0] for b in BENCHMARKS]]
+    if unknown:
+        sys.stderr.write("Unknown benchmarks: %s\n"%",".join(unknown))
+        sys.exit(2)
+    fixtures = Fixtures(os.path.abspath(args.work_dir),args.seed)
+    results = []
+    for name,setup,depends,item_name in BENCHMARKS:
+        if name not in names:
+            continue
+        for scale in get_scales(depends,values,args.max_cells):
+            result = dict(scale)
+            result.update({"benchmark":name,"item_name":item_name})
+            try:
+                func,items,reset = setup(fixtures,scale,args)
+                result.update(get_stats(time_rounds(func,reset,args.rounds,args.max_time)))
+                result["items"] = items
+                result["throughput"] = items/result["min"] if result["min"] > 0 else 0.0
+                result["status"] = "ok"
+            except (Exception,SystemExit) as e:
+                result["status"] = "failed: %s"%e
+            results.append(result)
+            print_result(result)
+    return {"python":sys.version.split()[0],"threads":args.threads,"rounds":args.rounds,"results":results}
+
+def get_scale_label(r):
+    return " ".join("%s=%s"%(k,r[k]) for k in SCALE_KEYS if r.get(k) is not None)
+
+def print_result(r):
+    if r["status"] != "ok":
+        print("%-28s %-40s %s"%(r["benchmark"],get_scale_label(r),r["status"]))
+    else:
+        print("%-28s %-40s min %10.4fs  median %10.4fs  stddev %8.4fs  rounds %-3d %12.0f %s/s"%(
+            r["benchmark"],get_scale_label(r),r["min"],r["median"],r["stddev"],r["rounds"],r["throughput"],r["item_name"]))
+    sys.stdout.flush()
+
+#Each benchmark against the same benchmark and scale in the baseline: min time ratio, and whether it's a regression
+def compare(report, baseline_report, tolerance):
+    get_key = lambda r: tuple([r["benchmark"]]+[r.get(k) for k in SCALE_KEYS])
+    baseline = dict((get_key(r),r) for r in baseline_report["results"] if r["status"] == "ok")
+    comparisons = []
+    for r in report["results"]:
+        base = baseline.get(get_key(r))
+        if base is None or r["status"] != "ok":
+            continue
+        ratio = r["min"]/base["min"] if base["min"] > 0 else float("inf")
+        regression = ratio > 1+tolerance and r["min"]-base["min"] > MIN_REGRESSION_SECONDS
+        comparisons.append((r,base,ratio,regression))
+    return comparisons
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the matrix and parsing functions on generated fixtures")
+    parser.add_argument("--features",default=DEFAULT_FEATURES,help="genes per fixture, comma separated")
+    parser.add_argument("--samples",default=DEFAULT_SAMPLES,help="samples per fixture, comma separated")
+    parser.add_argument("--contrasts",default="3",help="contrasts (condition pairs) per fixture, comma separated")
+    parser.add_argument("--full",action="store_true",help="features %s and samples %s"%(FULL_FEATURES,FULL_SAMPLES))
+    parser.add_argument("--max-cells",type=int,default=2*10**7,help="skip features x samples scales above this, 0 for no limit")
+    parser.add_argument("--benchmarks",default="all",help="comma separated, from: %s"%",".join(b[0] for b in BENCHMARKS))
+    parser.add_argument("--rounds",type=int,default=5,help="timed calls per benchmark, after a warmup call")
+    parser.add_argument("--max-time",type=float,default=30.0,help="stop a benchmark's rounds after this many seconds")
+    parser.add_argument("--threads",type=int,default=1,help="core budget of the functions (max_cores, prepDE -P)")
+    parser.add_argument("--seed",type=int,default=0)
+    parser.add_argument("--work-dir",default="microbench_data",help="where fixtures are generated and kept")
+    parser.add_argument("--output",help="write the results as json")
+    parser.add_argument("--baseline",help="results json of an earlier run to compare with")
+    parser.add_argument("--tolerance",type=float,default=0.25,help="allowed min time growth against the baseline")
+    args = parser.parse_args()
+    report = run_benchmarks(args)
+    if args.output:
+        with open(args.output,"w") as o:
+            json.dump(report,o,indent=1,sort_keys=True)
+    failed = [r for r in report["results"] if r["status"] != "ok"]
+    if args.baseline:
+        with open(args.baseline,"r") as bf:
+            comparisons = compare(report,json.load(bf),args.tolerance)
+        print("\nagainst %s (min time, new/baseline):"%args.baseline)
+        for r,base,ratio,regression in comparisons:
+            print("%-28s %-40s %10.4fs -> %10.4fs  %6.2fx%s"%(r["benchmark"],get_scale_label(r),base["min"],r["min"],ratio," REGRESSION" if regression else ""))
+        if any(c[3] for c in comparisons):
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
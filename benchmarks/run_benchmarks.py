@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import os,sys,time
+import json
+import math
+import errno
+import shutil
+import argparse
+import itertools
+import subprocess
+import traceback
+
+#End to end benchmarks of the python side of the pipeline steps, on synthetic datasets (synthetic_data.py)
+#Each step runs the pipeline function prok_tuxedo's task would call, in a forked process, and is measured with os.wait4:
+#wall time, cpu time (with the tools it starts) and peak memory. Throughput is items per second, items being what the
+#step scales with (reads, features x samples, genes x contrasts)
+#Tools that aren't installed are replaced by the stand-ins in benchmarks/stubs (samtools reads text sam as ".bam")
+#Every combination of the comma separated scale options runs, so one option with several values gives a scaling curve:
+#  python benchmarks/run_benchmarks.py --samples 4,8,16,32 --genes 5000 --depth 200000 --output results.json
+#  python benchmarks/run_benchmarks.py --samples 4,8,16,32 --genes 5000 --depth 200000 --baseline results.json
+#With --baseline, steps slower (or larger) than the baseline by more than --tolerance are listed and the exit code is 1
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+STUB_DIR = os.path.join(BENCHMARK_DIR,"stubs")
+#external tools the benchmarked steps run
+TOOLS = ["samtools"]
+#differences below this many seconds are noise, not regressions
+MIN_REGRESSION_SECONDS = 0.05
+SCALE_KEYS = ["recipe","samples","genes","depth","contrasts"]
+
+sys.path.insert(0,REPO_DIR)
+sys.path.insert(0,BENCHMARK_DIR)
+import synthetic_data
+#subsystems first: prok_tuxedo and subsystems import each other
+import subsystems
+import prok_tuxedo
+import prep_diffexp_files
+import quantification
+import workdir
+
+def find_executable(tool):
+    for path_dir in os.environ.get("PATH","").split(os.pathsep):
+        path = os.path.join(path_dir,tool)
+        if os.path.isfile(path) and os.access(path,os.X_OK):
+            return path
+    return None
+
+#Puts the repository (prepDE.py) and the stubs of missing tools on PATH. Returns {tool:"installed"|"stub"}
+def setup_path(work_dir):
+    tool_status = {}
+    stub_bin = os.path.join(work_dir,"bin")
+    if not os.path.isdir(stub_bin):
+        os.makedirs(stub_bin)
+    for tool in TOOLS:
+        link = os.path.join(stub_bin,tool)
+        if os.path.lexists(link):
+            os.remove(link)
+        if find_executable(tool):
+            tool_status[tool] = "installed"
+        else:
+            os.symlink(os.path.join(STUB_DIR,tool),link)
+            tool_status[tool] = "stub"
+    os.environ["PATH"] = os.pathsep.join([REPO_DIR,stub_bin,os.environ.get("PATH","")])
+    return tool_status
+
+#A dataset per scale, kept in work_dir and reused by later runs with the same scale
+class Dataset(object):
+    def __init__(self, work_dir, scale, tool_status, seed=0):
+        self.scale = scale
+        self.host = scale["recipe"] == "host"
+        name = "%s_s%d_g%d_d%d_c%d"%(scale["recipe"],scale["samples"],scale["genes"],scale["depth"],scale["contrasts"])
+        self.dir = os.path.join(work_dir,name)
+        done_file = os.path.join(self.dir,"dataset.json")
+        if not os.path.exists(done_file):
+            if os.path.isdir(self.dir):
+                shutil.rmtree(self.dir)
+            start = time.time()
+            genome,condition_dict,contrasts = synthetic_data.make_dataset(self.dir,scale["samples"],scale["genes"],scale["depth"],
+                                                                          scale["contrasts"],host=self.host,seed=seed)
+            self.make_bam(genome,condition_dict,tool_status)
+            with open(done_file,"w") as o:
+                json.dump({"genome":genome,"condition_dict":condition_dict,"contrasts":contrasts},o)
+            print("generated %s in %.1fs"%(name,time.time()-start))
+        with open(done_file,"r") as f:
+            dataset = json.load(f)
+        self.genome = dataset["genome"]
+        self.condition_dict = dataset["condition_dict"]
+        self.contrasts = dataset["contrasts"]
+        self.genome_file = self.genome["genome"]
+
+    #The read-level steps use the first sample's bam: converted with samtools if it's installed, the sam itself for the stub
+    def make_bam(self, genome, condition_dict, tool_status):
+        for condition in condition_dict:
+            for replicate in condition_dict[condition]["replicates"]:
+                rep = replicate[genome["genome"]]
+                if "sam" not in rep:
+                    continue
+                if tool_status["samtools"] == "installed":
+                    subprocess.check_call(["samtools","view","-b","-o",rep["bam"],rep["sam"]])
+                else:
+                    shutil.copy(rep["sam"],rep["bam"])
+                subprocess.check_call(["samtools","index",rep["bam"]])
+
+    def replicates(self):
+        return [r[self.genome_file] for c in sorted(self.condition_dict) for r in self.condition_dict[c]["replicates"]]
+
+    def first_replicate(self):
+        return [r for r in self.replicates() if "sam" in r][0]
+
+    def num_transcripts(self):
+        with open(self.replicates()[0]["gtf"],"r") as gf:
+            return sum(1 for line in gf if "\ttranscript\t" in line)
+
+    def num_features(self):
+        counts_files = [self.replicates()[0][key] for key in (["gene_counts","transcript_counts"] if self.host else ["counts"])]
+        return sum(sum(1 for line in open(cf)) for cf in counts_files)
+
+    #fresh copies of the pipeline structures, steps add keys to them
+    def genome_list(self):
+        return [json.loads(json.dumps(self.genome))]
+
+    def conditions(self):
+        return json.loads(json.dumps(self.condition_dict))
+
+#Benchmarked steps: name -> (run(dataset,job_data), items(dataset), item name)
+def run_split_bam(dataset, job_data):
+    rep = dataset.first_replicate()
+    quantification.split_bam_file(rep["bam"],job_data["max_cores"],[],workdir.WorkDir(os.path.dirname(rep["bam"])))
+
+def cleanup_split_bam(dataset):
+    split_dir = os.path.join(os.path.dirname(dataset.first_replicate()["bam"]),"Split_Bams")
+    if os.path.isdir(split_dir):
+        shutil.rmtree(split_dir)
+
+def run_counts_matrix(dataset, job_data):
+    create_counts_table = prep_diffexp_files.create_counts_table_host if dataset.host else prep_diffexp_files.create_counts_table
+    create_counts_table(dataset.genome_list(),dataset.conditions(),job_data)
+
+def run_prepde(dataset, job_data):
+    genome_list = dataset.genome_list()
+    #prepDE is skipped when the checkpoint manifest says its matrices are up to date
+    manifest_file = os.path.join(genome_list[0]["output"],"checkpoint.json")
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+    prok_tuxedo.prep_stringtie_matrix(genome_list,dataset.conditions(),dataset.host,[],job_data)
+
+def run_top_diffexp_genes(dataset, job_data):
+    prok_tuxedo.top_diffexp_genes(dataset.genome_list(),job_data)
+
+def run_write_gmx(dataset, job_data):
+    prok_tuxedo.write_gmx_file(dataset.genome_list())
+
+STAGES = [
+    ("split_bam_file",run_split_bam,lambda d: d.scale["depth"],"reads"),
+    ("counts_matrix",run_counts_matrix,lambda d: d.num_features()*d.scale["samples"],"counts"),
+    ("prepDE",run_prepde,lambda d: d.num_transcripts()*d.scale["samples"],"transcripts"),
+    ("top_diffexp_genes",run_top_diffexp_genes,lambda d: d.scale["genes"]*len(d.contrasts),"genes"),
+    ("write_gmx_file",run_write_gmx,lambda d: d.scale["genes"]*len(d.contrasts),"genes"),
+]
+CLEANUP = {"split_bam_file":cleanup_split_bam}
+
+#Runs func in a forked process and returns its exit status, wall time, cpu time and peak rss (kB)
+#The rusage covers the process and the commands it waited on. The forked process starts as a copy of this one,
+#so the peak rss includes the harness itself (see the "baseline" row of the report)
+def measure(func, quiet=True):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        if quiet:
+            devnull = os.open(os.devnull,os.O_WRONLY)
+            os.dup2(devnull,1)
+        try:
+            func()
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+    while True:
+        try:
+            pid,status,rusage = os.wait4(pid,0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    return {"status":os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status),
+            "wall_time":time.time()-start,
+            "cpu_time":rusage.ru_utime+rusage.ru_stime,
+            "max_rss_kb":rusage.ru_maxrss}
+
+def get_scales(args):
+    values = {"recipe":args.recipe.split(",")}
+    for key in SCALE_KEYS[1:]:
+        values[key] = [int(v) for v in getattr(args,key).split(",")]
+    return [dict(zip(SCALE_KEYS,combo)) for combo in itertools.product(*[values[k] for k in SCALE_KEYS])]
+
+#Runs the selected steps at every scale, each repeat times, keeping the fastest run
+def run_benchmarks(args):
+    work_dir = os.path.abspath(args.work_dir)
+    tool_status = setup_path(work_dir)
+    stage_names = [s[0] for s in STAGES] if args.stages == "all" else args.stages.split(",")
+    unknown = [s for s in stage_names if s not in [st[0] for st in STAGES]]
+    if unknown:
+        sys.stderr.write("Unknown stages: %s\n"%",".join(unknown))
+        sys.exit(2)
+    job_data = {"max_cores":args.threads,"feature_count":"htseq"}
+    results = []
+    baseline = measure(lambda: None)
+    for scale in get_scales(args):
+        dataset = Dataset(work_dir,scale,tool_status,args.seed)
+        for name,run,items,item_name in STAGES:
+            if name not in stage_names:
+                continue
+            best = None
+            for r in range(args.repeat):
+                m = measure(lambda: run(dataset,job_data),not args.verbose)
+                if name in CLEANUP:
+                    CLEANUP[name](dataset)
+                if m["status"] != 0:
+                    sys.stderr.write("%s failed at %s\n"%(name,json.dumps(scale,sort_keys=True)))
+                    best = m
+                    break
+                if best is None or m["wall_time"] < best["wall_time"]:
+                    best = m
+            result = dict(scale)
+            result.update(best)
+            result["stage"] = name
+            result["items"] = items(dataset)
+            result["item_name"] = item_name
+            result["throughput"] = result["items"]/best["wall_time"] if best["wall_time"] > 0 else 0.0
+            results.append(result)
+            print_result(result)
+    return {"tools":tool_status,"threads":args.threads,"repeat":args.repeat,"python":sys.version.split()[0],
+            "baseline_rss_kb":baseline["max_rss_kb"],"results":results}
+
+def print_result(r):
+    print("%-8s samples=%-5d genes=%-7d depth=%-9d contrasts=%-3d %-18s %10.3fs wall %10.3fs cpu %9.1f MB %12.0f %s/s%s"%(
+        r["recipe"],r["samples"],r["genes"],r["depth"],r["contrasts"],r["stage"],r["wall_time"],r["cpu_time"],
+        r["max_rss_kb"]/1024.0,r["throughput"],r["item_name"],"" if r["status"] == 0 else " FAILED"))
+    sys.stdout.flush()
+
+#Scaling curves: for each step and each scale option that varies with the others fixed, the wall time against the items
+#The exponent is the log-log slope between neighbouring points: ~1 is linear, ~2 quadratic
+def get_scaling(results):
+    curves = []
+    for key in SCALE_KEYS[1:]:
+        others = [k for k in SCALE_KEYS if k != key]
+        groups = {}
+        for r in results:
+            if r["status"] == 0:
+                groups.setdefault(tuple([r["stage"]]+[r[k] for k in others]),[]).append(r)
+        for group_key in sorted(groups):
+            points = sorted(groups[group_key],key=lambda r: r[key])
+            #the step doesn't scale with this option
+            if len(set(r["items"] for r in points)) < 2:
+                continue
+            curve = {"stage":group_key[0],"varied":key,"fixed":dict(zip(others,group_key[1:])),"points":[]}
+            for prev,cur in zip([None]+points[:-1],points):
+                point = {key:cur[key],"items":cur["items"],"wall_time":cur["wall_time"],"max_rss_kb":cur["max_rss_kb"],"exponent":None}
+                if prev is not None and cur["items"] > prev["items"] and prev["wall_time"] > 0 and cur["wall_time"] > 0:
+                    point["exponent"] = math.log(cur["wall_time"]/prev["wall_time"])/math.log(float(cur["items"])/prev["items"])
+                curve["points"].append(point)
+            curves.append(curve)
+    return curves
+
+def print_scaling(curves):
+    for curve in curves:
+        fixed = " ".join("%s=%s"%(k,curve["fixed"][k]) for k in SCALE_KEYS if k in curve["fixed"])
+        print("\n%s vs %s (%s)"%(curve["stage"],curve["varied"],fixed))
+        for p in curve["points"]:
+            exponent = "" if p["exponent"] is None else "exponent %.2f"%p["exponent"]
+            print("  %s=%-9d items=%-10d %10.3fs %9.1f MB  %s"%(curve["varied"],p[curve["varied"]],p["items"],p["wall_time"],p["max_rss_kb"]/1024.0,exponent))
+
+#Steps at the same scale that got slower or larger than in the baseline results by more than tolerance
+def compare(report, baseline_report, tolerance):
+    get_key = lambda r: tuple([r["stage"]]+[r[k] for k in SCALE_KEYS])
+    baseline = dict((get_key(r),r) for r in baseline_report["results"] if r["status"] == 0)
+    regressions = []
+    for r in report["results"]:
+        base = baseline.get(get_key(r))
+        if base is None:
+            continue
+        if r["status"] != 0:
+            regressions.append((r,"failed"))
+            continue
+        if r["wall_time"] > base["wall_time"]*(1+tolerance) and r["wall_time"]-base["wall_time"] > MIN_REGRESSION_SECONDS:
+            regressions.append((r,"wall time %.3fs -> %.3fs"%(base["wall_time"],r["wall_time"])))
+        if r["max_rss_kb"] > base["max_rss_kb"]*(1+tolerance):
+            regressions.append((r,"peak rss %.1f MB -> %.1f MB"%(base["max_rss_kb"]/1024.0,r["max_rss_kb"]/1024.0)))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the pipeline steps on synthetic RNA-seq datasets")
+    parser.add_argument("--recipe",default="bacterial",help="bacterial and/or host, comma separated")
+    parser.add_argument("--samples",default="4",help="samples per dataset, comma separated")
+    parser.add_argument("--genes",default="4000",help="genes per genome, comma separated")
+    parser.add_argument("--depth",default="100000",help="reads per sample, comma separated")
+    parser.add_argument("--contrasts",default="1",help="differential expression contrasts, comma separated")
+    parser.add_argument("--stages",default="all",help="comma separated, from: %s"%",".join(s[0] for s in STAGES))
+    parser.add_argument("--threads",type=int,default=4,help="core budget of the steps (max_cores)")
+    parser.add_argument("--repeat",type=int,default=1,help="runs per step, the fastest is reported")
+    parser.add_argument("--seed",type=int,default=0)
+    parser.add_argument("--work-dir",default="benchmark_data",help="where datasets are generated and kept")
+    parser.add_argument("--output",help="write the results as json")
+    parser.add_argument("--baseline",help="results json of an earlier run to compare with")
+    parser.add_argument("--tolerance",type=float,default=0.25,help="allowed slowdown/growth against the baseline")
+    parser.add_argument("--verbose",action="store_true",help="show the output of the steps")
+    args = parser.parse_args()
+    report = run_benchmarks(args)
+    print("\nbaseline (empty step): %.1f MB peak rss, tools: %s"%(report["baseline_rss_kb"]/1024.0,
+          ", ".join("%s %s"%(t,s) for t,s in sorted(report["tools"].items()))))
+    report["scaling"] = get_scaling(report["results"])
+    print_scaling(report["scaling"])
+    if args.output:
+        with open(args.output,"w") as o:
+            json.dump(report,o,indent=1,sort_keys=True)
+    failed = [r for r in report["results"] if r["status"] != 0]
+    if args.baseline:
+        with open(args.baseline,"r") as bf:
+            regressions = compare(report,json.load(bf),args.tolerance)
+        print("\n%d regressions against %s"%(len(regressions),args.baseline))
+        for r,reason in regressions:
+            print("  %s %s: %s"%(r["stage"]," ".join("%s=%s"%(k,r[k]) for k in SCALE_KEYS),reason))
+        if regressions:
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import os,sys
+import random
+import math
+
+#Synthetic inputs for the benchmarks: genomes, annotations, reads and the intermediate files of each pipeline step
+#Everything is generated from a seed, so the same scale gives the same files
+#Bacterial genomes have one chromosome and gene/CDS features, host-like genomes have several chromosomes and
+#gene/mRNA/exon features (plus the other Host feature types), several transcripts per gene
+BASES = "ACGT"
+#htseq-count special counters written at the end of each counts file
+HTSEQ_COUNTERS = ["__no_feature","__ambiguous","__too_low_aQual","__not_aligned","__alignment_not_unique"]
+#genes per chromosome of host-like genomes
+HOST_GENES_PER_CHROMOSOME = 2000
+#feature types of the extra host features, see quantification.HOST_GENE_FEATURES/HOST_TRANSCRIPT_FEATURES
+HOST_TRANSCRIPT_TYPES = ["mRNA","lnc_RNA","transcript","snRNA","snoRNA","miRNA","rRNA","tRNA"]
+
+#One annotated gene: (contig,start,end,strand,gene id,[transcript ids]), 1-based inclusive coordinates
+def make_genes(num_genes, host=False, seed=0):
+    rng = random.Random(seed)
+    num_contigs = max(1,int(math.ceil(float(num_genes)/HOST_GENES_PER_CHROMOSOME))) if host else 1
+    genes = []
+    contig_lengths = {}
+    for c in range(num_contigs):
+        contig = "chr%d"%(c+1) if host else "NC_000001.1"
+        pos = 1
+        contig_genes = num_genes//num_contigs+(1 if c < num_genes%num_contigs else 0)
+        for g in range(contig_genes):
+            pos += rng.randint(50,500)
+            length = rng.randint(300,3000)
+            gene_id = "gene-G%06d"%len(genes)
+            num_transcripts = rng.randint(1,3) if host else 1
+            transcripts = ["rna-G%06d.%d"%(len(genes),t+1) for t in range(num_transcripts)]
+            genes.append((contig,pos,pos+length-1,rng.choice("+-"),gene_id,transcripts))
+            pos += length
+        contig_lengths[contig] = pos+rng.randint(50,500)
+    return genes,contig_lengths
+
+def write_genome(fasta_file, contig_lengths, seed=0):
+    rng = random.Random(seed)
+    with open(fasta_file,"w") as o:
+        for contig in sorted(contig_lengths):
+            o.write(">%s\n"%contig)
+            for start in range(0,contig_lengths[contig],80):
+                o.write("".join(rng.choice(BASES) for i in range(min(80,contig_lengths[contig]-start)))+"\n")
+
+#GFF3 in the layout of the PATRIC/RefSeq annotations the pipeline reads: ID attributes, Parent links for transcripts and exons
+def write_gff(gff_file, genes, host=False, seed=0):
+    rng = random.Random(seed)
+    with open(gff_file,"w") as o:
+        o.write("##gff-version 3\n")
+        for contig,start,end,strand,gene_id,transcripts in genes:
+            o.write("%s\tsynthetic\tgene\t%d\t%d\t.\t%s\t.\tID=%s;Name=%s\n"%(contig,start,end,strand,gene_id,gene_id.replace("gene-","")))
+            if not host:
+                o.write("%s\tsynthetic\tCDS\t%d\t%d\t.\t%s\t0\tID=cds-%s;Parent=%s\n"%(contig,start,end,strand,gene_id.replace("gene-",""),gene_id))
+                continue
+            for transcript_id in transcripts:
+                feature_type = "mRNA" if rng.random() < 0.8 else rng.choice(HOST_TRANSCRIPT_TYPES)
+                o.write("%s\tsynthetic\t%s\t%d\t%d\t.\t%s\t.\tID=%s;Parent=%s\n"%(contig,feature_type,start,end,strand,transcript_id,gene_id))
+                for e,(exon_start,exon_end) in enumerate(get_exons(start,end,transcript_id)):
+                    o.write("%s\tsynthetic\texon\t%d\t%d\t.\t%s\t.\tID=exon-%s-%d;Parent=%s\n"%(contig,exon_start,exon_end,strand,transcript_id,e+1,transcript_id))
+
+#Exons of a transcript: the gene cut into 1-3 pieces, the same for every sample
+def get_exons(start, end, transcript_id):
+    rng = random.Random(transcript_id)
+    num_exons = rng.randint(1,3)
+    length = end-start+1
+    bounds = sorted(rng.sample(range(start+1,end),num_exons-1)) if num_exons > 1 and length > 10 else []
+    exons = []
+    exon_start = start
+    for b in bounds+[end+1]:
+        exons.append((exon_start,max(exon_start,b-int(length*0.05)-1)))
+        exon_start = b
+    return exons
+
+#Relative expression of each gene in each condition: a shared log-normal level, a fold change in some conditions
+def make_expression(genes, conditions, seed=0):
+    rng = random.Random(seed)
+    expression = {}
+    for gene in genes:
+        level = rng.lognormvariate(0,1.5)
+        expression[gene[4]] = dict((condition,level*(2**rng.gauss(0,2) if rng.random() < 0.1 else 1.0)) for condition in conditions)
+    return expression
+
+#Simulated reads of one sample, sorted by position, as a sam file (and fastq if fastq_file is given)
+#Reads come from the genes in proportion to their expression and are placed exactly where they were drawn from
+def write_reads(sam_file, genes, contig_lengths, expression, condition, num_reads, read_length=100, seed=0, fastq_file=None):
+    rng = random.Random(seed)
+    weights = [expression[g[4]][condition]*(g[2]-g[1]+1) for g in genes]
+    total = sum(weights)
+    cumulative = []
+    running = 0.0
+    for w in weights:
+        running += w/total
+        cumulative.append(running)
+    contig_order = sorted(contig_lengths)
+    reads = []
+    for r in range(num_reads):
+        x = rng.random()
+        lo,hi = 0,len(cumulative)-1
+        while lo < hi:
+            mid = (lo+hi)//2
+            if cumulative[mid] < x:
+                lo = mid+1
+            else:
+                hi = mid
+        contig,start,end,strand,gene_id,transcripts = genes[lo]
+        pos = rng.randint(start,max(start,end-read_length+1))
+        reads.append((contig_order.index(contig),pos,strand,r))
+    reads.sort()
+    fq = open(fastq_file,"w") if fastq_file else None
+    with open(sam_file,"w") as o:
+        o.write("@HD\tVN:1.6\tSO:coordinate\n")
+        for contig in contig_order:
+            o.write("@SQ\tSN:%s\tLN:%d\n"%(contig,contig_lengths[contig]))
+        o.write("@PG\tID:synthetic\tPN:synthetic_data.py\n")
+        for contig_index,pos,strand,r in reads:
+            seq = "".join(rng.choice(BASES) for i in range(read_length))
+            qual = "I"*read_length
+            flag = 0 if strand == "+" else 16
+            o.write("read%d\t%d\t%s\t%d\t60\t%dM\t*\t0\t0\t%s\t%s\tNH:i:1\n"%(r,flag,contig_order[contig_index],pos,read_length,seq,qual))
+            if fq:
+                fq.write("@read%d\n%s\n+\n%s\n"%(r,seq,qual))
+    if fq:
+        fq.close()
+
+#htseq-count output: one line per feature id (genes or transcripts) then the special counters
+def write_counts_file(counts_file, features, expression, condition, depth, seed=0):
+    rng = random.Random(seed)
+    total = sum(expression[f][condition] for f in features)
+    with open(counts_file,"w") as o:
+        for f in features:
+            mean = depth*expression[f][condition]/total
+            o.write("%s\t%d\n"%(f,max(0,int(rng.gauss(mean,math.sqrt(mean)+1)))))
+        for counter in HTSEQ_COUNTERS:
+            o.write("%s\t%d\n"%(counter,rng.randint(0,depth//100+1)))
+
+#StringTie -G output for one sample: transcript and exon lines with coverage, a few novel MSTRG transcripts
+def write_stringtie_gtf(gtf_file, genes, expression, condition, read_length=100, seed=0):
+    rng = random.Random(seed)
+    with open(gtf_file,"w") as o:
+        o.write("# stringtie -G synthetic.gff\n# StringTie version 2.1.4\n")
+        for contig,start,end,strand,gene_id,transcripts in genes:
+            if rng.random() < 0.02:
+                #novel transcript without a reference gene
+                gene_id = "MSTRG.%d"%rng.randint(1,len(genes))
+                transcripts = [gene_id+".1"]
+            for transcript_id in transcripts:
+                cov = expression.get(gene_id,{}).get(condition,1.0)*rng.uniform(0.5,1.5)*10
+                attributes = 'gene_id "%s"; transcript_id "%s"; reference_id "%s"; cov "%.6f"; FPKM "%.6f"; TPM "%.6f";'%(gene_id,transcript_id,transcript_id,cov,cov/2,cov/3)
+                o.write("%s\tStringTie\ttranscript\t%d\t%d\t1000\t%s\t.\t%s\n"%(contig,start,end,strand,attributes))
+                for e,(exon_start,exon_end) in enumerate(get_exons(start,end,transcript_id)):
+                    o.write('%s\tStringTie\texon\t%d\t%d\t1000\t%s\t.\tgene_id "%s"; transcript_id "%s"; exon_number "%d"; cov "%.6f";\n'%(contig,exon_start,exon_end,strand,gene_id,transcript_id,e+1,cov))
+
+#run_deseq2.R results for one contrast, sorted by gene like the script writes them
+def write_deseq2_contrast(contrast_file, features, seed=0):
+    rng = random.Random(seed)
+    with open(contrast_file,"w") as o:
+        o.write("\tbaseMean\tlog2FoldChange\tlfcSE\tstat\tpvalue\tpadj\n")
+        for f in sorted(features):
+            log_fc = rng.gauss(0,2) if rng.random() < 0.2 else rng.gauss(0,0.3)
+            pvalue = min(1.0,math.exp(-abs(log_fc)*rng.uniform(1,6)))
+            padj = "NA" if rng.random() < 0.05 else "%.6g"%min(1.0,pvalue*3)
+            o.write("%s\t%.4f\t%.6f\t%.6f\t%.6f\t%.6g\t%s\n"%(f,rng.uniform(1,5000),log_fc,rng.uniform(0.1,1),log_fc/0.3,pvalue,padj))
+
+#cuffdiff gene_exp.diff with every feature tested in every condition pair, 14 columns like cuffdiff writes them
+def write_cuffdiff_file(diff_file, features, conditions, seed=0):
+    rng = random.Random(seed)
+    pairs = [(conditions[i],conditions[j]) for i in range(len(conditions)) for j in range(i+1,len(conditions))]
+    with open(diff_file,"w") as o:
+        o.write("test_id\tgene_id\tgene\tlocus\tsample_1\tsample_2\tstatus\tvalue_1\tvalue_2\tlog2(fold_change)\ttest_stat\tp_value\tq_value\tsignificant\n")
+        for n,f in enumerate(features):
+            for sample1,sample2 in pairs:
+                value1 = 0.0 if rng.random() < 0.05 else rng.uniform(0,500)
+                value2 = rng.uniform(0,500)
+                log_fc = math.log((value2 or 0.01)/(value1 or 0.01),2)
+                status = "OK" if rng.random() < 0.9 else "NOTEST"
+                o.write("XLOC_%06d\tXLOC_%06d\t%s\tchr1:%d-%d\t%s\t%s\t%s\t%.4f\t%.4f\t%.6f\t%.4f\t%.4g\t%.4g\tno\n"%(
+                    n,n,f,n*1000,n*1000+900,sample1,sample2,status,value1,value2,log_fc,log_fc*1.5,rng.random(),rng.random()))
+
+#samstat html report in the layout modify_samstat_for_multiqc edits: the body css block, canvas1-4 charts,
+#the mapping quality section it cuts out and the footer. num_rows rows per table
+def write_samstat_html(html_file, num_rows, seed=0):
+    rng = random.Random(seed)
+    with open(html_file,"w") as o:
+        o.write("<!DOCTYPE html>\n<html>\n<head>\n<style>\nbody {\nfont-family: sans-serif;\nmargin: 0;\n}\ntable { border: 1px; }\n</style>\n</head>\n<body>\n")
+        for canvas in ["canvas1","canvas2","canvas3","canvas4"]:
+            o.write("<h2>Statistics %s</h2>\n<table>\n"%canvas)
+            for r in range(num_rows):
+                o.write("<tr><td>MAPQ &gt;= %d</td><td>%d</td><td>%.2f%%</td></tr>\n"%(r,rng.randint(0,10**6),rng.random()*100))
+            o.write("</table>\n<canvas id=\"%s\"></canvas>\n<script>var ctx_%s = document.getElementById(\"%s\"); new Chart(ctx_%s,{animation: true});</script>\n"%(canvas,canvas,canvas,canvas))
+        o.write("<h2>Base quality distributions separated by mapping quality thresholds</h2>\n")
+        for r in range(num_rows):
+            o.write("<tr><td>%d</td><td>%s</td></tr>\n"%(r,",".join(str(rng.randint(0,40)) for i in range(10))))
+        o.write("</footer>\n</body>\n</html>\n")
+
+#Writes a whole dataset under out_dir and returns the pipeline structures that point at it:
+#(genome, condition_dict, contrasts) shaped like prok_tuxedo builds them, replicates carry the files of every step
+#samples are spread over num_conditions conditions, contrasts are the first num_contrasts condition pairs
+#Reads (sam/fastq) are only simulated for the first sample: the read-level steps run on a single replicate
+def make_dataset(out_dir, num_samples, num_genes, depth, num_contrasts=1, num_conditions=2, host=False, read_length=100, seed=0, fastq=False):
+    genome_id = "host.1" if host else "bacteria.1"
+    genome_dir = os.path.join(out_dir,"genome")
+    genome_output = os.path.join(out_dir,"output",genome_id)
+    for d in [genome_dir,genome_output]:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    genes,contig_lengths = make_genes(num_genes,host,seed)
+    genome = {"genome":os.path.join(genome_dir,genome_id+".fna"),"annotation":os.path.join(genome_dir,genome_id+".gff"),
+              "dir":genome_dir,"output":genome_output}
+    write_genome(genome["genome"],contig_lengths,seed)
+    write_gff(genome["annotation"],genes,host,seed)
+    #enough conditions for num_contrasts distinct pairs
+    while num_conditions*(num_conditions-1)//2 < num_contrasts:
+        num_conditions += 1
+    conditions = ["cond%d"%(c+1) for c in range(max(2,num_conditions))]
+    expression = make_expression(genes,conditions,seed)
+    transcript_expression = {}
+    for g in genes:
+        for transcript_id in g[5]:
+            transcript_expression[transcript_id] = expression[g[4]]
+    all_expression = dict(expression)
+    all_expression.update(transcript_expression)
+    condition_dict = dict((condition,{"replicates":[]}) for condition in conditions)
+    for s in range(num_samples):
+        condition = conditions[s%len(conditions)]
+        sample_id = "S%d"%(s+1)
+        sample_dir = os.path.join(genome_output,condition,"replicate%d"%(len(condition_dict[condition]["replicates"])+1))
+        if not os.path.isdir(sample_dir):
+            os.makedirs(sample_dir)
+        rep = {"bam":os.path.join(sample_dir,sample_id+".bam"),"avg_read_length":str(read_length),"gtf":os.path.join(sample_dir,sample_id+".gtf")}
+        sample_seed = seed*100003+s
+        if host:
+            rep["gene_counts"] = os.path.join(sample_dir,sample_id+".gene.counts")
+            rep["transcript_counts"] = os.path.join(sample_dir,sample_id+".transcript.counts")
+            write_counts_file(rep["gene_counts"],[g[4] for g in genes],expression,condition,depth,sample_seed)
+            write_counts_file(rep["transcript_counts"],sorted(transcript_expression),transcript_expression,condition,depth,sample_seed)
+        else:
+            rep["counts"] = os.path.join(sample_dir,sample_id+".counts")
+            write_counts_file(rep["counts"],[g[4] for g in genes],expression,condition,depth,sample_seed)
+        write_stringtie_gtf(rep["gtf"],genes,all_expression,condition,read_length,sample_seed)
+        if s == 0:
+            rep["sam"] = os.path.join(sample_dir,sample_id+".sam")
+            write_reads(rep["sam"],genes,contig_lengths,expression,condition,depth,read_length,sample_seed,
+                        os.path.join(sample_dir,sample_id+".fq") if fastq else None)
+        condition_dict[condition]["replicates"].append({genome["genome"]:rep})
+    pairs = [(conditions[i],conditions[j]) for i in range(len(conditions)) for j in range(i+1,len(conditions))]
+    contrasts = [list(p) for p in pairs[:max(1,num_contrasts)]]
+    genome["diff_exp_contrasts"] = []
+    for c,pair in enumerate(contrasts):
+        contrast_file = os.path.join(genome_output,"_vs_".join(pair)+".htseq.Genes.deseq2")
+        write_deseq2_contrast(contrast_file,[g[4] for g in genes],seed*7919+c)
+        genome["diff_exp_contrasts"].append(contrast_file)
+    return genome,condition_dict,contrasts
+
+#Writes one dataset: synthetic_data.py <out_dir> <samples> <genes> <depth> [contrasts] [host]
+if __name__ == "__main__":
+    if len(sys.argv) < 5:
+        sys.stderr.write("usage: synthetic_data.py out_dir samples genes depth [contrasts] [host]\n")
+        sys.exit(2)
+    make_dataset(sys.argv[1],int(sys.argv[2]),int(sys.argv[3]),int(sys.argv[4]),
+                 int(sys.argv[5]) if len(sys.argv) > 5 else 1,host=len(sys.argv) > 6 and sys.argv[6] == "host",fastq=True)
+    print("dataset written to %s"%sys.argv[1])
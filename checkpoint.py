@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+import os,sys,time
+import json
+import hashlib
+import threading
+import subprocess
+
+#Record of the completed steps of a genome pipeline, <genome output>/checkpoint.json
+#Each step (one alignment, one stringtie run, one pipeline task...) is stored under a step name with its inputs,
+#parameters, tool versions and outputs. A restarted job skips a step only when is_complete verifies it:
+# - the parameters and tool versions are the same
+# - every output exists with the recorded size and checksum, and bam files end with the BGZF EOF block
+# - every input is unchanged, so steps after a rebuilt step are rebuilt too
+#Files are compared by (size,mtime) first, the sha1 is only computed again when those differ
+#"checkpoint_checksums": false in job_data records (size,mtime) only, for very large inputs
+MANIFEST_NAME = "checkpoint.json"
+#Bump whenever the entry layout changes, older manifests are then ignored
+MANIFEST_VERSION = 1
+#empty BGZF block that ends every complete bam file
+BGZF_EOF = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+#thread and process count options, left out of the step parameters so changing the core budget doesn't rerun steps
+THREAD_OPTIONS = ["-p","--threads","-@","-P"]
+
+#manifest file -> Manifest, so the threads of a genome pipeline share one
+manifests = {}
+manifests_lock = threading.Lock()
+#(realpath,size,mtime) -> sha1, so a file is hashed once per process
+checksum_memo = {}
+#tool -> version string
+tool_versions = {}
+
+#Returns the shared Manifest of a genome output directory
+def get_manifest(genome_dir, job_data=None):
+    manifest_file = os.path.join(os.path.abspath(genome_dir),MANIFEST_NAME)
+    with manifests_lock:
+        if manifest_file not in manifests:
+            checksums = job_data.get("checkpoint_checksums",True) if job_data else True
+            manifests[manifest_file] = Manifest(manifest_file,checksums)
+        return manifests[manifest_file]
+
+def get_file_state(path):
+    st = os.stat(path)
+    return st.st_size,st.st_mtime
+
+def get_checksum(path):
+    size,mtime = get_file_state(path)
+    memo_key = (os.path.realpath(path),size,mtime)
+    if memo_key not in checksum_memo:
+        sha = hashlib.sha1()
+        with open(path,"rb") as f:
+            for chunk in iter(lambda: f.read(1<<20),b""):
+                sha.update(chunk)
+        checksum_memo[memo_key] = sha.hexdigest()
+    return checksum_memo[memo_key]
+
+#A bam cut short by a killed job is missing the EOF block
+def is_bam_complete(bam_file):
+    try:
+        with open(bam_file,"rb") as bf:
+            bf.seek(0,os.SEEK_END)
+            if bf.tell() < len(BGZF_EOF):
+                return False
+            bf.seek(-len(BGZF_EOF),os.SEEK_END)
+            return bf.read() == BGZF_EOF
+    except (IOError,OSError):
+        return False
+
+#Output checks beyond the recorded size and checksum
+def check_output(path):
+    if path.endswith(".bam"):
+        return is_bam_complete(path)
+    return True
+
+#First line that "<tool> --version" prints, "unknown" if the tool doesn't run
+def get_tool_version(tool):
+    if tool not in tool_versions:
+        try:
+            version_cmd = subprocess.Popen([tool,"--version"],stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+            output,err = version_cmd.communicate()
+            lines = [l.strip() for l in output.decode("utf-8","replace").split("\n") if l.strip()]
+            tool_versions[tool] = lines[0] if lines else "unknown"
+        except OSError:
+            tool_versions[tool] = "unknown"
+    return tool_versions[tool]
+
+#Command line without its thread count options
+def get_command_params(cmd):
+    params = []
+    skip_next = False
+    for arg in cmd:
+        if skip_next:
+            skip_next = False
+        elif arg.strip() in THREAD_OPTIONS:
+            skip_next = True
+        else:
+            params.append(arg)
+    return params
+
+class Manifest(object):
+    def __init__(self, manifest_file, checksums=True):
+        self.manifest_file = manifest_file
+        self.checksums = checksums
+        self.lock = threading.Lock()
+        self.steps = {}
+        if os.path.exists(manifest_file):
+            try:
+                with open(manifest_file,"r") as mf:
+                    manifest = json.load(mf)
+                if manifest.get("version") == MANIFEST_VERSION:
+                    self.steps = manifest["steps"]
+            except (ValueError,KeyError):
+                sys.stderr.write("Ignoring unreadable checkpoint manifest %s\n"%manifest_file)
+
+    #The recorded entry of a step: {"params","tools","inputs","outputs","time"}, files as path -> [size,mtime,sha1]
+    def get(self, step):
+        with self.lock:
+            return self.steps.get(step,None)
+
+    #True if step was recorded with the same params and tools and its inputs and outputs are unchanged
+    def is_complete(self, step, inputs, outputs, params=None, tools=None):
+        entry = self.get(step)
+        if entry is None:
+            return False
+        if entry["params"] != json.loads(json.dumps(params)):
+            sys.stderr.write("%s: parameters changed, rerunning\n"%step)
+            return False
+        for tool in (tools if tools else []):
+            if entry["tools"].get(tool) != get_tool_version(tool):
+                sys.stderr.write("%s: %s version changed, rerunning\n"%(step,tool))
+                return False
+        if sorted(entry["outputs"].keys()) != sorted(outputs) or sorted(entry["inputs"].keys()) != sorted(inputs):
+            return False
+        for f in outputs:
+            if not os.path.exists(f) or not self.is_unchanged(f,entry["outputs"][f]) or not check_output(f):
+                sys.stderr.write("%s: output %s is missing or incomplete, rerunning\n"%(step,f))
+                return False
+        for f in inputs:
+            if not os.path.exists(f) or not self.is_unchanged(f,entry["inputs"][f]):
+                sys.stderr.write("%s: input %s changed, rerunning\n"%(step,f))
+                return False
+        return True
+
+    #Same (size,mtime) as recorded, or same size and contents when only the mtime moved
+    def is_unchanged(self, path, file_entry):
+        size,mtime = get_file_state(path)
+        if [size,mtime] == file_entry[:2]:
+            return True
+        return size == file_entry[0] and file_entry[2] is not None and get_checksum(path) == file_entry[2]
+
+    #Records a finished step and saves the manifest
+    def record(self, step, inputs, outputs, params=None, tools=None, checksums=None):
+        checksums = self.checksums if checksums is None else checksums
+        entry = {"params":params,"tools":{},"inputs":{},"outputs":{},"time":time.time()}
+        for tool in (tools if tools else []):
+            entry["tools"][tool] = get_tool_version(tool)
+        for key,files in [("inputs",inputs),("outputs",outputs)]:
+            for f in files:
+                size,mtime = get_file_state(f)
+                entry[key][f] = [size,mtime,get_checksum(f) if checksums else None]
+        with self.lock:
+            self.steps[step] = json.loads(json.dumps(entry))
+            self.save()
+
+    #Renamed into place, so a job killed while writing it keeps the previous manifest
+    def save(self):
+        tmp_file = "%s.%d.tmp"%(self.manifest_file,os.getpid())
+        with open(tmp_file,"w") as mf:
+            json.dump({"version":MANIFEST_VERSION,"steps":self.steps},mf,indent=1,sort_keys=True)
+        os.rename(tmp_file,self.manifest_file)
@@ -2,9 +2,12 @@
 
 import os,sys,subprocess
 import cuffdiff_to_genematrix 
+import workdir
+import pipeline_trace
+import checkpoint
 
 #TODO: smallRNA estimation in a future release
-def run_cufflinks(genome_list, condition_dict, parameters, output_dir):
+def run_cufflinks(genome_list, condition_dict, parameters, output_dir, job_data=None):
     for genome in genome_list:
         if genome.get("host",False):
             continue
@@ -25,7 +28,7 @@ def run_cufflinks(genome_list, condition_dict, parameters, output_dir):
         for library in condition_dict:
             for r in condition_dict[library]["replicates"]:
                 cur_dir=os.path.dirname(os.path.realpath(r[genome_file]["bam"]))
-                os.chdir(cur_dir)
+                cur_wd=workdir.WorkDir(cur_dir) #cufflinks writes its output to the working directory
                 cur_cmd=list(cmd)
                 r[genome_file]["dir"]=cur_dir
                 bam_file = r[genome_file]["bam"]
@@ -66,11 +69,15 @@ def run_cufflinks(genome_list, condition_dict, parameters, output_dir):
                 
                 cur_cmd += [bam_to_use]
                 cuff_gtf=os.path.join(cur_dir,"transcripts.gtf")
-                if not os.path.exists(cuff_gtf):
+                #the copied bam gets a new name every run, so the step parameters leave it out
+                manifest=checkpoint.get_manifest(genome["output"],job_data)
+                cuff_step=["cufflinks "+cuff_gtf,[bam_file,genome["annotation"],genome["genome"]],[cuff_gtf],checkpoint.get_command_params(cmd),["cufflinks"]]
+                if not manifest.is_complete(*cuff_step):
                     print " ".join(cur_cmd)
 		    try:
                         sys.stderr.write("Invoke cufflinks: %s\n" % (cur_cmd))
-			subprocess.check_call(cur_cmd)
+			cur_wd.check_call(cur_cmd)
+			manifest.record(*cuff_step)
 		    except Exception as e:
 		    	if bam_tmp != None:
 			    sys.stderr.write("remove temp %s in exception handler\n" % (bam_tmp))
@@ -109,9 +116,16 @@ def run_cuffdiff(genome_list, condition_dict, parameters, output_dir, gene_matri
                     manifest.write("\n"+os.path.join(r[genome_file]["dir"],"transcripts.gtf"))
         merge_cmd+=[merge_manifest]
 
-        if not os.path.exists(merge_file):
+        manifest=checkpoint.get_manifest(genome["output"],job_data)
+        merge_inputs=[genome["annotation"]]
+        for library in condition_dict:
+            for r in condition_dict[library]["replicates"]:
+                merge_inputs.append(os.path.join(r[genome_file]["dir"],"transcripts.gtf"))
+        merge_step=["merge "+merge_file,merge_inputs,[merge_file],checkpoint.get_command_params(merge_cmd),[merge_cmd[0]]]
+        if not manifest.is_complete(*merge_step):
             print " ".join(merge_cmd)
-            subprocess.check_call(merge_cmd)
+            pipeline_trace.check_call(merge_cmd)
+            manifest.record(*merge_step)
         else:
             sys.stderr.write(merge_file+" cuffmerge file already exists. skipping\n")
 
@@ -121,7 +135,6 @@ def run_cuffdiff(genome_list, condition_dict, parameters, output_dir, gene_matri
         if thread_count == 0:
             thread_count=2
         diff_cmd=["cuffdiff",merge_file,"-p",str(thread_count),"-b",genome_link,"-L",",".join(condition_dict.keys())]
-        os.chdir(cur_dir)
         cds_tracking=os.path.join(cur_dir,"cds.fpkm_tracking")
         contrasts_file = os.path.join(cur_dir, "contrasts.txt")
         with open(contrasts_file,'w') as contrasts_handle:
@@ -132,34 +145,39 @@ def run_cuffdiff(genome_list, condition_dict, parameters, output_dir, gene_matri
         diff_cmd+=["--contrast-file",contrasts_file,"-o",cur_dir]
 
         #create quant files and add to diff command
+        diff_quant_files=[]
         for library in condition_dict:
             quant_list=[]
             for r in condition_dict[library]["replicates"]:
                 #quant_cmd=["cuffquant",genome["annotation"],r[genome_file]["bam"]]
                 quant_cmd=["cuffquant",merge_file,r[genome_file]["bam"]]
                 cur_dir=r[genome_file]["dir"]#directory for this replicate/genome
-                os.chdir(cur_dir)
                 quant_file=os.path.join(cur_dir,"abundances.cxb")
                 quant_list.append(quant_file)
-                if not os.path.exists(quant_file):
-                    subprocess.check_call(quant_cmd)
+                quant_step=["cuffquant "+quant_file,[merge_file,r[genome_file]["bam"]],[quant_file],quant_cmd,["cuffquant"]]
+                if not manifest.is_complete(*quant_step):
+                    pipeline_trace.check_call(quant_cmd,cwd=cur_dir)
+                    manifest.record(*quant_step)
                 else:
                     print " ".join(quant_cmd)
                     sys.stderr.write(quant_file+" cuffquant file already exists. skipping\n")
             diff_cmd.append(",".join(quant_list))
+            diff_quant_files+=quant_list
 
         cur_dir=genome["output"]
-        os.chdir(cur_dir)
         cds_tracking=os.path.join(cur_dir,"cds.fpkm_tracking")
-        if not os.path.exists(cds_tracking):
+        de_file=os.path.join(cur_dir,"gene_exp.diff")
+        diff_step=["cuffdiff "+cur_dir,[merge_file,genome["genome"],contrasts_file]+diff_quant_files,[cds_tracking,de_file],checkpoint.get_command_params(diff_cmd),["cuffdiff"]]
+        diff_ran=not manifest.is_complete(*diff_step)
+        if diff_ran:
             print " ".join(diff_cmd)
-            subprocess.check_call(diff_cmd)
+            pipeline_trace.check_call(diff_cmd,cwd=cur_dir)
+            manifest.record(*diff_step)
         else:
             sys.stderr.write(cds_tracking+" cuffdiff file already exists. skipping\n")
         #write gene_gmx file now for cuffdiff pipeline
-        de_file=os.path.join(cur_dir,"gene_exp.diff")
         gmx_file=os.path.join(cur_dir,"gene_exp.gmx")
-        if os.path.exists(de_file) and not os.path.exists(gmx_file):
+        if os.path.exists(de_file) and (diff_ran or not os.path.exists(gmx_file)):
             cuffdiff_to_genematrix.main([de_file],gmx_file)
 
 
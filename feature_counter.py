@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+
+import os,sys,subprocess
+import re
+import bisect
+import multiprocessing
+import annotation_index
+import pipeline_trace
+
+#In-process replacement for htseq-count -m intersection-nonempty --nonunique=all -r pos
+#The annotation is parsed once into a step index per feature type and every bam is read once,
+#each read is assigned to all requested feature types in the same pass
+#Output files have the same layout as htseq-count: sorted feature ids followed by the special counters
+#Mates that a shard can't pair (mate on another contig, further than MATE_SEARCH_DISTANCE or missing) are paired
+#across shards once they are all counted, so pairs are counted once like htseq-count does. The only difference left:
+#htseq-count stops with an error when more than --max-reads-in-buffer reads wait for their mates, here there's no limit
+
+SPECIAL_COUNTERS = ["__no_feature","__ambiguous","__too_low_aQual","__not_aligned","__alignment_not_unique"]
+#htseq-count -a default
+MIN_QUAL = 10
+#splits a cigar string into (length,operation) pairs
+CIGAR_RE = re.compile(r"(\d+)([MIDNSHP=X])")
+#second mates starting up to this many bases after their mate are read with it, past the end of the mate's shard window
+MATE_SEARCH_DISTANCE = 10000
+
+#annotation used by the shard worker processes, set before the pool forks so every worker shares the parent's copy
+worker_annotation = None
+#parsed annotations kept for the next replicate: (gff_file,feature_types,id_attr,stranded) -> annotation
+annotation_memo = {}
+
+#Returns the value of attribute key from a gff3 (key=value) or gtf (key "value") attribute column
+def get_attribute(attr_str, key):
+    for attr in attr_str.split(";"):
+        attr = attr.strip()
+        if attr.startswith(key+"="):
+            return attr[len(key)+1:]
+        if attr.startswith(key+" "):
+            return attr[len(key)+1:].strip().strip("\"")
+    return None
+
+#Builds the step index for a list of (start,end,feature_id) intervals (0-based, half open)
+#Returns (starts,sets): step i covers [starts[i],starts[i+1]) and overlaps the features in sets[i]
+#The last step is always empty. Identical sets are shared to keep host annotations small
+def build_steps(intervals):
+    events = {}
+    for start,end,feature_id in intervals:
+        events.setdefault(start,[]).append((1,feature_id))
+        events.setdefault(end,[]).append((-1,feature_id))
+    active = {}
+    shared_sets = {}
+    starts = []
+    sets = []
+    for pos in sorted(events):
+        for delta,feature_id in events[pos]:
+            active[feature_id] = active.get(feature_id,0)+delta
+            if active[feature_id] == 0:
+                del active[feature_id]
+        fs = frozenset(active)
+        fs = shared_sets.setdefault(fs,fs)
+        if sets and sets[-1] == fs:
+            continue
+        starts.append(pos)
+        sets.append(fs)
+    return starts,sets
+
+#Parses the gff once for every type in feature_types
+#stranded: index features by (chromosome,strand) instead of chromosome, as htseq-count -s yes/reverse does
+#Returns {"types":[...], "ids":{type:sorted feature ids}, "steps":{type:{chromosome key:(starts,sets)}}, "stranded":bool}
+def parse_annotation(gff_file, feature_types, id_attr, stranded):
+    intervals = dict((ftype,{}) for ftype in feature_types)
+    feature_ids = dict((ftype,set()) for ftype in feature_types)
+    missing_id = 0
+    with open(gff_file,"r") as gf:
+        for line in gf:
+            if line.startswith("#"):
+                if line.startswith("##FASTA"):
+                    break
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 9 or fields[2] not in intervals:
+                continue
+            feature_id = get_attribute(fields[8],id_attr)
+            if feature_id is None:
+                missing_id += 1
+                continue
+            key = (fields[0],fields[6]) if stranded else fields[0]
+            intervals[fields[2]].setdefault(key,[]).append((int(fields[3])-1,int(fields[4]),feature_id))
+            feature_ids[fields[2]].add(feature_id)
+    if missing_id > 0:
+        sys.stderr.write("%d features in %s have no %s attribute: skipped\n"%(missing_id,gff_file,id_attr))
+    steps = {}
+    for ftype in feature_types:
+        steps[ftype] = dict((key,build_steps(ivs)) for key,ivs in intervals[ftype].items())
+    ids = dict((ftype,sorted(feature_ids[ftype])) for ftype in feature_types)
+    return {"types":list(feature_types),"ids":ids,"steps":steps,"stranded":stranded}
+
+#Returns the annotation for feature_types, reusing the one from the previous replicate
+#cache_dir: annotation_index cache, types already indexed there are loaded instead of parsed and new ones are stored
+def load_annotation(gff_file, feature_types, id_attr, stranded, cache_dir=None):
+    memo_key = (os.path.realpath(gff_file),tuple(feature_types),id_attr,stranded)
+    if memo_key not in annotation_memo:
+        annotation_memo.clear() #only keep one annotation, host annotations are large
+        annotation_memo[memo_key] = load_cached_annotation(gff_file,feature_types,id_attr,stranded,cache_dir)
+    return annotation_memo[memo_key]
+
+def load_cached_annotation(gff_file, feature_types, id_attr, stranded, cache_dir):
+    if not cache_dir:
+        return parse_annotation(gff_file,feature_types,id_attr,stranded)
+    gff_key = annotation_index.get_gff_key(gff_file)
+    annotation = {"types":list(feature_types),"ids":{},"steps":{},"stranded":stranded}
+    for ftype in feature_types:
+        cached = annotation_index.load_index(cache_dir,gff_key,ftype,id_attr,stranded)
+        if cached is not None:
+            annotation["ids"][ftype],annotation["steps"][ftype] = cached
+    missing = [ftype for ftype in feature_types if ftype not in annotation["steps"]]
+    if len(missing) == 0:
+        sys.stderr.write("Loaded annotation index for %s from %s\n"%(gff_file,cache_dir))
+        return annotation
+    #one pass over the gff for all the types that aren't cached yet
+    parsed = parse_annotation(gff_file,missing,id_attr,stranded)
+    for ftype in missing:
+        annotation["ids"][ftype] = parsed["ids"][ftype]
+        annotation["steps"][ftype] = parsed["steps"][ftype]
+        annotation_index.store_index(cache_dir,gff_key,ftype,id_attr,stranded,parsed["ids"][ftype],parsed["steps"][ftype])
+    return annotation
+
+#Converts a cigar string to (offset,length) alignment blocks relative to the alignment start
+def parse_cigar(cigar):
+    blocks = []
+    offset = 0
+    for size,op in CIGAR_RE.findall(cigar):
+        size = int(size)
+        if op in "M=X":
+            if size > 0:
+                blocks.append((offset,size))
+            offset += size
+        elif op in "DN":
+            offset += size
+    return blocks
+
+def get_nh(fields):
+    for tag in fields[11:]:
+        if tag.startswith("NH:i:"):
+            return int(tag[5:])
+    return 1
+
+#Assigns reads and read pairs to features for every feature type in the annotation
+#Mirrors htseq-count's order of checks: not aligned, alignment not unique (still counted with --nonunique=all), low quality, features
+class FeatureCounter(object):
+    def __init__(self, annotation, strand, min_qual=MIN_QUAL):
+        self.annotation = annotation
+        self.strand = strand
+        self.min_qual = min_qual
+        self.cigar_blocks = {}
+        self.pending_mates = {}
+        self.paired_end = None
+        self.counts = dict((ftype,{}) for ftype in annotation["types"])
+        self.no_feature = dict((ftype,0) for ftype in annotation["types"])
+        self.ambiguous = dict((ftype,0) for ftype in annotation["types"])
+        self.too_low_qual = 0
+        self.not_aligned = 0
+        self.not_unique = 0
+
+    #Adds one sam record, already split on tabs
+    def add(self, fields):
+        flag = int(fields[1])
+        if self.paired_end is None:
+            self.paired_end = bool(flag & 1)
+        if not self.paired_end:
+            self.count_read(fields)
+        elif not flag & 1:
+            self.count_pair(fields,None)
+        else:
+            self.add_mate(fields,flag)
+
+    #Pairs mates the way htseq-count -r pos does: hold a read until the record at its mate position arrives
+    def add_mate(self, fields, flag):
+        which = 1 if flag & 64 else 2
+        mate_chrom = fields[2] if fields[6] == "=" else fields[6]
+        own_key = (fields[0],which,fields[2],fields[3],mate_chrom,fields[7])
+        mate_key = (fields[0],3-which,mate_chrom,fields[7],fields[2],fields[3])
+        mate = self.pending_mates.pop(mate_key,None)
+        if mate is None:
+            self.pending_mates[own_key] = fields
+        elif which == 1:
+            self.count_pair(fields,mate)
+        else:
+            self.count_pair(mate,fields)
+
+    #Counts the reads whose mate never showed up
+    def finish(self):
+        for key in sorted(self.pending_mates):
+            if key[1] == 1:
+                self.count_pair(self.pending_mates[key],None)
+            else:
+                self.count_pair(None,self.pending_mates[key])
+        self.pending_mates = {}
+
+    def get_blocks(self, fields, invert):
+        cigar = fields[5]
+        if cigar not in self.cigar_blocks:
+            self.cigar_blocks[cigar] = parse_cigar(cigar)
+        if self.annotation["stranded"]:
+            reverse = bool(int(fields[1]) & 16) != invert
+            key = (fields[2],"-" if reverse else "+")
+        else:
+            key = fields[2]
+        start = int(fields[3])-1
+        return [(key,start+offset,start+offset+size) for offset,size in self.cigar_blocks[cigar]]
+
+    def count_read(self, fields):
+        if int(fields[1]) & 4:
+            self.not_aligned += 1
+            return
+        if get_nh(fields) > 1:
+            self.not_unique += 1
+        if int(fields[4]) < self.min_qual:
+            self.too_low_qual += 1
+            return
+        self.assign(self.get_blocks(fields,self.strand == "reverse"))
+
+    #read2 is on the opposite strand of the fragment, so its strand is inverted
+    def count_pair(self, read1, read2):
+        blocks = []
+        read1_aligned = read1 is not None and not int(read1[1]) & 4
+        read2_aligned = read2 is not None and not int(read2[1]) & 4
+        if read1_aligned:
+            blocks += self.get_blocks(read1,self.strand == "reverse")
+        if read2_aligned:
+            blocks += self.get_blocks(read2,self.strand != "reverse")
+        elif not read1_aligned:
+            self.not_aligned += 1
+            return
+        if (read1 is not None and get_nh(read1) > 1) or (read2 is not None and get_nh(read2) > 1):
+            self.not_unique += 1
+        if (read1 is not None and int(read1[4]) < self.min_qual) or (read2 is not None and int(read2[4]) < self.min_qual):
+            self.too_low_qual += 1
+            return
+        self.assign(blocks)
+
+    #intersection-nonempty: intersect the non-empty feature sets of every step the blocks touch
+    #--nonunique=all: every feature left in the intersection is counted
+    def assign(self, blocks):
+        for ftype in self.annotation["types"]:
+            type_steps = self.annotation["steps"][ftype]
+            fs = None
+            for key,block_start,block_end in blocks:
+                steps = type_steps.get(key)
+                if steps is None:
+                    continue
+                starts,sets = steps
+                i = max(0,bisect.bisect_right(starts,block_start)-1)
+                while i < len(starts) and starts[i] < block_end:
+                    if sets[i]:
+                        fs = sets[i] if fs is None else fs & sets[i]
+                    i += 1
+            if not fs:
+                self.no_feature[ftype] += 1
+                continue
+            if len(fs) > 1:
+                self.ambiguous[ftype] += 1
+            type_counts = self.counts[ftype]
+            for feature_id in fs:
+                type_counts[feature_id] = type_counts.get(feature_id,0)+1
+
+    #Plain dictionaries so the result can be sent back from a worker process
+    def get_result(self):
+        result = {}
+        for ftype in self.annotation["types"]:
+            specials = [self.no_feature[ftype],self.ambiguous[ftype],self.too_low_qual,self.not_aligned,self.not_unique]
+            result[ftype] = {"counts":self.counts[ftype],"specials":specials}
+        return result
+
+#Sums shard results from FeatureCounter.get_result
+def merge_results(results):
+    merged = {}
+    for result in results:
+        for ftype in result:
+            if ftype not in merged:
+                merged[ftype] = {"counts":{},"specials":[0]*len(SPECIAL_COUNTERS)}
+            merged_counts = merged[ftype]["counts"]
+            for feature_id,count in result[ftype]["counts"].items():
+                merged_counts[feature_id] = merged_counts.get(feature_id,0)+count
+            merged[ftype]["specials"] = [a+b for a,b in zip(merged[ftype]["specials"],result[ftype]["specials"])]
+    return merged
+
+#Yields the sam records of a shard split on tabs
+#regions from quantification.get_bam_regions, None reads the whole bam
+#A read belongs to the window it starts in: reads starting before the window are left to the window before it
+#Second mates starting within MATE_SEARCH_DISTANCE of their mate belong to the mate's window, they are picked up past
+#the window end. The other second mates come in their own window and are paired by count_features
+def read_shard(bam_file, regions):
+    if regions is None:
+        regions = [(None,0,0)]
+    for contig,start,end in regions:
+        view_cmd = ["samtools","view",bam_file]
+        if contig == "*":
+            view_cmd.append("*")
+        elif contig is not None:
+            view_cmd.append("%s:%d-%d"%(contig,start,end+MATE_SEARCH_DISTANCE))
+        view_proc = pipeline_trace.Popen(view_cmd,stdout=subprocess.PIPE,universal_newlines=True)
+        for line in view_proc.stdout:
+            fields = line.rstrip("\n").split("\t")
+            if contig is not None and contig != "*":
+                pos = int(fields[3])
+                mate_pos = int(fields[7])
+                near_mate = int(fields[1]) & 1 and fields[6] in ("=",contig) and 0 < mate_pos <= pos <= mate_pos+MATE_SEARCH_DISTANCE
+                if pos < start:
+                    continue
+                if pos > end and not (near_mate and start <= mate_pos <= end):
+                    continue
+                if near_mate and mate_pos < start:
+                    continue
+            yield fields
+        view_proc.stdout.close()
+        if pipeline_trace.wait(view_proc) != 0:
+            raise subprocess.CalledProcessError(view_proc.returncode," ".join(view_cmd))
+
+#Returns the counts of a shard and the mates it couldn't pair, left for count_features
+def count_shard(bam_file, regions, strand, annotation=None):
+    if annotation is None:
+        annotation = worker_annotation
+    counter = FeatureCounter(annotation,strand)
+    for fields in read_shard(bam_file,regions):
+        counter.add(fields)
+    return counter.get_result(),list(counter.pending_mates.values())
+
+def count_shard_worker(args):
+    return count_shard(*args)
+
+#Counts bam_file against every type in feature_types in one pass
+#shards: list of region lists from quantification.get_bam_regions, counted in parallel worker processes. None counts in this process
+#cache_dir: annotation_index cache directory, None parses the gff without caching
+#Returns {feature_type:{"ids":sorted feature ids,"counts":{feature_id:count},"specials":[...]}}, specials in SPECIAL_COUNTERS order
+def count_features(bam_file, gff_file, feature_types, id_attr, strand, shards=None, cache_dir=None):
+    global worker_annotation
+    annotation = load_annotation(gff_file,feature_types,id_attr,strand != "no",cache_dir)
+    if not shards or len(shards) == 1:
+        results = [count_shard(bam_file,shards[0] if shards else None,strand,annotation)]
+    else:
+        worker_annotation = annotation
+        pool = multiprocessing.Pool(len(shards))
+        try:
+            results = pool.map(count_shard_worker,[(bam_file,shard,strand) for shard in shards])
+        finally:
+            pool.close()
+            pool.join()
+            worker_annotation = None
+    #mates left by their shards are paired with each other, the ones whose mate never showed up count as single reads
+    mate_counter = FeatureCounter(annotation,strand)
+    for result,pending in results:
+        for fields in pending:
+            mate_counter.add(fields)
+    mate_counter.finish()
+    merged = merge_results([result for result,pending in results]+[mate_counter.get_result()])
+    for ftype in feature_types:
+        merged[ftype]["ids"] = annotation["ids"][ftype]
+    return merged
+
+#Writes counts in htseq-count format: every feature id of a type (0 if no reads) then that type's special counters
+#Types are written one after the other, like the appended htseq-count outputs of the host pipeline
+def write_counts(counts_file, result, feature_types):
+    with open(counts_file,"w") as cf:
+        for ftype in feature_types:
+            type_counts = result[ftype]["counts"]
+            cf.write("".join(["%s\t%d\n"%(feature_id,type_counts.get(feature_id,0)) for feature_id in result[ftype]["ids"]]))
+            for name,count in zip(SPECIAL_COUNTERS,result[ftype]["specials"]):
+                cf.write("%s\t%d\n"%(name,count))
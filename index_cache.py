@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import os,sys,subprocess
+import hashlib
+import fcntl
+import shutil
+import pipeline_trace
+
+#Shared cache of bowtie2 indices keyed by the genome fasta contents and the bowtie2 version
+#Layout: <cache_dir>/<key>/genome.*.bt2 with <cache_dir>/<key>.lock and <key>.build.lock files per entry
+#Jobs hold a shared lock on an entry while they build or align against it, evicting an entry needs the exclusive lock
+#Building an entry needs the exclusive build lock
+#Enabled with "index_cache" in job_data or the PROK_TUXEDO_INDEX_CACHE environment variable
+INDEX_NAME = "genome"
+DEFAULT_MAX_CACHE_GB = 50
+
+def get_cache_dir(job_data):
+    return job_data.get("index_cache",os.environ.get("PROK_TUXEDO_INDEX_CACHE",None))
+
+#Returns the first line of bowtie2-build --version, so indices from other bowtie2 versions are never reused
+def get_bowtie2_version():
+    version_cmd = subprocess.Popen(["bowtie2-build","--version"],stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+    version,err = version_cmd.communicate()
+    return version.decode("utf-8").strip().split("\n")[0]
+
+def get_index_key(fasta_file,bowtie2_version):
+    sha = hashlib.sha1()
+    with open(fasta_file,"rb") as ff:
+        for chunk in iter(lambda: ff.read(1<<20),b""):
+            sha.update(chunk)
+    sha.update(b"\0"+bowtie2_version.encode("utf-8"))
+    return sha.hexdigest()
+
+def get_dir_size(path):
+    total = 0
+    for root,dirs,files in os.walk(path):
+        for f in files:
+            total += os.path.getsize(os.path.join(root,f))
+    return total
+
+#Returns (index prefix, lock handle) for fasta_file, building the index on a cache miss
+#The entry stays share-locked until release_index is called so it can't be evicted mid-alignment
+#Without a cache directory the index is built next to the genome link as before and the lock handle is None
+def get_bowtie2_index(fasta_file, job_data, threads, pipeline_log):
+    cache_dir = get_cache_dir(job_data)
+    if not cache_dir:
+        build_bowtie2_index(fasta_file,fasta_file,threads,pipeline_log)
+        return fasta_file,None
+    subprocess.call(["mkdir","-p",cache_dir])
+    key = get_index_key(fasta_file,get_bowtie2_version())
+    entry_dir = os.path.join(cache_dir,key)
+    index_prefix = os.path.join(entry_dir,INDEX_NAME)
+    lock_handle = open(entry_dir+".lock","a")
+    #the entry lock is only ever held shared here: converting an exclusive flock to shared drops it first, and an
+    #evictor could take the entry in between. Building is serialized by the separate build lock instead
+    fcntl.flock(lock_handle,fcntl.LOCK_SH)
+    if os.path.exists(entry_dir):
+        sys.stderr.write("Using cached bowtie2 index %s for %s\n"%(index_prefix,fasta_file))
+    else:
+        #only one job builds, the others wait here and then find the published entry
+        with open(entry_dir+".build.lock","a") as build_lock:
+            fcntl.flock(build_lock,fcntl.LOCK_EX)
+            if not os.path.exists(entry_dir):
+                tmp_dir = os.path.join(cache_dir,".%s.%d.tmp"%(key,os.getpid()))
+                if os.path.exists(tmp_dir):
+                    shutil.rmtree(tmp_dir)
+                os.mkdir(tmp_dir)
+                try:
+                    build_bowtie2_index(fasta_file,os.path.join(tmp_dir,INDEX_NAME),threads,pipeline_log)
+                except:
+                    shutil.rmtree(tmp_dir)
+                    raise
+                #rename is atomic, other jobs never see a partially built index
+                os.rename(tmp_dir,entry_dir)
+            fcntl.flock(build_lock,fcntl.LOCK_UN)
+        evict_indices(cache_dir,key,job_data.get("index_cache_max_gb",DEFAULT_MAX_CACHE_GB))
+    #mtime of the entry is its last use for LRU eviction
+    os.utime(entry_dir,None)
+    return index_prefix,lock_handle
+
+def release_index(lock_handle):
+    if lock_handle:
+        fcntl.flock(lock_handle,fcntl.LOCK_UN)
+        lock_handle.close()
+
+def build_bowtie2_index(fasta_file, index_prefix, threads, pipeline_log):
+    bowtie_build_cmd = ["bowtie2-build","--threads",str(threads),fasta_file,index_prefix]
+    print(" ".join(bowtie_build_cmd))
+    pipeline_log.append(" ".join(bowtie_build_cmd))
+    pipeline_trace.check_call(bowtie_build_cmd)
+
+#Removes least recently used entries until the cache fits in max_gb
+#Entries locked by running jobs (and keep_key, the entry this job uses) are skipped
+def evict_indices(cache_dir, keep_key, max_gb):
+    max_bytes = float(max_gb)*(1<<30)
+    if max_bytes <= 0:
+        return
+    with open(os.path.join(cache_dir,".evict.lock"),"a") as evict_lock:
+        fcntl.flock(evict_lock,fcntl.LOCK_EX)
+        entries = []
+        for key in os.listdir(cache_dir):
+            entry_dir = os.path.join(cache_dir,key)
+            if key.startswith(".") or not os.path.isdir(entry_dir):
+                continue
+            entries.append((os.path.getmtime(entry_dir),key,get_dir_size(entry_dir)))
+        total = sum([e[2] for e in entries])
+        for mtime,key,size in sorted(entries):
+            if total <= max_bytes:
+                break
+            if key == keep_key:
+                continue
+            with open(os.path.join(cache_dir,key+".lock"),"a") as entry_lock:
+                try:
+                    fcntl.flock(entry_lock,fcntl.LOCK_EX|fcntl.LOCK_NB)
+                except IOError:
+                    continue #in use by another job
+                sys.stderr.write("Evicting cached bowtie2 index %s\n"%key)
+                shutil.rmtree(os.path.join(cache_dir,key))
+                total -= size
+        fcntl.flock(evict_lock,fcntl.LOCK_UN)
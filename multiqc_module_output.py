@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 
 import sys,os,subprocess
+import json
 
-#Writes introduction text to introduction.pipeline, which is read in by the module
+#Writes introduction text to <output_dir>/introduction.pipeline, which is read in by the module
 #all variables are assumed to be passed in as strings, so cast to ints when necessary
-def write_introduction_pipeline(recipe,num_samples,num_conditions,num_comparisons):
+def write_introduction_pipeline(output_dir,recipe,num_samples,num_conditions,num_comparisons):
     ###First part of the output section
     output_str = "The " + recipe + " recipe was executed with " + num_samples      
     output_str = output_str + " samples"
@@ -22,5 +23,27 @@ def write_introduction_pipeline(recipe,num_samples,num_conditions,num_comparison
     output_str = output_str + "- Subsystems<br/>"  
     output_str = output_str + "- Differential Gene Expression"  
     ###write to output file
-    with open("introduction.pipeline","w") as o:
+    with open(os.path.join(output_dir,"introduction.pipeline"),"w") as o:
         o.write(output_str)
+
+#Writes <output_dir>/performance.json for the performance module: the commands of genome_id in the pipeline trace
+#(pipeline_trace.jsonl) and the core budget. Each command is given the replicate whose bam or read file it names,
+#sample_files: {replicate id:[file paths]}, commands naming none of them belong to the whole genome (sample null)
+def write_performance_json(output_dir,trace_path,genome_id,sample_files,num_cores):
+    commands = []
+    if trace_path and os.path.exists(trace_path):
+        with open(trace_path,"r") as tf:
+            for line in tf:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.get("genome") != genome_id:
+                    continue
+                record["sample"] = None
+                for sample in sorted(sample_files):
+                    if any(os.path.basename(f) in record["cmd"] for f in sample_files[sample]):
+                        record["sample"] = sample
+                        break
+                commands.append(record)
+    with open(os.path.join(output_dir,"performance.json"),"w") as o:
+        o.write(json.dumps({"genome":genome_id,"num_cores":num_cores,"samples":sorted(sample_files),"commands":commands}))
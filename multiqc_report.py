@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
-import sys,os,subprocess
+import sys,os
+import workdir
 
 SPACE = "    " #multiqc does not like the tab character, using a 4-space macro
 
@@ -14,7 +15,6 @@ def setup_multiqc_configs(genome_list,condition_dict):
     config_dict = setup_shared_config_sections() 
     config_list = []
     for genome in genome_list:
-        os.chdir(genome["output"])
         config_path = os.path.join(genome["output"],os.path.basename(genome["output"])+"_multiqc_config.yaml")
         config_list.append(config_path)
         ###write config file
@@ -55,7 +55,7 @@ def run_multiqc(genome_list,condition_dict):
     remove_data_dir = False
     force_overwrite = True
     for index,genome in enumerate(genome_list):
-        os.chdir(genome["output"])
+        genome_wd = workdir.genome_dir(genome)
         report_name = os.path.basename(genome["output"])+"_report.html"
         multiqc_cmd = ["multiqc","--flat","-o",".","-n",report_name,"-t","simple",".","-c",config_path_list[index]]
         if remove_data_dir:
@@ -65,7 +65,7 @@ def run_multiqc(genome_list,condition_dict):
         if debug_multiqc:
             multiqc_cmd += ["--lint"]
         print(" ".join(multiqc_cmd))
-        subprocess.check_call(multiqc_cmd)
+        genome_wd.check_call(multiqc_cmd)
 
 #returns a dictionary with strings for the sections contained in this function
 def setup_shared_config_sections():
@@ -106,6 +106,7 @@ def setup_shared_config_sections():
                 SPACE+"- differential_expression",
                 SPACE+"- custom_content",
                 SPACE+"- samstat",
+                SPACE+"- performance",
                 SPACE+"- references"
                 ]
     config_dict["module_order"] = module_list
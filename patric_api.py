@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import os,sys,time
+import json
+import hashlib
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import authenticate
+
+#Client for the PATRIC data API queries made by subsystems.py (subsystem, sp_gene, genome_amr)
+#One pooled session per API url is shared by every lookup of the job, requests time out and are retried with backoff,
+#large result sets are fetched page by page, and results can be cached on disk for repeated jobs on the same genome
+#API url: "data_api" in job_data (set from --sstring), PATRIC_DATA_API in the environment, or DEFAULT_API_URL
+#Cache: "api_cache" in job_data or PROK_TUXEDO_API_CACHE, entries expire after "api_cache_ttl_hours"
+DEFAULT_API_URL = "https://patricbrc.org/api/"
+DEFAULT_CACHE_TTL_HOURS = 24*7
+#(connect,read) seconds
+DEFAULT_TIMEOUT = (10,300)
+DEFAULT_RETRIES = 5
+#rows per request when paging through a query
+DEFAULT_PAGE_SIZE = 25000
+#statuses worth retrying, everything else fails right away
+RETRY_STATUSES = [429,500,502,503,504]
+
+#api url -> PatricAPI, so every lookup in the job goes through the same connection pool
+api_clients = {}
+
+def get_api_url(job_data):
+    api_url = job_data.get("data_api",os.environ.get("PATRIC_DATA_API",DEFAULT_API_URL)) if job_data else os.environ.get("PATRIC_DATA_API",DEFAULT_API_URL)
+    if not api_url.endswith("/"):
+        api_url += "/"
+    return api_url
+
+#Returns the shared client for the API url and cache settings in job_data
+def get_client(job_data):
+    job_data = job_data if job_data else {}
+    api_url = get_api_url(job_data)
+    if api_url not in api_clients:
+        cache_dir = job_data.get("api_cache",os.environ.get("PROK_TUXEDO_API_CACHE",None))
+        cache_ttl = float(job_data.get("api_cache_ttl_hours",DEFAULT_CACHE_TTL_HOURS))*3600
+        api_clients[api_url] = PatricAPI(api_url,cache_dir,cache_ttl)
+    return api_clients[api_url]
+
+class PatricAPI(object):
+    def __init__(self, api_url, cache_dir=None, cache_ttl=DEFAULT_CACHE_TTL_HOURS*3600, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, page_size=DEFAULT_PAGE_SIZE):
+        self.api_url = api_url
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self.timeout = timeout
+        self.page_size = page_size
+        self.session = requests.Session()
+        #backoff: 0.5s, 1s, 2s, ... between retries
+        retry = Retry(total=retries,backoff_factor=0.5,status_forcelist=RETRY_STATUSES)
+        adapter = HTTPAdapter(pool_connections=4,pool_maxsize=16,max_retries=retry)
+        self.session.mount("http://",adapter)
+        self.session.mount("https://",adapter)
+        self.session.headers.update({"accept":"application/solr+json"})
+        authenticate.authenticateByEnv(self.session)
+
+    #Sends one GET for <api_url><core>/?<rql> and returns the decoded json
+    #Raises requests.exceptions.RequestException when the request fails after the retries
+    def get_json(self, core, rql):
+        url = self.api_url+core+"/?"+rql
+        print(url)
+        response = self.session.get(url,timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    #Yields every document matching rql from a solr core, page_size rows per request
+    #sort_field gives the pages a stable order
+    def iter_docs(self, core, rql, select_fields=None, sort_field=None):
+        query = rql
+        if select_fields:
+            query += "&select(%s)"%",".join(select_fields)
+        if sort_field:
+            query += "&sort(+%s)"%sort_field
+        start = 0
+        while True:
+            page = self.get_json(core,"%s&limit(%d,%d)&http_accept=application/solr+json"%(query,self.page_size,start))
+            docs = page["response"]["docs"]
+            for doc in docs:
+                yield doc
+            start += len(docs)
+            if len(docs) == 0 or start >= int(page["response"].get("numFound",0)):
+                break
+
+    #Returns the list of documents for a query about genome_id, from the on-disk cache when a fresh entry exists
+    def get_docs(self, core, genome_id, rql, select_fields=None, sort_field=None):
+        cache_file = self.get_cache_file(core,genome_id,rql,select_fields,sort_field)
+        if cache_file and os.path.exists(cache_file) and time.time()-os.path.getmtime(cache_file) < self.cache_ttl:
+            try:
+                with open(cache_file,"r") as cf:
+                    docs = json.load(cf)
+                sys.stderr.write("Using cached %s results for genome_id %s\n"%(core,genome_id))
+                return docs
+            except ValueError:
+                sys.stderr.write("Ignoring unreadable cache entry %s\n"%cache_file)
+        docs = list(self.iter_docs(core,rql,select_fields,sort_field))
+        if cache_file:
+            self.store_cache(cache_file,docs)
+        return docs
+
+    #<cache_dir>/<genome_id>/<core>.<hash of api url and query>.json
+    def get_cache_file(self, core, genome_id, rql, select_fields, sort_field):
+        if not self.cache_dir:
+            return None
+        query_key = json.dumps([self.api_url,core,rql,select_fields,sort_field])
+        query_hash = hashlib.sha1(query_key.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir,genome_id,"%s.%s.json"%(core,query_hash))
+
+    #Written to a temp file and renamed, so concurrent jobs never read a partial entry. Failing to cache isn't an error
+    def store_cache(self, cache_file, docs):
+        tmp_file = "%s.%d.tmp"%(cache_file,os.getpid())
+        try:
+            try:
+                os.makedirs(os.path.dirname(cache_file))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(cache_file)):
+                    raise
+            with open(tmp_file,"w") as cf:
+                json.dump(docs,cf)
+            os.rename(tmp_file,cache_file)
+        except (IOError,OSError) as e:
+            sys.stderr.write("Could not cache API results %s: %s\n"%(cache_file,str(e)))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+import os,sys
+import json
+import threading
+import traceback
+import checkpoint
+import pipeline_trace
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+#Small task graph runner for the pipeline steps in prok_tuxedo.run_pipeline
+#Each Task names the tasks it runs after and can declare the files it reads and writes. Tasks whose dependencies are done
+#run at the same time in threads, at most num_workers at once, and a task whose outputs are up to date is skipped
+#Up to date ("task_skip" in job_data):
+# - mtime: every output exists and none is older than the newest input (default)
+# - checksum: every output exists unchanged and the inputs have the same sha1 as when the task last ran
+# - none: tasks always run
+#Either way the task params (its options) must match the last run. Tasks are recorded in the genome's checkpoint manifest
+#(checkpoint.py) as "task <name>"
+#Tasks that log commands write them to their own list (Runner.log), the lists are added to pipeline_log in task order
+#so the log doesn't depend on which of the tasks running at the same time finishes first
+SKIP_MODES = ["mtime","checksum","none"]
+DEFAULT_SKIP_MODE = "mtime"
+
+#action: called with no arguments to run the task
+#deps: names of tasks that must finish first, they have to be added to the Runner before this one
+#inputs/outputs: called with no arguments, return the lists of files the task reads and writes
+#  They are called when the task is about to run, so they can use paths set by the tasks before it
+#  Tasks without outputs always run: steps that check their own files or only set up state for later tasks
+#params: json value with the task options, a change reruns the task
+#restore: called instead of action when the task is skipped, sets the paths later tasks read
+class Task(object):
+    def __init__(self, name, action, deps=None, inputs=None, outputs=None, params=None, restore=None):
+        self.name = name
+        self.action = action
+        self.deps = deps if deps else []
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params
+        self.restore = restore
+
+    def get_inputs(self):
+        return list(self.inputs()) if self.inputs else []
+
+    def get_outputs(self):
+        return list(self.outputs()) if self.outputs else []
+
+class Runner(object):
+    def __init__(self, num_workers, manifest, skip_mode=DEFAULT_SKIP_MODE, pipeline_log=None):
+        if skip_mode not in SKIP_MODES:
+            raise ValueError("Invalid task_skip %s: %s only"%(skip_mode,", ".join(SKIP_MODES)))
+        self.num_workers = max(1,int(num_workers))
+        self.manifest = manifest
+        self.skip_mode = skip_mode
+        #insertion order, which is also a valid execution order
+        self.tasks = []
+        self.task_dict = {}
+        self.pipeline_log = pipeline_log
+        self.task_logs = {}
+        #tasks whose log is already in pipeline_log
+        self.num_logged = 0
+
+    def add(self, task):
+        if task.name in self.task_dict:
+            raise ValueError("Duplicate task %s"%task.name)
+        for dep in task.deps:
+            if dep not in self.task_dict:
+                raise ValueError("Task %s depends on unknown task %s"%(task.name,dep))
+        self.tasks.append(task)
+        self.task_dict[task.name] = task
+        return task
+
+    #Command log of task name, for the task's action to append to
+    def log(self, name):
+        return self.task_logs.setdefault(name,[])
+
+    #Adds the logs of the finished tasks at the front of the task order to pipeline_log, all of them if finished is None
+    def merge_logs(self, finished=None):
+        while self.num_logged < len(self.tasks):
+            name = self.tasks[self.num_logged].name
+            if finished is not None and name not in finished:
+                break
+            if self.pipeline_log is not None:
+                self.pipeline_log.extend(self.task_logs.get(name,[]))
+            self.num_logged += 1
+
+    #Runs every task, dependencies first. After the first failure no new task starts, the running ones are waited on
+    #and the failure is raised again: exceptions after their traceback is printed, sys.exit codes as SystemExit
+    def run(self):
+        try:
+            self.run_tasks()
+        finally:
+            #a failed run keeps the logs of every task that ran, for Pipeline.txt
+            self.merge_logs()
+
+    def run_tasks(self):
+        done = set()
+        running = {}
+        pending = list(self.tasks)
+        result_queue = queue.Queue()
+        failure = None
+        while pending or running:
+            if failure is None:
+                for task in [t for t in pending if all(d in done for d in t.deps)]:
+                    if len(running) >= self.num_workers:
+                        break
+                    pending.remove(task)
+                    worker = threading.Thread(target=self.run_task,args=(task,result_queue))
+                    worker.daemon = True
+                    worker.start()
+                    running[task.name] = worker
+            if not running:
+                break
+            name,error = result_queue.get()
+            running.pop(name).join()
+            if error is None:
+                done.add(name)
+                self.merge_logs(done)
+            elif failure is None:
+                failure = error
+        if failure is not None:
+            raise failure
+
+    #Thread target: runs or skips one task and queues (name,None) or (name,exception)
+    def run_task(self, task, result_queue):
+        error = None
+        pipeline_trace.set_step(task.name)
+        try:
+            if self.is_up_to_date(task):
+                print("Skipping task %s: outputs are up to date"%task.name)
+                if task.restore:
+                    task.restore()
+            else:
+                print("Running task %s"%task.name)
+                task.action()
+                if task.outputs:
+                    self.record_task(task)
+        except SystemExit as e:
+            error = e
+        except Exception as e:
+            sys.stderr.write("Task %s failed\n"%task.name)
+            traceback.print_exc()
+            error = e
+        sys.stdout.flush()
+        result_queue.put((task.name,error))
+
+    #Prints the tasks in execution order with what run() would do, nothing is run
+    #Tasks without outputs check their own files and are listed as "run". Paths that earlier tasks set aren't known yet,
+    #those tasks are listed as "check (paths not known yet)". Tasks after a task that reruns rerun as well
+    def dry_run(self, out=sys.stdout):
+        will_run = set()
+        for task in self.tasks:
+            rerun_deps = [d for d in task.deps if d in will_run]
+            if task.outputs is None:
+                status = "run"
+            elif rerun_deps:
+                status = "run (after %s)"%",".join(rerun_deps)
+                will_run.add(task.name)
+            else:
+                try:
+                    if self.is_up_to_date(task):
+                        status = "up to date"
+                    else:
+                        status = "run"
+                        will_run.add(task.name)
+                except KeyError:
+                    status = "check (paths not known yet)"
+            deps = ",".join(task.deps) if task.deps else "-"
+            out.write("%s\t%s\tafter: %s\n"%(task.name,status,deps))
+
+    #True if the task declares outputs and they are up to date with its inputs and params
+    def is_up_to_date(self, task):
+        if self.skip_mode == "none" or task.outputs is None:
+            return False
+        outputs = task.get_outputs()
+        inputs = task.get_inputs()
+        if len(outputs) == 0:
+            return False
+        if self.skip_mode == "checksum":
+            return self.manifest.is_complete(self.get_step(task),inputs,outputs,task.params)
+        #mtime: a task recorded with other params reruns, one that was never recorded only needs newer outputs
+        if not all(os.path.exists(f) for f in outputs+inputs) or not all(checkpoint.check_output(f) for f in outputs):
+            return False
+        entry = self.manifest.get(self.get_step(task))
+        if entry is not None and entry["params"] != json.loads(json.dumps(task.params)):
+            return False
+        newest_input = max([os.path.getmtime(f) for f in inputs]) if inputs else 0
+        return newest_input <= min([os.path.getmtime(f) for f in outputs])
+
+    #Manifest step name of a task
+    def get_step(self, task):
+        return "task "+task.name
+
+    #checksums are only computed for the checksum mode
+    def record_task(self, task):
+        self.manifest.record(self.get_step(task),task.get_inputs(),task.get_outputs(),task.params,checksums=self.skip_mode == "checksum")
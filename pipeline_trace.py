@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+import os,sys,time
+import json
+import errno
+import threading
+import subprocess
+
+#Trace of the external commands a job runs, one json object per line in <output_dir>/pipeline_trace.jsonl
+#Each line is appended as soon as the command exits, so a failed job keeps the trace of every command up to the failure:
+# - start: unix time the command started, wall_time: seconds until it exited
+# - user_time/system_time/cpu_time: cpu seconds of the command and the processes it waited on (os.wait4 rusage)
+# - max_rss_kb: peak resident memory of the largest of those processes
+# - read_bytes/write_bytes: block device input/output, reads served from the page cache are not counted
+# - status: exit code, minus the signal number if the command was killed
+# - genome/step: the genome pipeline and task that ran the command (set_genome/set_step)
+#Commands run through the functions below are traced, WorkDir runs its commands through them as well
+TRACE_NAME = "pipeline_trace.jsonl"
+#rusage block counts are 512 byte units
+BLOCK_SIZE = 512
+
+#set by start(), nothing is written before that
+trace_file = None
+#genome of this process: genomes run one after the other or in their own process
+context = {"genome":None}
+#task of the current thread
+thread_state = threading.local()
+
+#Starts the trace of a job in output_dir, the file of an earlier run is appended to
+def start(output_dir):
+    global trace_file
+    trace_file = os.path.join(os.path.abspath(output_dir),TRACE_NAME)
+
+def set_genome(genome):
+    context["genome"] = genome
+
+def set_step(step):
+    thread_state.step = step
+
+def get_step():
+    return getattr(thread_state,"step",None)
+
+#Returns func wrapped to run with the step of the calling thread, for jobs handed to thread pools
+def with_step(func):
+    step = get_step()
+    def run_with_step(*args):
+        set_step(step)
+        return func(*args)
+    return run_with_step
+
+#subprocess.Popen that remembers when the command started, finish it with wait() or communicate() from this module
+def Popen(cmd, **kwargs):
+    proc = subprocess.Popen(cmd,**kwargs)
+    proc.trace_cmd = cmd
+    proc.trace_cwd = kwargs.get("cwd",None)
+    proc.trace_start = time.time()
+    return proc
+
+#Waits for proc with os.wait4 and writes its trace line. Returns the exit code, which is also set as proc.returncode
+#proc.wait() must not be called before, the rusage is only available to the call that reaps the process
+def wait(proc):
+    if proc.returncode is not None:
+        return proc.returncode
+    while True:
+        try:
+            pid,status,rusage = os.wait4(proc.pid,0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    end = time.time()
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    cmd = proc.trace_cmd
+    write_record({
+        "start":round(proc.trace_start,3),
+        "genome":context["genome"],
+        "step":get_step(),
+        "cmd":cmd if isinstance(cmd,str) else " ".join(cmd),
+        "cwd":proc.trace_cwd if proc.trace_cwd else os.getcwd(),
+        "pid":proc.pid,
+        "status":proc.returncode,
+        "wall_time":round(end-proc.trace_start,3),
+        "user_time":round(rusage.ru_utime,3),
+        "system_time":round(rusage.ru_stime,3),
+        "cpu_time":round(rusage.ru_utime+rusage.ru_stime,3),
+        "max_rss_kb":rusage.ru_maxrss,
+        "read_bytes":rusage.ru_inblock*BLOCK_SIZE,
+        "write_bytes":rusage.ru_oublock*BLOCK_SIZE})
+    return proc.returncode
+
+#Popen.communicate for commands with only stdout piped: reads stdout to the end, then waits with wait()
+def communicate(proc):
+    output = proc.stdout.read() if proc.stdout else None
+    if proc.stdout:
+        proc.stdout.close()
+    wait(proc)
+    return output,None
+
+def call(cmd, **kwargs):
+    return wait(Popen(cmd,**kwargs))
+
+def check_call(cmd, **kwargs):
+    status = call(cmd,**kwargs)
+    if status != 0:
+        raise subprocess.CalledProcessError(status,cmd)
+    return 0
+
+#Each line is a single append write, so threads and the processes of parallel genome pipelines can share the file
+#No lock: a process forked while another thread held it (multiprocessing pools) would wait on it forever
+def write_record(record):
+    if trace_file is None:
+        return
+    line = (json.dumps(record,sort_keys=True)+"\n").encode("utf-8")
+    fd = os.open(trace_file,os.O_WRONLY|os.O_APPEND|os.O_CREAT,0o644)
+    try:
+        os.write(fd,line)
+    finally:
+        os.close(fd)
+
+#Totals per genome and step of a trace file, as {(genome,step):{"commands","wall_time","cpu_time","max_rss_kb"}}
+def summarize(trace_path):
+    totals = {}
+    with open(trace_path,"r") as tf:
+        for line in tf:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            key = (record.get("genome"),record.get("step"))
+            if key not in totals:
+                totals[key] = {"commands":0,"wall_time":0.0,"cpu_time":0.0,"max_rss_kb":0}
+            totals[key]["commands"] += 1
+            totals[key]["wall_time"] += record["wall_time"]
+            totals[key]["cpu_time"] += record["cpu_time"]
+            totals[key]["max_rss_kb"] = max(totals[key]["max_rss_kb"],record["max_rss_kb"])
+    return totals
+
+#Prints the per step totals of a trace: pipeline_trace.py <output_dir>/pipeline_trace.jsonl
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.stderr.write("usage: pipeline_trace.py pipeline_trace.jsonl\n")
+        sys.exit(2)
+    totals = summarize(sys.argv[1])
+    print("genome\tstep\tcommands\twall_time\tcpu_time\tmax_rss_kb")
+    for key in sorted(totals,key=lambda k: -totals[k]["wall_time"]):
+        t = totals[key]
+        print("%s\t%s\t%d\t%.1f\t%.1f\t%d"%(key[0],key[1],t["commands"],t["wall_time"],t["cpu_time"],t["max_rss_kb"]))
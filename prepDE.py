@@ -1,5 +1,6 @@
 #!/usr/bin/env python2
-import re, csv, sys, os, glob, warnings, itertools
+import re, csv, sys, os, glob, warnings, itertools, multiprocessing
+from array import array
 from math import ceil
 from optparse import OptionParser
 from operator import itemgetter
@@ -17,6 +18,7 @@ parser.add_option('-p', '--pattern', default=".", help="a regular expression tha
 parser.add_option('-c', '--cluster', action="store_true", help="whether to cluster genes that overlap with different gene IDs, ignoring ones with geneID pattern (see below)")
 parser.add_option('-s', '--string', default="MSTRG", help="if a different prefix is used for geneIDs assigned by StringTie [default: %default]")
 parser.add_option('-k', '--key', default="prepG", help="if clustering, what prefix to use for geneIDs assigned by this script [default: %default]")
+parser.add_option('-P', '--processes', default=1, type='int', help="number of processes parsing sample GTFs at the same time [default: %default]")
 parser.add_option('--legend', default="legend.csv", help="if clustering, where to output the legend file mapping transcripts to assigned geneIDs [default: %default]")
 (opts, args)=parser.parse_args()
 
@@ -29,36 +31,36 @@ if (os.path.isfile(opts.input)):
             if line[0] != '#':
                 lineLst = tuple(line.strip().split())
                 if (len(lineLst) != 2):
-                    print "Error: Text file with sample ID and path invalid (%s)" % (line.strip())
+                    print("Error: Text file with sample ID and path invalid (%s)" % (line.strip()))
                     exit(1)
                 if lineLst[0] in samples:
-                    print "Error: Sample ID duplicated (%s)" % (lineLst[0])
+                    print("Error: Sample ID duplicated (%s)" % (lineLst[0]))
                     exit(1)
                 if not os.path.isfile(lineLst[1]):
-                    print "Error: GTF file not found (%s)" % (lineLst[1])
+                    print("Error: GTF file not found (%s)" % (lineLst[1]))
                     exit(1)
                 samples.append(lineLst)
     except IOError:
-        print "Error: List of .gtf files, %s, doesn't exist" % (opts.input)
+        print("Error: List of .gtf files, %s, doesn't exist" % (opts.input))
         exit(1)
 else:
     # gtfList = False
     ## Check that opts.input directory exists
     if not os.path.isdir(opts.input):
       parser.print_help()
-      print " "
-      print "Error: sub-directory '%s' not found!" % (opts.input)
+      print(" ")
+      print("Error: sub-directory '%s' not found!" % (opts.input))
       sys.exit(1)
 
     #####
     ## Collect all samples file paths and if empty print help message and quit
     #####
-    samples = [(i,glob.iglob(os.path.join(opts.input,i,"*.gtf")).next()) for i in next(os.walk(opts.input))[1] if re.search(opts.pattern,i)]
+    samples = [(i,next(glob.iglob(os.path.join(opts.input,i,"*.gtf")))) for i in next(os.walk(opts.input))[1] if re.search(opts.pattern,i)]
 
 if len(samples) == 0:
   parser.print_help()
-  print " "
-  print "Error: no GTF files found under ./%s !" % (opts.input)
+  print(" ")
+  print("Error: no GTF files found under ./%s !" % (opts.input))
   sys.exit(1)
 
 RE_GENE_ID=re.compile('gene_id "([^"]+)"')
@@ -94,92 +96,124 @@ def getCov(s):
     return v
   return 0.0
 
-def is_overlap(x,y): #NEEDS TO BE INTS!
-  return x[0]<=y[1] and y[0]<=x[1]
-
-
-def t_overlap(t1, t2): #from badGenes: chromosome, strand, cluster, start, end, (e1start, e1end)...
-    if t1[0] != t2[0] or t1[1] != t2[1] or t1[5]<t2[4]: return False
-    for i in range(6, len(t1)):
-        for j in range(6, len(t2)):
-            if is_overlap(t1[i], t2[j]): return True
-    return False
+#####
+## Groups the transcripts in badGenes into clusters of transcripts with overlapping exons
+## (transitively, on the same chromosome and strand) and returns the clusters with more than one transcript
+## Sort-and-sweep: exons of a chromosome/strand are sorted by start and merged into runs of overlapping exons,
+## every transcript with an exon in the same run ends up in the same cluster (union-find)
+#####
+def cluster_transcripts(badGenes): #from badGenes: chromosome, strand, cluster, start, end, (e1start, e1end)...
+    parent=list(range(len(badGenes)))
+    def find(x):
+        root=x
+        while parent[root]!=root:
+            root=parent[root]
+        while parent[x]!=root:
+            parent[x], x = root, parent[x]
+        return root
+    exons={} #key=(chromosome, strand), value=[(start, end, transcript)...]
+    for n, t in enumerate(badGenes):
+        for e in t[6:]:
+            exons.setdefault((t[0], t[1]), []).append((e[0], e[1], n))
+    for key in exons:
+        run_end=None
+        run_root=None
+        for start, end, n in sorted(exons[key]):
+            if run_end is not None and start<=run_end: #closed intervals, touching exons overlap
+                a, b = find(run_root), find(n)
+                if a!=b:
+                    parent[b]=a
+                run_end=max(run_end, end)
+            else:
+                run_end=end
+                run_root=n
+    members={}
+    for n in range(len(badGenes)):
+        members.setdefault(find(n), []).append(badGenes[n][2])
+    return [c for c in members.values() if len(c)>1]
 
 ## Average Readlength
 read_len=opts.length
 
-## Variables/Matrices to store t/g_counts
-t_count_matrix, g_count_matrix=[],[]
-
 ##Get ready for clustering, stuff is once for all samples##
 geneIDs={} #key=transcript, value=cluster/gene_id
 
-
-## For each of the sorted sample paths
-for s in samples:
-    badGenes=[] #list of bad genes (just ones that aren't MSTRG)
-    try:
-        ## opts.input = parent directory of sample subdirectories
-        ## s = sample currently iterating through
-        ## os.path.join(opts.input,s,"*.gtf") path to current sample's GTF
-        ## split = list of lists: [[chromosome, ...],...]
-
-        #with open(glob.iglob(os.path.join(opts.input,s,"*.gtf")).next()) as f:
-        #    split=[l.split('\t') for l in f.readlines()]
-#        if not gtfList:
-#            f = open(glob.iglob(os.path.join(opts.input,s[1],"*.gtf")).next())
-#        else:
-#            f = open(s[1])
-        with open(s[1]) as f:
-            split=[l.split('\t') for l in f.readlines()]
-
-        ## i = numLine; v = corresponding i-th GTF row
-        for i,v in enumerate(split):
-            if is_transcript(v):
-                t_id=RE_TRANSCRIPT_ID.search(v[len(v)-1]).group(1)
-                try:
-                  g_id=getGeneID(v[len(v)-1], v[0], t_id)
-                except:
-                  print "Problem at line:\n:%s\n" % (v)
-                  print "i='%s', len(v)=%s" % (i, len(v));
-                  sys.exit(1)
-                geneIDs.setdefault(t_id, g_id)
-                if not RE_STRING.match(g_id):
-                    badGenes.append([v[0],v[6], t_id, g_id, min(int(v[3]),int(v[4])), max(int(v[3]),int(v[4]))]) #chromosome, strand, cluster/transcript id, start, end
-                    j=i+1
-                    while j<len(split) and split[j][2]=="exon":
-                        badGenes[len(badGenes)-1].append((min(int(split[j][3]), int(split[j][4])), max(int(split[j][3]), int(split[j][4]))))
-                        j+=1
-
-    except StopIteration:
-        warnings.warn("Didn't get a GTF in that directory. Looking in another...")
-
-    else: #we found the "bad" genes!
-        break
+#####
+## Parses one sample's GTF in a single pass, line by line
+## Returns (sample ID, [(transcript_id, gene_id, count)...] in file order, badGenes)
+## badGenes (transcripts whose gene isn't a StringTie geneID, with their exons) is only collected
+## for the first sample, it is what --cluster works on
+#####
+def parse_gtf(job):
+  sample_id, gtf_file, collect_bad = job
+  transcripts=[]
+  badGenes=[] #chromosome, strand, cluster/transcript id, gene id, start, end, (e1start, e1end)...
+  t_id=None
+  bad=None
+  with open(gtf_file) as f:
+    for l in f:
+      if l.startswith("#"):
+        continue
+      v=l.split('\t')
+      if v[2]=="transcript":
+        if t_id is not None:
+          transcripts.append((t_id, g_id, int(ceil(coverage*transcript_len/read_len))))
+        t_id=RE_TRANSCRIPT_ID.search(v[len(v)-1]).group(1)
+        g_id=getGeneID(v[len(v)-1], v[0], t_id)
+        coverage=getCov(v[len(v)-1])
+        transcript_len=0
+        bad=None
+        if collect_bad and not RE_STRING.match(g_id):
+          bad=[v[0], v[6], t_id, g_id, min(int(v[3]),int(v[4])), max(int(v[3]),int(v[4]))]
+          badGenes.append(bad)
+      elif v[2]=="exon":
+        transcript_len+=int(v[4])-int(v[3])+1 #because end coordinates are inclusive in GTF
+        if bad is not None:
+          bad.append((min(int(v[3]), int(v[4])), max(int(v[3]), int(v[4]))))
+      else:
+        bad=None #exons of a bad gene are the ones right after its transcript line
+  if t_id is not None:
+    transcripts.append((t_id, g_id, int(ceil(coverage*transcript_len/read_len))))
+  return sample_id, transcripts, badGenes
+
+## Per-transcript counts, one array slot per sample. -1 marks a sample that doesn't have the transcript:
+## the first line for a transcript in a sample wins, missing ones are written as 0
+t_index={} #key=transcript, value=row in t_ids/t_counts
+t_ids=[] #transcripts in the order they are first seen
+t_counts=[]
+badGenes=[]
+
+jobs=[(s[0], s[1], q==0) for q, s in enumerate(samples)]
+if opts.processes>1 and len(samples)>1:
+  pool=multiprocessing.Pool(min(opts.processes, len(samples)))
+  parsed=pool.imap(parse_gtf, jobs) #in sample order, while the next samples are parsed
+else:
+  pool=None
+  parsed=itertools.imap(parse_gtf, jobs) if hasattr(itertools, "imap") else map(parse_gtf, jobs)
+
+for q, (sample_id, transcripts, sample_bad) in enumerate(parsed):
+  print("%d %s" % (q, sample_id))
+  if q==0:
+    badGenes=sample_bad
+  for t_id, g_id, count in transcripts:
+    geneIDs.setdefault(t_id, g_id)
+    row=t_index.get(t_id)
+    if row is None:
+      row=t_index[t_id]=len(t_ids)
+      t_ids.append(t_id)
+      t_counts.append(array('l', [-1])*len(samples))
+    if t_counts[row][q]<0:
+      t_counts[row][q]=count
+
+if pool is not None:
+  pool.close()
+  pool.join()
 
 ##THE CLUSTERING BEGINS!##
 if opts.cluster and len(badGenes)>0:
-    clusters=[] #lists of lists (could be sets) or something of transcripts
-    badGenes.sort(key=itemgetter(3)) #sort by start coord...?
-    i=0
-    while i<len(badGenes): #rather un-pythonic
-        temp_cluster=[badGenes[i]]
-
-        k=0
-        while k<len(temp_cluster):
-            j=i+1
-            while j<len(badGenes):
-                if t_overlap(temp_cluster[k], badGenes[j]):
-                    temp_cluster.append(badGenes[j])
-                    del badGenes[j]
-                else:
-                    j+=1
-            k+=1
-        if len(temp_cluster)>1:
-            clusters.append([t[2] for t in temp_cluster])
-        i+=1
+    clusters=cluster_transcripts(badGenes)
 
-    print len(clusters)
+    print(len(clusters))
 
     for c in clusters:
         c.sort()
@@ -197,78 +231,30 @@ if opts.cluster and len(badGenes)>0:
         my_writer=csv.writer(l_file)
         my_writer.writerows(legend)
 
-geneDict={} #key=gene/cluster, value=dictionary with key=sample, value=summed counts
-t_dict={}
-for q, s in enumerate(samples):
-    print q, s[0]
-
-    try:
-        #with open(glob.iglob(os.path.join(opts.input,s,"*.gtf")).next()) as f: #grabs first .gtf file it finds inside the sample subdirectory
-#        if not gtfList:
-#            f = open(glob.iglob(os.path.join(opts.input,s[1],"*.gtf")).next())
-#        else:
-        f = open(s[1])
-        
-            # s = s.split('/')[len(s.split('/')) - 1].split('.gtf')[0].split('_')[0]
-            # s = sample_IDs[q]
-
-##        split=[t[:len(t)-1]+t[len(t)-1].split(";") for t in split]
-##        split=[t[:len(t)-1] for t in split] #eliminate '\n' at end
-##        split=[[e.lstrip() for e in t] for t in split]
-        #should consider making stuff into dictionaries, maybe each split line
-
-##            transcriptList=[]
-        transcript_len=0
-        for l in f:
-            if l.startswith("#"):
-                continue
-            v=l.split('\t')
-            if v[2]=="transcript":
-                if transcript_len>0:
-##                        transcriptList.append((g_id, t_id, int(ceil(coverage*transcript_len/read_len))))
-                    t_dict.setdefault(t_id, {})
-                    t_dict[t_id].setdefault(s[0], int(ceil(coverage*transcript_len/read_len)))
-                t_id=RE_TRANSCRIPT_ID.search(v[len(v)-1]).group(1)
-                #g_id=RE_GENE_ID.search(v[len(v)-1]).group(1)
-                g_id=getGeneID(v[len(v)-1], v[0], t_id)
-                #coverage=float(RE_COVERAGE.search(v[len(v)-1]).group(1))
-                coverage=getCov(v[len(v)-1])
-                transcript_len=0
-            if v[2]=="exon":
-                transcript_len+=int(v[4])-int(v[3])+1 #because end coordinates are inclusive in GTF
-
-##            transcriptList.append((g_id, t_id, int(ceil(coverage*transcript_len/read_len))))
-        t_dict.setdefault(t_id, {})
-        t_dict[t_id].setdefault(s[0], int(ceil(coverage*transcript_len/read_len)))
-
-    except StopIteration:
-#        if not gtfList:
-#            warnings.warn("No GTF file found in " + os.path.join(opts.input,s[1]))
-#        else:
-        warnings.warn("No GTF file found in " + s[1])
-
-
-##        transcriptList.sort(key=lambda bla: bla[1]) #gene_id
-
-    for i,v in t_dict.iteritems():
-##        print i,v
-        geneDict.setdefault(geneIDs[i],{}) #gene_id
-        geneDict[geneIDs[i]].setdefault(s[0],0)
-        geneDict[geneIDs[i]][s[0]]+=v[s[0]]
-
+## Gene counts are summed once, after clustering has settled the geneIDs
+g_index={} #key=gene/cluster, value=row in g_ids/g_counts
+g_ids=[]
+g_counts=[]
+for t_id, counts in zip(t_ids, t_counts):
+  g_id=geneIDs[t_id]
+  row=g_index.get(g_id)
+  if row is None:
+    row=g_index[g_id]=len(g_ids)
+    g_ids.append(g_id)
+    g_counts.append(array('l', [0])*len(samples))
+  gene_counts=g_counts[row]
+  for q, c in enumerate(counts):
+    if c>0:
+      gene_counts[q]+=c
 
 with open(opts.t, 'w') as csvfile:
-    my_writer = csv.DictWriter(csvfile, fieldnames = ["transcript_id"] + [x for x,y in samples])
-    my_writer.writerow(dict((fn,fn) for fn in my_writer.fieldnames))
-    for i in t_dict:
-        t_dict[i]["transcript_id"] = i
-        my_writer.writerow(t_dict[i])
+    my_writer = csv.writer(csvfile)
+    my_writer.writerow(["transcript_id"] + [x for x,y in samples])
+    for t_id, counts in zip(t_ids, t_counts):
+        my_writer.writerow([t_id] + [max(c, 0) for c in counts])
 
 with open(opts.g, 'w') as csvfile:
-    my_writer = csv.DictWriter(csvfile, fieldnames = ["gene_id"] + [x for x,y in samples])
-##    my_writer.writerow([""]+samples)
-##    my_writer.writerows(geneDict)
-    my_writer.writerow(dict((fn,fn) for fn in my_writer.fieldnames))
-    for i in geneDict:
-        geneDict[i]["gene_id"] = i #add gene_id to row
-        my_writer.writerow(geneDict[i])
+    my_writer = csv.writer(csvfile)
+    my_writer.writerow(["gene_id"] + [x for x,y in samples])
+    for g_id, counts in zip(g_ids, g_counts):
+        my_writer.writerow([g_id] + list(counts))
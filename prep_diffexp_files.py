@@ -1,79 +1,104 @@
 #!/usr/bin/env python
 
-import os,sys,subprocess
+import os
+import scheduler
+import workdir
+import checkpoint
+import numpy
+
+#htseq-count special counters at the end of each counts file, left out of the matrices
+OMIT_LIST = ["__no_feature","__ambiguous","__too_low_aQual","__not_aligned","__alignment_not_unique"]
+#rows per write() call when writing a matrix
+WRITE_CHUNK_ROWS = 10000
+
+#Reads one htseq-format counts file, skipping the special counters
+#Returns (features,counts) in file order. A feature listed twice keeps its last count
+def read_counts_file(counts_file):
+    counts_dict = {}
+    features = []
+    with open(counts_file,"r") as cf:
+        for line in cf:
+            feature,count = line.strip().split("\t")
+            if feature not in OMIT_LIST:
+                if feature not in counts_dict:
+                    features.append(feature)
+                counts_dict[feature] = int(count)
+    return features,[counts_dict[f] for f in features]
+
+#Builds the feature x replicate count matrix for a list of counts files (one per replicate, in column order)
+#The files are read in parallel, rows are the sorted union of their features, missing features are 0
+#Returns (features,counts) with counts a numpy int64 array of shape (features,replicates)
+def build_counts_matrix(counts_files,job_data):
+    num_workers = min(len(counts_files),scheduler.get_core_budget(job_data))
+    file_counts = scheduler.run_parallel(read_counts_file,[(cf,) for cf in counts_files],num_workers)
+    feature_set = set()
+    for features,counts in file_counts:
+        feature_set.update(features)
+    features = sorted(feature_set)
+    feature_index = dict((f,i) for i,f in enumerate(features))
+    matrix = numpy.zeros((len(features),len(counts_files)),dtype=numpy.int64)
+    for col,(file_features,counts) in enumerate(file_counts):
+        rows = numpy.array([feature_index[f] for f in file_features],dtype=numpy.int64)
+        matrix[rows,col] = numpy.array(counts,dtype=numpy.int64)
+    return features,matrix
+
+#Writes the tab delimited matrix read by run_deseq2.R and the R plotting scripts, plus <matrix_file>.npz
+#with the same data (arrays "counts", "features", "samples") for steps that don't want to re-parse the text
+def write_counts_matrix(matrix_file,features,replicate_list,matrix):
+    delim = "\t"
+    with open(matrix_file,"w") as mf:
+        mf.write(delim.join(["Feature"]+replicate_list)+"\n")
+        for chunk_start in range(0,len(features),WRITE_CHUNK_ROWS):
+            rows = matrix[chunk_start:chunk_start+WRITE_CHUNK_ROWS].tolist()
+            lines = [delim.join([feature]+[str(c) for c in row]) for feature,row in zip(features[chunk_start:chunk_start+WRITE_CHUNK_ROWS],rows)]
+            mf.write("\n".join(lines)+"\n")
+    with open(matrix_file+".npz","wb") as npz:
+        numpy.savez(npz,counts=matrix,features=numpy.array(features),samples=numpy.array(replicate_list))
+    return matrix_file+".npz"
+
+#Loads a matrix written by write_counts_matrix from its .npz sidecar
+#Returns (features,replicate ids,counts array)
+def load_counts_matrix(npz_file):
+    with numpy.load(npz_file) as data:
+        return data["features"].tolist(),data["samples"].tolist(),data["counts"]
+
+#Paths of the counts matrices create_counts_table(_host) writes for a genome: <genome_dir>/<genome_id>.<feature_count>.gene_counts
+#and for Host also .transcript_counts, each with its .npz sidecar. Returned as the genome keys they are stored under
+def get_counts_matrix_paths(genome,job_data,host):
+    genome_dir = genome["output"]
+    matrix_prefix = os.path.join(genome_dir,os.path.basename(genome_dir)+"."+job_data.get("feature_count","htseq"))
+    paths = {"gene_matrix":matrix_prefix+".gene_counts","gene_matrix_npz":matrix_prefix+".gene_counts.npz"}
+    if host:
+        paths["transcript_matrix"] = matrix_prefix+".transcript_counts"
+        paths["transcript_matrix_npz"] = matrix_prefix+".transcript_counts.npz"
+    return paths
+
+#Counts files of every replicate that go into a genome's matrices
+def get_counts_files(genome,condition_dict,host):
+    counts_keys = ["gene_counts","transcript_counts"] if host else ["counts"]
+    counts_files = []
+    for condition in condition_dict:
+        for replicate in condition_dict[condition]["replicates"]:
+            counts_files += [replicate[genome["genome"]][key] for key in counts_keys]
+    return counts_files
 
 def create_counts_table_host(genome_list,condition_dict,job_data):
-    #Remove the last 5 lines from htseq-count output
-    omit_list = ["__no_feature","__ambiguous","__too_low_aQual","__not_aligned","__alignment_not_unique"]
     for genome in genome_list:
-        genome_file = genome["genome"]
-        genome_annotation = genome["annotation"]
-        genome_dir = genome["output"]
-        feature_count = job_data.get("feature_count","htseq")
-        #change to genome directory
-        os.chdir(genome_dir)
-        gene_set = set()
-        transcript_set = set()
+        genome.update(get_counts_matrix_paths(genome,job_data,True))
         replicate_list = []
-        gc_dict = {}
-        tc_dict = {}
+        gc_files = []
+        tc_files = []
         for condition in condition_dict:
             for replicate in condition_dict[condition]["replicates"]:
                 gc_file = replicate[genome["genome"]]["gene_counts"]
-                tc_file = replicate[genome["genome"]]["transcript_counts"]
-                replicate_id = os.path.basename(gc_file).replace(".gene.counts","")
-                replicate_list.append(replicate_id)
-                gc_dict[replicate_id] = {}
-                tc_dict[replicate_id] = {}
-                with open(gc_file,"r") as gf:
-                    for line in gf:
-                        feature,count = line.strip().split("\t")
-                        if feature not in omit_list:
-                            gene_set.add(feature)
-                            gc_dict[replicate_id][feature] = count
-                with open(tc_file,"r") as tf:
-                    for line in tf:
-                        feature,count = line.strip().split("\t")
-                        if feature not in omit_list:
-                            transcript_set.add(feature)
-                            tc_dict[replicate_id][feature] = count
+                replicate_list.append(os.path.basename(gc_file).replace(".gene.counts",""))
+                gc_files.append(gc_file)
+                tc_files.append(replicate[genome["genome"]]["transcript_counts"])
         #output counts table
-        genome_id = os.path.basename(genome_dir)
-        #Delimeter: , (csv files)
-        delim = "\t"
-        gene_counts_mtx = genome_id+"."+feature_count+".gene_counts"
-        transcript_counts_mtx = genome_id+"."+feature_count+".transcript_counts"
-        with open(gene_counts_mtx,"w") as gcm:
-            #write headers
-            gcm.write("Feature")
-            for replicate_id in replicate_list:
-                gcm.write("%s%s"%(delim,replicate_id))
-            gcm.write("\n")
-            #write gene info 
-            for gene in gene_set:
-                gcm.write(gene)
-                for replicate_id in replicate_list:
-                    if gene in gc_dict[replicate_id]:
-                        gcm.write("%s%s"%(delim,gc_dict[replicate_id][gene]))
-                    else:
-                        gcm.write("%s0"%delim)
-                gcm.write("\n")
-        genome["gene_matrix"] = os.path.join(genome["output"],gene_counts_mtx)
-        with open(transcript_counts_mtx,"w") as tcm:
-            #write headers
-            tcm.write("Feature")
-            for replicate_id in replicate_list:
-                tcm.write("%s%s"%(delim,replicate_id))
-            tcm.write("\n")
-            for transcript in transcript_set:
-                tcm.write(transcript)
-                for replicate_id in replicate_list:
-                    if transcript in tc_dict[replicate_id]:
-                        tcm.write("%s%s"%(delim,tc_dict[replicate_id][transcript]))
-                    else:
-                        tcm.write("%s0"%delim)
-                tcm.write("\n")
-        genome["transcript_matrix"] = os.path.join(genome["output"],transcript_counts_mtx)
+        genes,gene_matrix = build_counts_matrix(gc_files,job_data)
+        write_counts_matrix(genome["gene_matrix"],genes,replicate_list,gene_matrix)
+        transcripts,transcript_matrix = build_counts_matrix(tc_files,job_data)
+        write_counts_matrix(genome["transcript_matrix"],transcripts,replicate_list,transcript_matrix)
 
 #Merges the counts file generated for each replicate from htseq-count for each genome. Outputs file to genome directory
 #Names file according to genome identifier
@@ -81,54 +106,18 @@ def create_counts_table_host(genome_list,condition_dict,job_data):
 # - genome: The current genome dictionary object from genome_list
 # - condition_dict: complete condition dictionary object
 def create_counts_table(genome_list,condition_dict,job_data):
-    #Remove the last 5 lines from htseq-count output
-    omit_list = ["__no_feature","__ambiguous","__too_low_aQual","__not_aligned","__alignment_not_unique"]
     for genome in genome_list:
-        genome_file = genome["genome"]
-        genome_annotation = genome["annotation"]
-        genome_dir = genome["output"]
-        feature_count = job_data.get("feature_count","htseq")
-        #change to genome directory
-        #change to genome directory
-        os.chdir(genome_dir)
-        feature_set = set()
+        genome.update(get_counts_matrix_paths(genome,job_data,False))
         replicate_list = []
-        counts_dict = {}
-        #load counts file information into memory
+        counts_files = []
         for condition in condition_dict: 
             for replicate in condition_dict[condition]["replicates"]:
                 counts_file = replicate[genome["genome"]]["counts"]
-                replicate_id = os.path.basename(counts_file).replace(".counts","")
-                replicate_list.append(replicate_id)
-                counts_dict[replicate_id] = {}
-                with open(counts_file,"r") as cf:
-                    for line in cf:
-                        feature,count = line.strip().split("\t")
-                        #skip the last five lines in counts file
-                        if feature not in omit_list:
-                            feature_set.add(feature)
-                            counts_dict[replicate_id][feature] = count
+                replicate_list.append(os.path.basename(counts_file).replace(".counts",""))
+                counts_files.append(counts_file)
         #output counts table
-        genome_id = os.path.basename(genome_dir)
-        #Delimeter: , (csv files)
-        delim = "\t"
-        genome_counts_mtx = genome_id+"."+feature_count+".gene_counts"
-        with open(genome_counts_mtx,"w") as gcm:
-            #write headers
-            gcm.write("Feature")
-            for replicate_id in replicate_list:
-                gcm.write("%s%s"%(delim,replicate_id))
-            gcm.write("\n")
-            #write feature info 
-            for feature in feature_set:
-                gcm.write(feature)
-                for replicate_id in replicate_list:
-                    if feature in counts_dict[replicate_id]:
-                        gcm.write("%s%s"%(delim,counts_dict[replicate_id][feature]))
-                    else:
-                        gcm.write("%s0"%delim)
-                gcm.write("\n")
-        genome["gene_matrix"] = os.path.join(genome["output"],genome_counts_mtx)
+        features,matrix = build_counts_matrix(counts_files,job_data)
+        write_counts_matrix(genome["gene_matrix"],features,replicate_list,matrix)
 
 #Put a metadata file in each genome directory
 #Subsetting the data on current conditions can be done in R
@@ -146,11 +135,22 @@ def create_metadata_file(genome_list,condition_dict,output_dir):
     #Print file to top level output directory, only 1 metadat file is needed
     #Get the top level output directory
     metadata_file = os.path.join(output_dir,"Metadata.txt")
-    with open(metadata_file,"w") as mf:
-        mf.write("Sample\tCondition\n")
-        for condition in info_dict:
-            for replicate in info_dict[condition]:
-                mf.write("%s\t%s\n"%(replicate,condition))
+    metadata_lines = ["Sample\tCondition\n"]
+    for condition in info_dict:
+        for replicate in info_dict[condition]:
+            metadata_lines.append("%s\t%s\n"%(replicate,condition))
+    #an unchanged file is left alone, so the steps reading it aren't rerun because of its mtime
+    if os.path.exists(metadata_file):
+        with open(metadata_file,"r") as mf:
+            rewrite = mf.read() != "".join(metadata_lines)
+    else:
+        rewrite = True
+    if rewrite:
+        #genome pipelines running in parallel all write this file, rename it into place so none of them reads a partial file
+        tmp_metadata_file = "%s.%d.tmp"%(metadata_file,os.getpid())
+        with open(tmp_metadata_file,"w") as mf:
+            mf.write("".join(metadata_lines))
+        os.rename(tmp_metadata_file,metadata_file)
     #Add metadata file to each genome in genome_list
     for genome in genome_list:
         genome["deseq_metadata"] = metadata_file
@@ -162,8 +162,6 @@ def write_gtf_list(genome_list,condition_dict):
         genome_file = genome["genome"]
         genome_annotation = genome["annotation"]
         genome_dir = genome["output"]
-        #change to genome directory
-        os.chdir(genome_dir)
         rep_gtf_list = []
         for condition in condition_dict:
             for replicate in condition_dict[condition]["replicates"]:
@@ -183,24 +181,34 @@ def write_gtf_list(genome_list,condition_dict):
         genome["prepDE_input"] = gtf_path_filename
 
 #Calls the prepDE.py script that transforms stringtie output into a format usable by DESeq2
-def prep_stringtie_diffexp(genome_list,condition_dict,host_bool,pipeline_log):
+#prepDE.py parses one sample GTF per process, up to the core budget
+def prep_stringtie_diffexp(genome_list,condition_dict,host_bool,pipeline_log,job_data=None):
+    num_samples = sum([len(condition_dict[condition]["replicates"]) for condition in condition_dict])
+    num_processes = min(num_samples,scheduler.get_core_budget(job_data))
     for genome in genome_list:
         avg_length = str(average_read_length_total(condition_dict,genome))
         genome_file = genome["genome"]
         genome_dir = genome["output"]
         genome_id = os.path.basename(genome_dir)
-        os.chdir(genome_dir)
+        genome_wd = workdir.WorkDir(genome_dir)
         genome_counts_mtx = genome_id+".stringtie.gene_counts" 
         genome["gene_matrix"] = os.path.join(genome["output"],genome_counts_mtx)
-        prep_cmd = ["prepDE.py","-i",genome["prepDE_input"],"-l",avg_length,"-g",genome_counts_mtx]
+        prep_cmd = ["prepDE.py","-i",genome["prepDE_input"],"-l",avg_length,"-g",genome_counts_mtx,"-P",str(max(1,num_processes))]
         if host_bool:
             transcript_counts_mtx = genome_id+".stringtie.transcript_counts"
             genome["transcript_matrix"] = os.path.join(genome["output"],transcript_counts_mtx)
             prep_cmd+=["-t",transcript_counts_mtx]
-        if not os.path.exists(genome_counts_mtx):
+        #the sample gtfs are listed in the prepDE input file, -P only sets the process count
+        with open(genome["prepDE_input"],"r") as gpf:
+            sample_gtfs = [line.rstrip("\n").split("\t")[1] for line in gpf if line.strip()]
+        prep_outputs = [genome["gene_matrix"]]+([genome["transcript_matrix"]] if host_bool else [])
+        prep_step = ["prepDE "+genome["gene_matrix"],[genome["prepDE_input"]]+sample_gtfs,prep_outputs,checkpoint.get_command_params(prep_cmd)]
+        manifest = checkpoint.get_manifest(genome_dir,job_data)
+        if not manifest.is_complete(*prep_step):
             print(" ".join(prep_cmd))
             pipeline_log.append(" ".join(prep_cmd))
-            subprocess.check_call(prep_cmd)
+            genome_wd.check_call(prep_cmd)
+            manifest.record(*prep_step)
 
 def average_read_length_total(condition_dict,genome):
     num_replicates = 0
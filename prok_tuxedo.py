@@ -2,10 +2,16 @@
 
 #import standard libraries
 import os, sys, subprocess, glob, argparse
+import traceback
 import multiprocessing
 import tarfile, json
 import requests,shutil
 import math
+import heapq
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 #import scripts
 import cuffdiff_to_genematrix
@@ -16,6 +22,13 @@ import prep_diffexp_files
 import subsystems
 import multiqc_report
 import multiqc_module_output as mmo
+import qc_stage
+import scheduler
+import patric_api
+import workdir
+import pipeline_dag
+import checkpoint
+import pipeline_trace
 
 #take genome data structure and condition_dict and make directory names. processses condition to ensure no special characters, or whitespace
 def make_directory_names(genome, condition_dict):
@@ -54,7 +67,7 @@ def run_diff_exp_import(genome_list, condition_dict, parameters, output_dir, con
             convert_cmd=[transform_script, "--ufile", params_file, "--sstring", map_args.sstring, "--output_path",experiment_path,"--xfile",gmx_file]
             print " ".join(convert_cmd)
             try:
-               subprocess.check_call(convert_cmd)
+               pipeline_trace.check_call(convert_cmd)
             except(subprocess.CalledProcessError):
                sys.stderr.write("Running differential expression import failed.\n")
                #subprocess.call(["rm","-rf",experiment_path])
@@ -66,7 +79,10 @@ def run_diff_exp_import(genome_list, condition_dict, parameters, output_dir, con
 
 #Gets the lists of contrasts and runs DESeq2
 #Runs DESeq2 once for each genome
+#Contrasts run in parallel R workers: "deseq2": {"workers": N} in job_data, defaults to one per contrast up to the core budget
+#"deseq2": {"global_fit": true} fits one model on all samples and extracts every contrast from it
 def run_deseq2(genome_list,contrasts,job_data,dge_dict):
+    deseq2_options = get_deseq2_options(contrasts,job_data)
     #Get list of contrasts to pass into deseq2 R script
     contrast_cmd = []
     for pair in contrasts:
@@ -75,10 +91,10 @@ def run_deseq2(genome_list,contrasts,job_data,dge_dict):
         contrast_cmd.append(",".join(pair))  
 
     #For each genome, run the deseq2 R script passing in the genome counts matrix, metadata file, and all contrasts
-    #changes directory to the top genome directory for each genome
-    #invoking run_deseq2.R: run_deseq2.R <counts_file.txt> <metadata_file.txt> <output_prefix> <feature_count> <contrast_1> <contrast_2> ... <contrast_n>
+    #runs in the top genome directory for each genome, the R script writes its outputs there
+    #invoking run_deseq2.R: run_deseq2.R [--workers=N] [--global-fit] <counts_file.txt> <metadata_file.txt> <output_prefix> <feature_count> <contrast_1> <contrast_2> ... <contrast_n>
     for genome in genome_list:
-        os.chdir(genome["output"])
+        genome_wd = workdir.genome_dir(genome)
         genome_prefix = os.path.basename(genome["output"])
         diffexp_list = [] #list of files to run differential expression on 
         diffexp_list.append((genome["gene_matrix"],"Genes",job_data.get("feature_count","htseq")))
@@ -97,53 +113,107 @@ def run_deseq2(genome_list,contrasts,job_data,dge_dict):
             continue
         #diffexp_cmd_gene = ["run_deseq2.R",genome["gene_matrix"],metadata_file,genome_prefix+".genes"]+contrast_cmd
         #diffexp_cmd_transcript = ["run_deseq2.R",genome["transcript_matrix"],metadata_file,genome_prefix+".transcripts"]+contrast_cmd
-        genome["diff_exp_contrasts"] = []
         for diffexp_params in diffexp_list:
-            diffexp_cmd = ["run_deseq2.R",diffexp_params[0],metadata_file,diffexp_params[1],diffexp_params[2]]+contrast_cmd
+            diffexp_cmd = ["run_deseq2.R"]+deseq2_options+[diffexp_params[0],metadata_file,diffexp_params[1],diffexp_params[2]]+contrast_cmd
             print("%s\n"%" ".join(diffexp_cmd))
-            subprocess.check_call(diffexp_cmd)
+            genome_wd.check_call(diffexp_cmd)
             #wrap_svg_in_html("Volcano_Plots_mqc.svg")
-            dge_dict["volcano"] = wrap_svg_in_html("Volcano_Plots.svg")
-            for pair in contrasts:
-                pair = [x.replace(",","_") for x in pair]
-                pair = "_vs_".join(pair) 
-                #diffexp_file = genome_prefix + "_" + pair + ".txt"
-                diffexp_output = pair+"."+diffexp_params[2]+"."+diffexp_params[1]+".deseq2"
-                genome["diff_exp_contrasts"].append(os.path.join(genome["output"],diffexp_output))
-            
+            dge_dict["volcano"] = wrap_svg_in_html(genome_wd.path("Volcano_Plots.svg"))
+        genome["diff_exp_contrasts"] = get_deseq2_outputs(genome,contrasts,job_data)
+
+#Options passed to run_deseq2.R before the positional arguments
+def get_deseq2_options(contrasts,job_data):
+    global_fit = job_data.get("deseq2",{}).get("global_fit",False)
+    #the global fit parallelizes DESeq() itself, so it can use the whole budget
+    default_workers = scheduler.get_core_budget(job_data) if global_fit else min(len(contrasts),scheduler.get_core_budget(job_data))
+    deseq2_workers = int(job_data.get("deseq2",{}).get("workers",default_workers))
+    deseq2_options = ["--workers=%d"%max(1,deseq2_workers)]
+    if global_fit:
+        deseq2_options.append("--global-fit")
+    return deseq2_options
+
+#Contrast files run_deseq2.R writes to the genome directory: <condition1>_vs_<condition2>.<feature_count>.<Genes|Transcripts>.deseq2
+def get_deseq2_outputs(genome,contrasts,job_data):
+    feature_count = job_data.get("feature_count","htseq")
+    levels = ["Genes","Transcripts"] if "transcript_matrix" in genome else ["Genes"]
+    diffexp_outputs = []
+    for level in levels:
+        for pair in contrasts:
+            pair = [x.replace(",","_") for x in pair]
+            pair = "_vs_".join(pair) 
+            #diffexp_file = genome_prefix + "_" + pair + ".txt"
+            diffexp_output = pair+"."+feature_count+"."+level+".deseq2"
+            diffexp_outputs.append(os.path.join(genome["output"],diffexp_output))
+    return diffexp_outputs
          
 #Writes the gene_exp.gmx file used in expression_transform.py from DESeq2 output
+#One gene_exp.gmx per genome directory with that genome's contrasts, genomes are written in parallel processes
 def write_gmx_file(genome_list):
-    gene_set = set()
-    gene_count_dict = {}
-    contrast_list = []
-    for genome in genome_list:
-        os.chdir(genome["output"])
-        contrast_file_list = genome["diff_exp_contrasts"]
-        for contrast_file in contrast_file_list:
-            #when creating gene_exp.gmx, ignore transcripts
-            if "Transcript" in contrast_file:
-                continue
-            contrast_name = os.path.basename(contrast_file).replace(".txt","")
-            contrast_list.append(contrast_name)
-            gene_count_dict[contrast_name] = {}
-            with open(contrast_file,"r") as cf:
-                next(cf)
-                for line in cf:
-                    gene,baseMean,log2FC,lfcSE,stat,pvalue,padj = line.strip().split("\t")
-                    gene_set.add(gene.replace("gene-",""))
-                    gene_count_dict[contrast_name][gene] = log2FC
-
-        with open("gene_exp.gmx","w") as o:
-            o.write("Gene_ID\t%s\n"%"\t".join(contrast_list))
-            for gene in gene_set:
-                o.write(gene)
-                for contrast in contrast_list:
-                    if gene in gene_count_dict[contrast]:
-                        o.write("\t%s"%gene_count_dict[contrast][gene])
-                    else:
-                        o.write("\t0")
-                o.write("\n")
+    gmx_args = [(genome["output"],genome["diff_exp_contrasts"]) for genome in genome_list]
+    if len(gmx_args) <= 1:
+        for args in gmx_args:
+            write_genome_gmx(args)
+        return
+    pool = multiprocessing.Pool(len(gmx_args))
+    try:
+        pool.map(write_genome_gmx,gmx_args)
+    finally:
+        pool.close()
+        pool.join()
+
+#Yields (gene,log2FC) from a DESeq2 results file in gene order
+#run_deseq2.R writes the results sorted by gene, a file that isn't sorted is read and sorted in memory instead
+def read_contrast_genes(contrast_file):
+    if not is_sorted_contrast(contrast_file):
+        sys.stderr.write("%s is not sorted by gene, sorting it in memory\n"%contrast_file)
+        with open(contrast_file,"r") as cf:
+            next(cf)
+            for gene_fc in sorted([tuple(line.strip().split("\t")[0:3:2]) for line in cf]):
+                yield gene_fc
+        return
+    with open(contrast_file,"r") as cf:
+        next(cf)
+        for line in cf:
+            gene,baseMean,log2FC = line.strip().split("\t",3)[0:3]
+            yield gene,log2FC
+
+#(gene,contrast index,log2FC) so merged lines from different contrasts sort by gene then contrast
+def tag_contrast_genes(contrast_file,contrast_index):
+    for gene,log2FC in read_contrast_genes(contrast_file):
+        yield gene,contrast_index,log2FC
+
+def is_sorted_contrast(contrast_file):
+    prev_gene = None
+    with open(contrast_file,"r") as cf:
+        next(cf)
+        for line in cf:
+            gene = line.split("\t",1)[0]
+            if prev_gene is not None and gene < prev_gene:
+                return False
+            prev_gene = gene
+    return True
+
+#Writes gene_exp.gmx for one genome by merge-joining its sorted gene contrast files,
+#only the current line of each contrast file is in memory. Genes missing from a contrast get 0
+def write_genome_gmx(gmx_args):
+    genome_output,contrast_file_list = gmx_args
+    #when creating gene_exp.gmx, ignore transcripts
+    contrast_files = [cf for cf in contrast_file_list if not "Transcript" in cf]
+    contrast_list = [os.path.basename(cf).replace(".txt","") for cf in contrast_files]
+    contrast_streams = [tag_contrast_genes(contrast_file,i) for i,contrast_file in enumerate(contrast_files)]
+    with open(os.path.join(genome_output,"gene_exp.gmx"),"w") as o:
+        o.write("Gene_ID\t%s\n"%"\t".join(contrast_list))
+        row = None
+        cur_gene = None
+        for gene,i,log2FC in heapq.merge(*contrast_streams):
+            if gene != cur_gene:
+                if row is not None:
+                    o.write("%s\t%s\n"%(cur_gene.replace("gene-",""),"\t".join(row)))
+                cur_gene = gene
+                row = ["0"]*len(contrast_files)
+            row[i] = log2FC
+        if row is not None:
+            o.write("%s\t%s\n"%(cur_gene.replace("gene-",""),"\t".join(row)))
 
 #TODO: might not need function
 #Function that checks the genes from the host pipeline 
@@ -152,25 +222,29 @@ def validate_host_genes():
     print("need to write function")
 
 #TODO: what if they don't do differential expression
-#TODO: should we care about the p-value?
 #TODO: maybe two heatmaps: 50 upregulated and 50 downregulated?
 #Strategy: 
-#   - go through and keep two sorted lists: upregulated and downregulated
-#   - pass top 50(?) into heatmap program 
+#   - stream every contrast file once, the first significant occurrence of a gene decides its direction and log2FC
+#   - keep the top_k most upregulated and top_k most downregulated genes in two bounded heaps
+#   - pass those genes into the heatmap program 
+#Thresholds come from "heatmap" in job_data: top_k (per direction, at least 1, default 25), pval_threshold on padj (default 1.0)
+#and log2fc_threshold on |log2FC| (default 0)
 #Returns: number of genes in the heatmap, skip heatmap if 0
-def top_diffexp_genes(genome_list): 
-    #TODO: log_threshold = 1
-    #pval_threshold = 0.05
-    pval_threshold = 1.0
+def top_diffexp_genes(genome_list,job_data=None): 
+    heatmap_params = job_data.get("heatmap",{}) if job_data else {}
+    top_k = int(heatmap_params.get("top_k",25))
+    if top_k < 1:
+        raise ValueError("Invalid heatmap top_k %d: must be at least 1"%top_k)
+    pval_threshold = float(heatmap_params.get("pval_threshold",1.0))
+    log2fc_threshold = float(heatmap_params.get("log2fc_threshold",0))
     for genome in genome_list:
-        os.chdir(genome["output"])
         contrast_file_list = genome["diff_exp_contrasts"]
-        #List for upregulated genes
-        up_genes_list = []
-        up_log_list = []
-        #List for downregulated genes
-        down_genes_list = []
-        down_log_list = []
+        #genes already placed in a direction
+        seen_genes = set()
+        #min-heaps of (log2FC magnitude, -order seen, gene): the root is the first to drop out, ties keep the gene seen first
+        up_heap = []
+        down_heap = []
+        seq = 0
         #grab all signification genes
         for contrast_file in contrast_file_list:
             with open(contrast_file,"r") as cf:
@@ -178,22 +252,25 @@ def top_diffexp_genes(genome_list):
                 for line in cf:
                     gene,baseMean,logFC,lfcSE,stat,pvalue,padj = line.strip().split("\t") 
                     #TODO: check that skipping over padj == "NA" is correct
-                    if padj == "NA":
+                    if padj == "NA" or gene in seen_genes:
                         continue
                     if float(padj) < pval_threshold:
-                        if float(logFC) < 0 and gene not in down_genes_list and gene not in up_genes_list:
-                            down_genes_list.append(gene)
-                            down_log_list.append(float(logFC))
-                        elif float(logFC) > 0 and gene not in up_genes_list and gene not in down_genes_list:
-                            up_genes_list.append(gene)
-                            up_log_list.append(float(logFC))
-        #zip and sort lists 
-        up_sorted = sorted(tuple(zip(up_genes_list,up_log_list)),key=lambda x:x[1],reverse=True)
-        down_sorted = sorted(tuple(zip(down_genes_list,down_log_list)),key=lambda x:x[1])
-        #get subset of genes for heatmap
-        num_up = 25 if len(up_sorted) > 25 else len(up_sorted)
-        num_down = 25 if len(down_sorted) > 25 else len(down_sorted)
-        heatmap_genes = list(up_sorted)[:num_up]+list(down_sorted)[:num_down]
+                        log_fc = float(logFC)
+                        if log_fc < -log2fc_threshold:
+                            heap = down_heap
+                        elif log_fc > log2fc_threshold:
+                            heap = up_heap
+                        else:
+                            continue
+                        seen_genes.add(gene)
+                        seq += 1
+                        entry = (abs(log_fc),-seq,gene)
+                        if len(heap) < top_k:
+                            heapq.heappush(heap,entry)
+                        elif entry > heap[0]:
+                            heapq.heapreplace(heap,entry)
+        #largest change first, ties in the order the genes were seen
+        heatmap_genes = [e[2] for e in sorted(up_heap,reverse=True)]+[e[2] for e in sorted(down_heap,reverse=True)]
         if len(heatmap_genes) == 0:
             sys.stderr.write("No significant genes found in differential expression file: no heatmap output\n")
             continue 
@@ -202,12 +279,12 @@ def top_diffexp_genes(genome_list):
         genome["heatmap_genes"] = heatmap_genes_file 
         with open(heatmap_genes_file,"w") as o:
             for gene in heatmap_genes:
-                o.write("%s\n"%gene[0]) 
+                o.write("%s\n"%gene) 
 
 def generate_heatmaps(genome_list,job_data,dge_dict):
-    feature_count = "htseq" if job_data.get("feature_count","htseq") == "htseq" else "stringtie"
+    feature_count = "stringtie" if job_data.get("feature_count","htseq") == "stringtie" else "htseq"
     for genome in genome_list:
-        os.chdir(genome["output"])
+        genome_wd = workdir.genome_dir(genome)
         if not "heatmap_genes" in genome:
             continue
         #<heatmap_script.R> <gene_counts.txt> <metaata.txt> <heatmap_genes.txt> <output_prefix> <feature_count> <specialty_genes)
@@ -216,7 +293,7 @@ def generate_heatmaps(genome_list,job_data,dge_dict):
         #genome["heatmap_svg"] = os.path.join(genome["output"],"Normalized_Top_50_Differentially_Expressed_Genes_mqc.svg")
         genome["heatmap_svg"] = os.path.join(genome["output"],"Normalized_Top_50_Differentially_Expressed_Genes.svg")
         print(" ".join(heatmap_cmd))
-        subprocess.check_call(heatmap_cmd)
+        genome_wd.check_call(heatmap_cmd)
         dge_dict["heatmap"] = wrap_svg_in_html(genome["heatmap_svg"])
 
 #Places <DOCTYPE> and <html>/</html> around svg code
@@ -247,7 +324,7 @@ def setup(genome_list, condition_dict, parameters, output_dir, job_data):
                 if "srr_accession" in r:
                     srr_id = r["srr_accession"] 
                     meta_file = os.path.join(target_dir,srr_id+"_meta.txt")
-                    subprocess.check_call(["p3-sra","--out",target_dir,"--metadata-file", meta_file, "--id",srr_id])
+                    pipeline_trace.check_call(["p3-sra","--out",target_dir,"--metadata-file", meta_file, "--id",srr_id])
                     with open(meta_file) as f:
                         job_meta = json.load(f)
                         files = job_meta[0].get("files",[])
@@ -260,6 +337,11 @@ def setup(genome_list, condition_dict, parameters, output_dir, job_data):
                                 r["read1"]=os.path.join(target_dir,f)
                             elif f.endswith("fastqc.html"):
                                 r["fastqc"].append(os.path.join(target_dir, f))
+    #start the subsystem and specialty gene lookups main will need, same conditions as in main
+    run_cuffdiff_pipeline = job_data.get("feature_count","htseq") == "cuffdiff"
+    subsystem_lookup = not run_cuffdiff_pipeline and job_data.get("recipe","RNA-Rocket") == "RNA-Rocket"
+    specialty_lookup = not run_cuffdiff_pipeline and len(condition_dict.keys()) > 1 and not job_data.get("novel_features",False)
+    subsystems.prefetch_annotations(genome_list,job_data,subsystem_lookup,specialty_lookup)
            
 
 def main(genome_list, condition_dict, parameters_str, output_dir, gene_matrix=False, contrasts=[], job_data=None, map_args=None, diffexp_json=None):
@@ -275,72 +357,234 @@ def main(genome_list, condition_dict, parameters_str, output_dir, gene_matrix=Fa
         parameters=json.loads(parameters_str)
     else:
         parameters = {}
-    setup(genome_list, condition_dict, parameters, output_dir, job_data)
-    
-    ###Setup dictionaries for the multiqc modules: use json dump to put these files at the top of each genome directory
-    dge_dict = {}
-    subsystem_dict = {}
-
-    ###write the introduction to the multiqc report based on the recipe, number of samples, conditions, and contrasts
-    for genome in genome_list:
-        os.chdir(genome["output"])
-        num_samples = len(job_data.get("single_end_libs",[])) + len(job_data.get("paired_end_libs",[])) 
-        mmo.write_introduction_pipeline(job_data.get("recipe","None"),str(num_samples),str(len(job_data.get("experimental_conditions","0"))),str(len(job_data.get("contrasts","0"))))
     #pipeline_log holds the commands at each step of the pipeline and prints it to an output file Pipeline.txt
     #TODO: should it contain the json dump of the input parameters? 
     pipeline_log = []
+    if job_data.get("dry_run",False):
+        run_pipeline(genome_list, condition_dict, parameters, output_dir, gene_matrix, contrasts, job_data, map_args, diffexp_json, pipeline_log)
+        return
+    #wall time, cpu time, peak memory and io of every command go to pipeline_trace.jsonl as they finish
+    pipeline_trace.start(output_dir)
+    #genomes run as separate pipelines at the same time, "genome_workers" in job_data limits how many
+    num_genome_workers = min(len(genome_list),int(job_data.get("genome_workers",len(genome_list))))
+    if num_genome_workers > 1:
+        pipeline_log = run_genomes_parallel(genome_list, condition_dict, parameters, output_dir, gene_matrix, contrasts, job_data, map_args, diffexp_json, num_genome_workers)
+    else:
+        #Pipeline.txt is also written when a step fails, with the commands run up to the failure
+        try:
+            run_pipeline(genome_list, condition_dict, parameters, output_dir, gene_matrix, contrasts, job_data, map_args, diffexp_json, pipeline_log)
+        except BaseException:
+            with open(os.path.join(output_dir,"Pipeline.txt"),"w") as o:
+                o.write("\n".join(pipeline_log))
+            raise
+    with open(os.path.join(output_dir,"Pipeline.txt"),"w") as o:
+        o.write("\n".join(pipeline_log))
+
+#Seconds between checks that the genome processes are still running while waiting for their results
+RESULT_POLL_SECONDS = 10
+
+#Runs one pipeline per genome in its own process, at most num_workers at a time
+#Processes keep the module level state of each pipeline apart. The core budget is split between the workers
+#Returns the pipeline logs of the genomes in genome_list order, exits if any genome failed
+def run_genomes_parallel(genome_list, condition_dict, parameters, output_dir, gene_matrix, contrasts, job_data, map_args, diffexp_json, num_workers):
+    genome_job_data = dict(job_data)
+    genome_job_data["max_cores"] = max(1,scheduler.get_core_budget(job_data)//num_workers)
+    result_queue = multiprocessing.Queue()
+    pending = list(enumerate(genome_list))
+    running = {}
+    genome_logs = {}
+    failed = []
+    while pending or running:
+        while pending and len(running) < num_workers:
+            index,genome = pending.pop(0)
+            #not a daemon: the genome pipelines start their own worker pools
+            proc = multiprocessing.Process(target=run_genome_pipeline,args=(index, genome, condition_dict, parameters, output_dir, gene_matrix, contrasts, genome_job_data, map_args, diffexp_json, result_queue))
+            proc.start()
+            running[index] = proc
+        index,status,genome_log = get_genome_result(result_queue,running)
+        running.pop(index).join()
+        genome_logs[index] = genome_log
+        if status != 0:
+            failed.append(genome_list[index]["dir"])
+    pipeline_log = []
+    for index in range(len(genome_list)):
+        pipeline_log.extend(genome_logs[index])
+    if failed:
+        sys.stderr.write("Pipeline failed for genomes: %s\n"%",".join(failed))
+        with open(os.path.join(output_dir,"Pipeline.txt"),"w") as o:
+            o.write("\n".join(pipeline_log))
+        sys.exit(1)
+    return pipeline_log
+
+#Waits for the next (index,exit status,pipeline log) of the running genome processes
+#Results are read before joining, a process doesn't exit until its queued data is consumed. A process that died
+#without queueing its result (killed, out of memory) counts as failed with its exit code and an empty log
+def get_genome_result(result_queue, running):
+    while True:
+        try:
+            return result_queue.get(timeout=RESULT_POLL_SECONDS)
+        except queue.Empty:
+            pass
+        for index,proc in running.items():
+            if proc.is_alive():
+                continue
+            #its result, if it queued one, is already in the pipe
+            try:
+                return result_queue.get(False)
+            except queue.Empty:
+                sys.stderr.write("Genome process %d exited with %s before reporting a result\n"%(index,proc.exitcode))
+                return index,proc.exitcode if proc.exitcode else 1,[]
+
+#Process target for run_genomes_parallel: runs the pipeline for one genome and queues (index,exit status,pipeline log)
+def run_genome_pipeline(index, genome, condition_dict, parameters, output_dir, gene_matrix, contrasts, job_data, map_args, diffexp_json, result_queue):
+    pipeline_log = []
+    status = 0
+    try:
+        run_pipeline([genome], condition_dict, parameters, output_dir, gene_matrix, contrasts, job_data, map_args, diffexp_json, pipeline_log)
+    except SystemExit as e:
+        #the cuffdiff pipeline exits with 0 when it's done
+        status = e.code if isinstance(e.code,int) else int(e.code is not None)
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    sys.stdout.flush()
+    result_queue.put((index,status,pipeline_log))
+
+#The pipeline for the genomes in genome_list, adding the commands it runs to pipeline_log
+#Each genome runs as a graph of tasks (build_pipeline_tasks), genomes one after the other
+#"dry_run" in job_data lists the tasks and whether they are up to date instead of running them
+def run_pipeline(genome_list, condition_dict, parameters, output_dir, gene_matrix, contrasts, job_data, map_args, diffexp_json, pipeline_log):
+    for genome in genome_list:
+        make_directory_names(genome, condition_dict)
+        pipeline_trace.set_genome(os.path.basename(genome["output"]))
+        runner = build_pipeline_tasks(genome, condition_dict, parameters, output_dir, gene_matrix, contrasts, job_data, map_args, diffexp_json, pipeline_log)
+        if job_data.get("dry_run",False):
+            print("Tasks for %s:"%genome["output"])
+            runner.dry_run()
+        else:
+            runner.run()
+
+#Returns a pipeline_dag.Runner with the pipeline steps for one genome
+#Steps that only depend on earlier ones run at the same time, up to "task_workers" in job_data
+#Steps with declared inputs/outputs are skipped when up to date ("task_skip": mtime, checksum or none), the others
+#check their own files. Tasks are recorded in the genome's checkpoint manifest
+def build_pipeline_tasks(genome, condition_dict, parameters, output_dir, gene_matrix, contrasts, job_data, map_args, diffexp_json, pipeline_log):
+    genome_list = [genome]
+    runner = pipeline_dag.Runner(int(job_data.get("task_workers",DEFAULT_TASK_WORKERS)),checkpoint.get_manifest(genome["output"],job_data),job_data.get("task_skip",pipeline_dag.DEFAULT_SKIP_MODE),pipeline_log)
+    Task = pipeline_dag.Task
+    feature_count = job_data.get("feature_count","htseq")
+    host = job_data.get("recipe","RNA-Rocket") == "Host"
     #TRUE: runs cufflinks then cuffdiff if differential expression is turned on
     #FALSE: runs either htseq-count or stringtie
-    run_cuffdiff_pipeline = job_data.get("feature_count","htseq") == "cuffdiff"
-    alignment.run_alignment(genome_list, condition_dict, parameters, output_dir, job_data, pipeline_log)
+    run_cuffdiff_pipeline = feature_count == "cuffdiff"
+    run_diffexp = len(condition_dict.keys()) > 1 and not job_data.get("novel_features",False)
+    ###Setup dictionaries for the multiqc modules: use json dump to put these files at the top of each genome directory
+    dge_dict = {}
+    #fastqc, samtools stats and samstat run in the background until the qc task collects them
+    qc = qc_stage.QCStage(int(job_data.get("qc_workers",qc_stage.DEFAULT_QC_WORKERS)))
+
+    runner.add(Task("setup",lambda: setup_genomes(genome_list, condition_dict, parameters, output_dir, job_data)))
+    runner.add(Task("align",lambda: alignment.run_alignment(genome_list, condition_dict, parameters, output_dir, job_data, runner.log("align"), qc),["setup"]))
+    runner.add(Task("qc",lambda: qc.join(runner.log("qc")),["align"]))
     if run_cuffdiff_pipeline:
-        cufflinks_pipeline.run_cufflinks(genome_list, condition_dict, parameters, output_dir)
+        runner.add(Task("count",lambda: cufflinks_pipeline.run_cufflinks(genome_list, condition_dict, parameters, output_dir, job_data),["align"]))
     else:
-        quantification.run_featurecount(genome_list, condition_dict, parameters, output_dir, job_data, pipeline_log)
-    prep_diffexp_files.create_metadata_file(genome_list,condition_dict,output_dir)
+        runner.add(Task("count",lambda: quantification.run_featurecount(genome_list, condition_dict, parameters, output_dir, job_data, runner.log("count")),["align"]))
+    runner.add(Task("metadata",lambda: prep_diffexp_files.create_metadata_file(genome_list,condition_dict,output_dir),["align"]))
     #TODO: change novel_features condition when novel-isoform differential expression is implemented
-    if not run_cuffdiff_pipeline and job_data.get("feature_count","htseq") == "stringtie":
-        prep_diffexp_files.write_gtf_list(genome_list,condition_dict) #function that writes the input for prepDE.py, which is a list of samples and paths to their gtf files. Do this for each genome
-        prep_diffexp_files.prep_stringtie_diffexp(genome_list,condition_dict,job_data.get("recipe","RNA-Rocket") == "Host",pipeline_log)   
-    elif not run_cuffdiff_pipeline and job_data.get("feature_count","htseq") == "htseq": #htseq
-        if job_data.get("recipe","RNA-Rocket") == "Host":
-            prep_diffexp_files.create_counts_table_host(genome_list,condition_dict,job_data)
-        else:
-            prep_diffexp_files.create_counts_table(genome_list,condition_dict,job_data)
+    if feature_count == "stringtie":
+        #writes the input for prepDE.py, which is a list of samples and paths to their gtf files, then runs prepDE.py
+        runner.add(Task("matrix",lambda: prep_stringtie_matrix(genome_list,condition_dict,host,runner.log("matrix"),job_data),["count"]))
+    elif feature_count in ["htseq","native"]: #htseq format counts files
+        create_counts_table = prep_diffexp_files.create_counts_table_host if host else prep_diffexp_files.create_counts_table
+        matrix_paths = lambda: prep_diffexp_files.get_counts_matrix_paths(genome,job_data,host)
+        runner.add(Task("matrix",lambda: create_counts_table(genome_list,condition_dict,job_data),["count"],
+            inputs=lambda: prep_diffexp_files.get_counts_files(genome,condition_dict,host),
+            outputs=lambda: list(matrix_paths().values()),
+            restore=lambda: genome.update(matrix_paths())))
     #TODO: reorganize queries to occur in one script instead of creating a dependency between different query functions and their order
+    #the heatmap labels genes with the subsystem superclass mapping
+    subsystem_deps = []
     if not run_cuffdiff_pipeline and job_data.get("recipe","RNA-Rocket") == "RNA-Rocket":
-        subsystems.run_subsystem_analysis(genome_list,job_data)
-    
-    if len(condition_dict.keys()) > 1 and not job_data.get("novel_features",False):
-        #If running cuffdiff pipeline, terminated after running expression import
-        if run_cuffdiff_pipeline:
-            cufflinks_pipeline.run_cuffdiff(genome_list, condition_dict, parameters, output_dir, gene_matrix, contrasts, job_data, map_args, diffexp_json)
-            run_diff_exp_import(genome_list, condition_dict, parameters, output_dir, contrasts, job_data, map_args, diffexp_json)
-            sys.exit(0)
+        runner.add(Task("subsystems",lambda: subsystems.run_subsystem_analysis(genome_list,job_data),["matrix","metadata"]))
+        subsystem_deps.append("subsystems")
+    if run_diffexp and run_cuffdiff_pipeline:
+        #the cuffdiff pipeline ends after the expression import, without a report
+        runner.add(Task("cuffdiff",lambda: cufflinks_pipeline.run_cuffdiff(genome_list, condition_dict, parameters, output_dir, gene_matrix, contrasts, job_data, map_args, diffexp_json),["count","metadata"]))
+        runner.add(Task("import",lambda: run_diff_exp_import(genome_list, condition_dict, parameters, output_dir, contrasts, job_data, map_args, diffexp_json),["cuffdiff","qc"]))
+        return runner
+    if run_diffexp:
         #volcano plots are generated in the same script that runs deseq2
-        run_deseq2(genome_list,contrasts,job_data,dge_dict)
-        write_gmx_file(genome_list)
+        volcano_svg = os.path.join(genome["output"],"Volcano_Plots.svg")
+        runner.add(Task("deseq2",lambda: run_deseq2(genome_list,contrasts,job_data,dge_dict),["matrix","metadata"],
+            inputs=lambda: [genome["gene_matrix"],genome["deseq_metadata"]]+([genome["transcript_matrix"]] if "transcript_matrix" in genome else []),
+            outputs=lambda: get_deseq2_outputs(genome,contrasts,job_data)+[volcano_svg,volcano_svg.replace(".svg",".html")],
+            params={"contrasts":contrasts,"global_fit":job_data.get("deseq2",{}).get("global_fit",False)},
+            restore=lambda: restore_deseq2(genome,contrasts,job_data,dge_dict)))
+        runner.add(Task("gmx",lambda: write_gmx_file(genome_list),["deseq2"],
+            inputs=lambda: genome["diff_exp_contrasts"],
+            outputs=lambda: [os.path.join(genome["output"],"gene_exp.gmx")]))
         #TODO: differential expression import will fail for host, fix by getting valid genes 
-        try:
-            run_diff_exp_import(genome_list, condition_dict, parameters, output_dir, contrasts, job_data, map_args, diffexp_json)
-        except:
-            print("Expression import failed")
+        runner.add(Task("import",lambda: try_diff_exp_import(genome_list, condition_dict, parameters, output_dir, contrasts, job_data, map_args, diffexp_json),["gmx"]))
         #get amr and specialty genes for labeling the heatmap
-        subsystems.setup_specialty_genes(genome_list)
+        runner.add(Task("specialty_genes",lambda: subsystems.setup_specialty_genes(genome_list,job_data),["setup"]))
         #generate heatmaps 
-        top_diffexp_genes(genome_list) 
-        generate_heatmaps(genome_list,job_data,dge_dict)
-    #write out any of the json files to the top level of the genomes
-    #TODO: rewrite dictionaries to be in the context of genomes
+        runner.add(Task("heatmap_genes",lambda: top_diffexp_genes(genome_list,job_data),["deseq2"]))
+        heatmap_svg = os.path.join(genome["output"],"Normalized_Top_50_Differentially_Expressed_Genes.svg")
+        heatmap_inputs = ["gene_matrix","deseq_metadata","heatmap_genes","specialty_genes_map","superclass_map"]
+        runner.add(Task("heatmap",lambda: generate_heatmaps(genome_list,job_data,dge_dict),["heatmap_genes","specialty_genes"]+subsystem_deps,
+            inputs=lambda: [genome[key] for key in heatmap_inputs if key in genome],
+            #no heatmap without significant genes
+            outputs=lambda: [heatmap_svg,heatmap_svg.replace(".svg",".html")] if "heatmap_genes" in genome else [],
+            restore=lambda: restore_heatmap(genome,heatmap_svg,dge_dict)))
+    #the report reads the output of every other step
+    runner.add(Task("report",lambda: write_report(genome_list,condition_dict,dge_dict,job_data),[t.name for t in runner.tasks]))
+    return runner
+
+#Default number of pipeline tasks of a genome running at the same time. The qc task mostly waits on the QC tools
+DEFAULT_TASK_WORKERS = 4
+
+#setup and the introduction of the multiqc report, which is based on the recipe, number of samples, conditions, and contrasts
+def setup_genomes(genome_list, condition_dict, parameters, output_dir, job_data):
+    setup(genome_list, condition_dict, parameters, output_dir, job_data)
+    for genome in genome_list:
+        num_samples = len(job_data.get("single_end_libs",[])) + len(job_data.get("paired_end_libs",[])) 
+        mmo.write_introduction_pipeline(genome["output"],job_data.get("recipe","None"),str(num_samples),str(len(job_data.get("experimental_conditions","0"))),str(len(job_data.get("contrasts","0"))))
+
+def prep_stringtie_matrix(genome_list,condition_dict,host,pipeline_log,job_data):
+    prep_diffexp_files.write_gtf_list(genome_list,condition_dict)
+    prep_diffexp_files.prep_stringtie_diffexp(genome_list,condition_dict,host,pipeline_log,job_data)
+
+def try_diff_exp_import(genome_list, condition_dict, parameters, output_dir, contrasts, job_data, map_args, diffexp_json):
+    try:
+        run_diff_exp_import(genome_list, condition_dict, parameters, output_dir, contrasts, job_data, map_args, diffexp_json)
+    except:
+        print("Expression import failed")
+
+#Sets what run_deseq2 and generate_heatmaps would have set when their task is skipped
+def restore_deseq2(genome,contrasts,job_data,dge_dict):
+    genome["diff_exp_contrasts"] = get_deseq2_outputs(genome,contrasts,job_data)
+    dge_dict["volcano"] = os.path.join(genome["output"],"Volcano_Plots.html")
+
+def restore_heatmap(genome,heatmap_svg,dge_dict):
+    genome["heatmap_svg"] = heatmap_svg
+    dge_dict["heatmap"] = heatmap_svg.replace(".svg",".html")
+
+#write out any of the json files to the top level of the genomes, then the multiqc report
+#TODO: rewrite dictionaries to be in the context of genomes
+def write_report(genome_list,condition_dict,dge_dict,job_data):
     for genome in genome_list:
-        os.chdir(genome["output"])
         #output dge_dict
-        with open("differential_expression.json","w") as dge_handle:
+        with open(os.path.join(genome["output"],"differential_expression.json"),"w") as dge_handle:
             dge_handle.write(json.dumps(dge_dict))
+        #commands traced so far for the performance module, by replicate
+        sample_files = {}
+        for condition in condition_dict:
+            for r in condition_dict[condition]["replicates"]:
+                bam_file = r[genome["genome"]]["bam"]
+                sample_files[os.path.basename(bam_file).replace(".bam","")] = [bam_file]+[r[read] for read in ["read1","read2"] if read in r]
+        mmo.write_performance_json(genome["output"],pipeline_trace.trace_file,os.path.basename(genome["output"]),sample_files,scheduler.get_core_budget(job_data))
     multiqc_report.run_multiqc(genome_list,condition_dict)
-    os.chdir(output_dir)
-    with open("Pipeline.txt","w") as o:
-        o.write("\n".join(pipeline_log))
         
 
 if __name__ == "__main__":
@@ -363,6 +607,8 @@ if __name__ == "__main__":
     parser.add_argument('-p', help='JSON formatted parameter list for tuxedo suite keyed to program', default="{}", required=False)
     parser.add_argument('-o', help='output directory. defaults to current directory.', required=False, default=None)
     parser.add_argument('-d', help='name of the folder for differential expression job folder where files go', required=True) 
+    parser.add_argument('--max-cores', help='total number of cores shared by concurrent alignment jobs. defaults to all cores on the node', type=int, required=False, default=0)
+    parser.add_argument('--dry-run', help='list the pipeline tasks of each genome and whether they are up to date without running them', action='store_true', required=False)
     #parser.add_argument('-x', action="store_true", help='run the gene matrix conversion and create a patric expression object', required=False)
     #parser.add_argument('readfiles', nargs='+', help="whitespace sep list of read files. shoudld be \
     #        in corresponding order as library list. ws separates libraries,\
@@ -383,6 +629,16 @@ if __name__ == "__main__":
     #create library dict
     with open(map_args.jfile, 'r') as job_handle:
         job_data = json.load(job_handle)
+    if map_args.max_cores > 0:
+        job_data["max_cores"] = map_args.max_cores
+    if map_args.dry_run:
+        job_data["dry_run"] = True
+    #data api url for the subsystem and specialty gene lookups (patric_api.py)
+    if map_args.sstring and "data_api" not in job_data:
+        try:
+            job_data["data_api"] = json.loads(map_args.sstring)["data_api"]
+        except (ValueError,KeyError,TypeError):
+            sys.stderr.write("No data_api in --sstring, using %s\n"%patric_api.DEFAULT_API_URL)
 
     condition_list= job_data.get("experimental_conditions",[])
     got_conditions=False
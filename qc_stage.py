@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+from multiprocessing.pool import ThreadPool
+import pipeline_trace
+
+#QC jobs running next to alignment/quantification, set "qc_workers" in job_data to change
+DEFAULT_QC_WORKERS = 2
+
+#Runs the QC tools (fastqc, samtools stats, samstat) off the critical path
+#Alignment submits QC jobs here and moves on to the next step, the jobs run on their own thread pool
+#Nothing downstream reads the QC output except multiqc, so main only joins the stage before run_multiqc
+#With num_workers == 0 every job runs immediately in the caller, which is the old serial behavior
+class QCStage(object):
+    def __init__(self, num_workers):
+        self.pool = ThreadPool(num_workers) if num_workers > 0 else None
+        self.jobs = []
+
+    #func must return the list of commands it ran
+    #order_key sorts the commands in the pipeline log, so the log doesn't depend on which job finished first
+    def submit(self, order_key, func, *args):
+        if self.pool:
+            #traced under the step that submitted the job
+            self.jobs.append((order_key,self.pool.apply_async(pipeline_trace.with_step(func),args)))
+        else:
+            self.jobs.append((order_key,FinishedJob(func(*args))))
+
+    #Waits for every submitted job and adds their commands to pipeline_log
+    #Re-raises the first exception raised by a QC job
+    def join(self, pipeline_log):
+        jobs = sorted(self.jobs,key=lambda job: job[0])
+        self.jobs = []
+        for order_key,job in jobs:
+            pipeline_log.extend(job.get())
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+#Same interface as the AsyncResult returned by the thread pool
+class FinishedJob(object):
+    def __init__(self, result):
+        self.result = result
+
+    def get(self):
+        return self.result
@@ -1,6 +1,16 @@
 #!/usr/bin/env python
 
 import os,sys,glob,math,shutil,subprocess
+import scheduler
+import feature_counter
+import annotation_index
+import workdir
+import pipeline_trace
+import checkpoint
+
+#feature types counted for the Host recipe: gene counts file and transcript counts file
+HOST_GENE_FEATURES = ["gene","pseudogene"]
+HOST_TRANSCRIPT_FEATURES = ["mRNA","lnc_RNA","transcript","snRNA","V_gene_segment","snoRNA","enhancer","biological_region","primary_transcript","miRNA","C_gene_segment","rRNA","tRNA"]
 
 #Run the feature count program specified in json input, or run htseq-count by default
 def run_featurecount(genome_list, condition_dict, parameters, output_dir, job_data, pipeline_log):
@@ -8,10 +18,12 @@ def run_featurecount(genome_list, condition_dict, parameters, output_dir, job_da
     program = job_data.get("feature_count","htseq")
     if program == "htseq":
         run_htseq_count(genome_list, condition_dict, parameters, job_data, output_dir, pipeline_log)
+    elif program == "native":
+        run_native_count(genome_list, condition_dict, parameters, job_data, output_dir, pipeline_log)
     elif program == "stringtie":
         run_stringtie(genome_list, condition_dict, parameters, job_data, output_dir, pipeline_log)
     else: #not a valid program
-        sys.stderr.write("Invalid feature count program: htseq or stringtie only\n")
+        sys.stderr.write("Invalid feature count program: htseq, native or stringtie only\n")
         os.exit(1)
 
 def run_stringtie(genome_list, condition_dict, parameters, job_data, output_dir, pipeline_log):
@@ -23,12 +35,13 @@ def run_stringtie(genome_list, condition_dict, parameters, job_data, output_dir,
     for genome in genome_list:
         genome_file=genome["genome"]
         genome_link = genome["genome_link"]
+        manifest = checkpoint.get_manifest(genome["output"],job_data)
         #transcriptome assembly
         gtf_list = []
         for library in condition_dict:
             for r in condition_dict[library]["replicates"]:
                 cur_dir=os.path.dirname(os.path.realpath(r[genome_file]["bam"]))
-                os.chdir(cur_dir)
+                cur_wd=workdir.WorkDir(cur_dir) #-A output is relative to the replicate directory
                 r[genome_file]["dir"]=cur_dir
                 cuff_gtf=os.path.join(cur_dir,"transcripts.gtf")
                 stringtie_cmd = ["stringtie",r[genome_file]["bam"],"-p",str(thread_count),"-A","gene_abund.tab"]
@@ -39,9 +52,11 @@ def run_stringtie(genome_list, condition_dict, parameters, job_data, output_dir,
                 r[genome_file]["gtf"] = cuff_gtf
                 gtf_list.append(cuff_gtf)
                 print (" ".join(stringtie_cmd))
-                if not os.path.exists(cuff_gtf):
+                stringtie_step = ["stringtie "+cuff_gtf,[r[genome_file]["bam"],genome["annotation"]],[cuff_gtf,cur_wd.path("gene_abund.tab")],checkpoint.get_command_params(stringtie_cmd),["stringtie"]]
+                if not manifest.is_complete(*stringtie_step):
                     pipeline_log.append(" ".join(stringtie_cmd))
-                    subprocess.check_call(stringtie_cmd)
+                    cur_wd.check_call(stringtie_cmd)
+                    manifest.record(*stringtie_step)
                 else:
                     sys.stderr.write(cuff_gtf+" stringtie file already exists. skipping\n")
         #True: Skip merged annotation pipeline
@@ -52,38 +67,42 @@ def run_stringtie(genome_list, condition_dict, parameters, job_data, output_dir,
             return
         #merge reconstructed transcriptomes
         ##stringtie --merge -G <reference annotation> -o <merged annotation> <gtf list>
-        os.chdir(genome["output"])
         #os.mkdir("merged_annotation")
         merge_file = os.path.join(genome["output"],"merged_annotation","merged.gtf")
-        if not os.path.exists(merge_file):
-            merge_cmd = ["stringtie","--merge","-G",genome["annotation"],"-o",merge_file]+gtf_list
+        merge_cmd = ["stringtie","--merge","-G",genome["annotation"],"-o",merge_file]+gtf_list
+        merge_step = ["merge "+merge_file,[genome["annotation"]]+gtf_list,[merge_file],merge_cmd,["stringtie"]]
+        if not manifest.is_complete(*merge_step):
             print(" ".join(merge_cmd))
             pipeline_log.append(" ".join(merge_cmd))
-            subprocess.check_call(merge_cmd)
+            pipeline_trace.check_call(merge_cmd)
+            manifest.record(*merge_step)
         genome["merged_annotation"] = merge_file 
         #requantify transcriptome results with merged annotation
         for library in condition_dict:
             for r in condition_dict[library]["replicates"]:
                 cur_dir=os.path.dirname(os.path.realpath(r[genome_file]["bam"]))
-                os.chdir(cur_dir)
+                cur_wd=workdir.WorkDir(cur_dir)
                 merge_gtf = os.path.join(cur_dir,"transcripts_merged.gtf")
                 stringtie_cmd = ["stringtie",r[genome_file]["bam"],"-p",str(thread_count),"-A","merged_abund.tab","-e","-G",genome["merged_annotation"],"-o",merge_gtf]
                 r[genome_file]["merged_gtf"] = merge_gtf
-                if not os.path.exists(merge_gtf):
+                stringtie_step = ["stringtie "+merge_gtf,[r[genome_file]["bam"],genome["merged_annotation"]],[merge_gtf,cur_wd.path("merged_abund.tab")],checkpoint.get_command_params(stringtie_cmd),["stringtie"]]
+                if not manifest.is_complete(*stringtie_step):
                     print (" ".join(stringtie_cmd))
                     pipeline_log.append(" ".join(stringtie_cmd))
-                    subprocess.check_call(stringtie_cmd)
+                    cur_wd.check_call(stringtie_cmd)
+                    manifest.record(*stringtie_step)
                 else:
                     sys.stderr.write(merge_gtf+" stringtie file already exists. skipping\n")
 
-def split_bam_file(replicate_bam,threads,pipeline_log):
+#Split_Bams is made in the replicate work directory replicate_wd
+def split_bam_file(replicate_bam,threads,pipeline_log,replicate_wd):
     print("Splitting %s into %s files for parallel htseq-count"%(replicate_bam,str(threads)))
     #count number of reads in bam file
     count_cmd_list = ["samtools","view","-c","--threads",str(threads),replicate_bam]
     print(" ".join(count_cmd_list))
     pipeline_log.append(" ".join(count_cmd_list))
-    count_cmd = subprocess.Popen(count_cmd_list,stdout=subprocess.PIPE)
-    num_lines,err = count_cmd.communicate()
+    count_cmd = pipeline_trace.Popen(count_cmd_list,stdout=subprocess.PIPE)
+    num_lines,err = pipeline_trace.communicate(count_cmd)
     num_lines = float(num_lines.strip())
     #number of lines per file
     num_lines_per_file = int(math.floor(num_lines/float(threads)))
@@ -91,24 +110,26 @@ def split_bam_file(replicate_bam,threads,pipeline_log):
     header_cmd = ["samtools","view","-H",replicate_bam]
     print(" ".join(header_cmd))
     pipeline_log.append(" ".join(header_cmd))
-    header_output = subprocess.Popen(header_cmd,stdout=subprocess.PIPE)
-    header,err = header_output.communicate()
+    header_output = pipeline_trace.Popen(header_cmd,stdout=subprocess.PIPE)
+    header,err = pipeline_trace.communicate(header_output)
     #separate bam file into multiple bam files
     view_cmd = ["samtools","view","--threads",str(threads),replicate_bam]
     split_cmd = ["split","-l",str(num_lines_per_file)]
-    if os.path.exists("Split_Bams"):
+    split_dir = replicate_wd.path("Split_Bams")
+    if os.path.exists(split_dir):
         #if directory wasn't deleted for some reason, remove before running
-        shutil.rmtree("Split_Bams") 
+        shutil.rmtree(split_dir) 
     print(" ".join(view_cmd))
     pipeline_log.append(" ".join(view_cmd))
-    bam_var = subprocess.Popen(view_cmd,stdout=subprocess.PIPE)
-    os.mkdir("Split_Bams")
-    os.chdir("Split_Bams")
+    bam_var = pipeline_trace.Popen(view_cmd,stdout=subprocess.PIPE)
+    os.mkdir(split_dir)
     print(" ".join(split_cmd))
     pipeline_log.append(" ".join(split_cmd))
-    subprocess.check_call(split_cmd,stdin=bam_var.stdout)
+    pipeline_trace.check_call(split_cmd,stdin=bam_var.stdout,cwd=split_dir)
+    bam_var.stdout.close()
+    pipeline_trace.wait(bam_var)
     sys.stdout.flush() #Get warnings if buffer isn't flushed for some reason, buffer overflow? seems unlikely
-    for sam in glob.glob("*"): #iterate through all split files and format
+    for sam in glob.glob(os.path.join(split_dir,"*")): #iterate through all split files and format
         new_sam = sam+".sam"
         with open(new_sam,"w") as ns:
             ns.write(header)
@@ -117,36 +138,204 @@ def split_bam_file(replicate_bam,threads,pipeline_log):
             ns.write("".join(sam_lines))
             sam_file.close()
         os.remove(sam)
-    os.chdir("..")
 
-def run_htseq_parallel(genome_annotation,replicate_bam,counts_file,strand,feature,feature_type,threads, pipeline_log):
+def run_htseq_parallel(genome_annotation,replicate_bam,counts_file,strand,feature,feature_type,threads, pipeline_log, replicate_wd):
     #run htseq-count
     htseq_cmd = ["htseq-count","-t",feature_type,"-m","intersection-nonempty","--nonunique=all","-f","sam","-r","pos","-s",strand,"-i",feature,"-n",str(threads)]
     #htseq_cmd = ["htseq-count","-t",feature_type,"-f","sam","-r","pos","-s",strand,"-i",feature,"-n",str(threads)]
-    for sam in glob.glob("Split_Bams/*"): #iterate through all split files and format
+    for sam in glob.glob(replicate_wd.path("Split_Bams","*")): #iterate through all split files and format
         htseq_cmd.append(sam)
     htseq_cmd.append(genome_annotation)
     print(" ".join(htseq_cmd))
     pipeline_log.append(" ".join(htseq_cmd))
     #htseq_stdout = subprocess.Popen(htseq_cmd,stdout=subprocess.PIPE,shell=True)
-    htseq_stdout = subprocess.Popen(htseq_cmd,stdout=subprocess.PIPE)
+    htseq_stdout = pipeline_trace.Popen(htseq_cmd,stdout=subprocess.PIPE)
     print("running htseq-parallel: communicate()")
-    htseq_output,htseq_err = htseq_stdout.communicate()
+    htseq_output,htseq_err = pipeline_trace.communicate(htseq_stdout)
     sys.stdout.flush()
     print("finished communicate(), writing to Output.txt")
-    with open("Output.txt","w") as o:
+    output_file = replicate_wd.path("Output.txt")
+    with open(output_file,"w") as o:
         o.write(htseq_output)
     #    subprocess.check_call(htseq_cmd,stdout=o)
     #Combine output into counts file and delete Split_Bams directory
     #TODO: maybe rewrite using a bash command?
-    with open("Output.txt","r") as split_counts:
+    with open(output_file,"r") as split_counts:
         with open(counts_file,"w") as cf:
             for line in split_counts:
                 line = line.strip().split()
                 gene = line[0]
                 counts = [int(x) for x in line[1:]]
                 cf.write("%s\t%s\n"%(gene,sum(counts))) 
-    os.remove("Output.txt")
+    os.remove(output_file)
+
+#Prepares the bam file for parallel htseq-count
+#region: returns the bam regions for each shard, nothing is written to disk
+#lines: splits the bam into sam files in <replicate_wd>/Split_Bams (split_bam_file) and returns None
+def shard_bam_file(replicate_bam,threads,bam_split,pipeline_log,replicate_wd):
+    if bam_split == "region":
+        return get_bam_regions(replicate_bam,int(threads),pipeline_log)
+    split_bam_file(replicate_bam,threads,pipeline_log,replicate_wd)
+    return None
+
+#Runs htseq-count on the shards made by shard_bam_file and writes the summed counts to counts_file
+def run_htseq_shards(genome_annotation,replicate_bam,counts_file,strand,feature,feature_type,threads,regions,pipeline_log,replicate_wd):
+    if regions is None:
+        run_htseq_parallel(genome_annotation,replicate_bam,counts_file,strand,feature,feature_type,threads,pipeline_log,replicate_wd)
+    else:
+        run_htseq_regions(genome_annotation,replicate_bam,counts_file,strand,feature,feature_type,regions,pipeline_log)
+
+#Divides an indexed bam into num_shards lists of regions with about the same number of mapped reads, using samtools idxstats
+#Contigs are cut into equal length windows so a single chromosome bacterial genome still gives num_shards shards
+#Each region is (contig,start,end) with 1-based inclusive coordinates, the unplaced unmapped reads ("*",0,0) go in the last shard
+def get_bam_regions(replicate_bam,num_shards,pipeline_log):
+    idxstats_cmd = ["samtools","idxstats",replicate_bam]
+    print(" ".join(idxstats_cmd))
+    pipeline_log.append(" ".join(idxstats_cmd))
+    idxstats_output = pipeline_trace.Popen(idxstats_cmd,stdout=subprocess.PIPE)
+    idxstats,err = pipeline_trace.communicate(idxstats_output)
+    contigs = []
+    contig_order = {}
+    for line in idxstats.decode("utf-8").strip().split("\n"):
+        contig,length,mapped,unmapped = line.split("\t")
+        contig_order[contig] = len(contig_order)
+        if contig != "*" and int(mapped) > 0:
+            contigs.append((contig,int(length),int(mapped)))
+    total_mapped = sum([c[2] for c in contigs])
+    reads_per_shard = max(1.0,float(total_mapped)/num_shards)
+    windows = []
+    for contig,length,mapped in contigs:
+        num_windows = min(length,int(math.ceil(mapped/reads_per_shard)))
+        window_size = int(math.ceil(float(length)/num_windows))
+        for start in range(1,length+1,window_size):
+            windows.append((float(mapped)/num_windows,(contig,start,min(length,start+window_size-1))))
+    #largest windows first into the emptiest shard
+    shards = [[0.0,[]] for i in range(num_shards)]
+    for reads,region in sorted(windows,key=lambda w: w[0],reverse=True):
+        shard = min(shards,key=lambda sh: sh[0])
+        shard[0] += reads
+        shard[1].append(region)
+    shards[-1][1].append(("*",0,0))
+    #keep regions in bam order inside a shard, htseq-count -r pos expects sorted input
+    return [sorted(sh[1],key=lambda r: (contig_order[r[0]],r[1])) for sh in shards if len(sh[1]) > 0]
+
+#Streams the reads of one shard (header first) into htseq_stdin
+#A read overlapping the start of a window also belongs to the window before it, so only reads starting inside the window are kept
+def write_shard_reads(replicate_bam,regions,htseq_stdin):
+    header_cmd = pipeline_trace.Popen(["samtools","view","-H",replicate_bam],stdout=subprocess.PIPE)
+    shutil.copyfileobj(header_cmd.stdout,htseq_stdin)
+    header_cmd.stdout.close()
+    pipeline_trace.wait(header_cmd)
+    for contig,start,end in regions:
+        region = "*" if contig == "*" else "%s:%d-%d"%(contig,start,end)
+        view_cmd = pipeline_trace.Popen(["samtools","view",replicate_bam,region],stdout=subprocess.PIPE)
+        #readline, not iteration: python2 file iteration read-ahead would be lost by copyfileobj
+        line = view_cmd.stdout.readline()
+        while line:
+            if contig == "*" or int(line.split(b"\t",4)[3]) >= start:
+                htseq_stdin.write(line)
+                break
+            line = view_cmd.stdout.readline()
+        #reads are sorted, everything after the first read starting in the window is in the window
+        shutil.copyfileobj(view_cmd.stdout,htseq_stdin)
+        view_cmd.stdout.close()
+        if pipeline_trace.wait(view_cmd) != 0:
+            raise subprocess.CalledProcessError(view_cmd.returncode,"samtools view "+replicate_bam+" "+region)
+
+#Counts one shard with htseq-count reading sam from stdin
+#Returns htseq-count's output lines
+def run_htseq_region_shard(htseq_cmd,replicate_bam,regions):
+    htseq_proc = pipeline_trace.Popen(htseq_cmd,stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+    try:
+        write_shard_reads(replicate_bam,regions,htseq_proc.stdin)
+    finally:
+        htseq_proc.stdin.close()
+    #htseq-count only writes its counts after reading all input, so stdout can't fill up while writing stdin
+    htseq_output,err = pipeline_trace.communicate(htseq_proc)
+    if htseq_proc.returncode != 0:
+        raise subprocess.CalledProcessError(htseq_proc.returncode," ".join(htseq_cmd))
+    return htseq_output.decode("utf-8").strip().split("\n")
+
+#Runs one htseq-count per shard from get_bam_regions at the same time and sums their counts into counts_file
+#Same output as run_htseq_parallel, without the intermediate sam files
+def run_htseq_regions(genome_annotation,replicate_bam,counts_file,strand,feature,feature_type,regions,pipeline_log):
+    htseq_cmd = get_htseq_stdin_cmd(genome_annotation,strand,feature,feature_type)
+    for shard in regions:
+        pipeline_log.append(get_shard_view_cmd(replicate_bam,shard)+" | "+" ".join(htseq_cmd))
+    print("running htseq-count on %d regions of %s"%(len(regions),replicate_bam))
+    shard_args = [(htseq_cmd,replicate_bam,shard) for shard in regions]
+    counts_lines = sum_shard_counts(scheduler.run_parallel(run_htseq_region_shard,shard_args,len(regions)))
+    with open(counts_file,"w") as cf:
+        cf.write("".join(counts_lines))
+
+def get_htseq_stdin_cmd(genome_annotation,strand,feature,feature_type):
+    return ["htseq-count","-t",feature_type,"-m","intersection-nonempty","--nonunique=all","-f","sam","-r","pos","-s",strand,"-i",feature,"-",genome_annotation]
+
+def get_shard_view_cmd(replicate_bam,regions):
+    return "samtools view "+replicate_bam+" "+" ".join(["%s:%d-%d"%r if r[0] != "*" else "*" for r in regions])
+
+#Adds up the htseq-count output lines of each shard
+#Returns the counts file lines in the order the features first appear
+def sum_shard_counts(shard_outputs):
+    counts = {}
+    feature_order = []
+    for shard_output in shard_outputs:
+        for line in shard_output:
+            line = line.strip().split()
+            if line[0] not in counts:
+                counts[line[0]] = 0
+                feature_order.append(line[0])
+            counts[line[0]] += int(line[1])
+    return ["%s\t%s\n"%(gene,counts[gene]) for gene in feature_order]
+
+#File-like object passing each write to every htseq-count stdin, so one samtools traversal feeds all of them
+class TeeWriter(object):
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    def write(self, data):
+        for o in self.outputs:
+            o.write(data)
+
+#Counts one shard for several feature types: the shard is read once and streamed to one htseq-count per type
+#Returns the htseq-count output lines for each entry of htseq_cmds
+def run_htseq_fanout_shard(htseq_cmds,replicate_bam,regions):
+    htseq_procs = [pipeline_trace.Popen(cmd,stdin=subprocess.PIPE,stdout=subprocess.PIPE) for cmd in htseq_cmds]
+    try:
+        write_shard_reads(replicate_bam,regions,TeeWriter([p.stdin for p in htseq_procs]))
+    finally:
+        for p in htseq_procs:
+            p.stdin.close()
+    shard_outputs = []
+    for cmd,p in zip(htseq_cmds,htseq_procs):
+        htseq_output,err = pipeline_trace.communicate(p)
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode," ".join(cmd))
+        shard_outputs.append(htseq_output.decode("utf-8").strip().split("\n"))
+    return shard_outputs
+
+#Single pass Host counting: every feature type of every counts file is counted from one traversal of the bam
+#outputs: list of (counts file, feature types written to it in order), same file contents as running
+#run_htseq_shards once per type and appending the results
+#Each shard runs one htseq-count per feature type, so the bam is cut into threads/(number of types) shards
+def run_htseq_multi_type(genome_annotation,replicate_bam,outputs,strand,feature,threads,pipeline_log):
+    feature_types = []
+    for counts_file,types in outputs:
+        feature_types += types
+    regions = get_bam_regions(replicate_bam,max(1,int(threads)//len(feature_types)),pipeline_log)
+    htseq_cmds = [get_htseq_stdin_cmd(genome_annotation,strand,feature,t) for t in feature_types]
+    for shard in regions:
+        pipeline_log.append(get_shard_view_cmd(replicate_bam,shard)+" | tee >("+") >(".join([" ".join(cmd) for cmd in htseq_cmds])+")")
+    print("running htseq-count for %d feature types on %d regions of %s"%(len(feature_types),len(regions),replicate_bam))
+    shard_args = [(htseq_cmds,replicate_bam,shard) for shard in regions]
+    shard_outputs = scheduler.run_parallel(run_htseq_fanout_shard,shard_args,len(regions))
+    type_counts = {}
+    for i,t in enumerate(feature_types):
+        type_counts[t] = sum_shard_counts([so[i] for so in shard_outputs])
+    for counts_file,types in outputs:
+        with open(counts_file,"w") as cf:
+            for t in types:
+                cf.write("".join(type_counts[t]))
 
 # -s: (yes,no,reverse) 
 # -i: feature to look for in annotation file (final column)
@@ -158,13 +347,19 @@ def run_htseq_count(genome_list, condition_dict, parameters, job_data, output_di
     #recipe to check for host and change parameters
     recipe = job_data.get("recipe","RNA-Rocket")
     threads = parameters.get("htseq",{}).get("-p","1")
+    #Host recipe: single_pass counts all feature types from one bam traversal (needs bam_split "region"),
+    #per_type runs htseq-count over the whole bam once per feature type
+    host_count = job_data.get("host_count","single_pass")
+    if job_data.get("bam_split","region") != "region":
+        host_count = "per_type"
     for genome in genome_list:
         genome_file = genome["genome"]
         genome_annotation = genome["annotation"]
+        manifest = checkpoint.get_manifest(genome["output"],job_data)
         for condition in condition_dict:
             for replicate in condition_dict[condition]["replicates"]:
                 cur_dir = os.path.dirname(os.path.realpath(replicate[genome_file]["bam"]))
-                os.chdir(cur_dir)
+                cur_wd = workdir.WorkDir(cur_dir)
                 replicate[genome_file]["dir"] = cur_dir
                 counts_file = os.path.basename(replicate[genome_file]["bam"]).replace(".bam",".counts")
                 counts_file_path = os.path.join(cur_dir,counts_file) 
@@ -174,20 +369,46 @@ def run_htseq_count(genome_list, condition_dict, parameters, job_data, output_di
                     replicate[genome_file]["transcript_counts"] = counts_file_path.replace(".counts",".transcript.counts") 
                 else:
                     replicate[genome_file]["counts"] = counts_file_path
-                if int(threads) > 1:
-                    if recipe == "Host":
+                #region: shards are read from the indexed bam as needed, lines: split into Split_Bams sam files
+                bam_split = job_data.get("bam_split","region")
+                #checkpoint steps of the counts files, a counts file is only reused if its bam and annotation didn't change
+                replicate_bam = replicate[genome_file]["bam"]
+                if recipe == "Host":
+                    gene_step = get_counts_step(replicate[genome_file]["gene_counts"],replicate_bam,genome_annotation,["htseq",HOST_GENE_FEATURES,"ID",strand],["htseq-count"])
+                    transcript_step = get_counts_step(replicate[genome_file]["transcript_counts"],replicate_bam,genome_annotation,["htseq",HOST_TRANSCRIPT_FEATURES,"ID",strand],["htseq-count"])
+                    gene_counts_done = manifest.is_complete(*gene_step)
+                    transcript_counts_done = manifest.is_complete(*transcript_step)
+                else:
+                    counts_step = get_counts_step(counts_file_path,replicate_bam,genome_annotation,["htseq",[feature_type],feature,strand],["htseq-count"])
+                if int(threads) > 1 or (recipe == "Host" and host_count == "single_pass"):
+                    regions = None
+                    if recipe == "Host" and host_count == "single_pass":
+                        outputs = []
+                        for step,done,types in [(gene_step,gene_counts_done,HOST_GENE_FEATURES),(transcript_step,transcript_counts_done,HOST_TRANSCRIPT_FEATURES)]:
+                            if done:
+                                sys.stderr.write("%s exists for genome file %s: skipping htseq-count for %s\n"%(step[2][0],genome_file,",".join(types)))
+                            else:
+                                outputs.append((step[2][0],types))
+                        if len(outputs) > 0:
+                            run_htseq_multi_type(genome_annotation,replicate[genome_file]["bam"],outputs,strand,"ID",threads,pipeline_log)
+                        for step,done in [(gene_step,gene_counts_done),(transcript_step,transcript_counts_done)]:
+                            if not done:
+                                manifest.record(*step)
+                    elif recipe == "Host":
                         #Split the bam file
-                        if not os.path.exists(replicate[genome_file]["gene_counts"]) or not os.path.exists(replicate[genome_file]["transcript_counts"]):
-                            split_bam_file(replicate[genome_file]["bam"],threads,pipeline_log)
-                        if os.path.exists(replicate[genome_file]["gene_counts"]):
+                        if not gene_counts_done or not transcript_counts_done:
+                            regions = shard_bam_file(replicate[genome_file]["bam"],threads,bam_split,pipeline_log,cur_wd)
+                        if gene_counts_done:
                             sys.stderr.write("%s exists for genome file %s: skipping htseq-count for genes\n"%(replicate[genome_file]["gene_counts"],genome_file))
                         else:
                             #Run gene_count matrix parameters
                             #Create two counts files and append them together
-                            genes_file = os.path.basename(replicate[genome_file]["gene_counts"])
+                            genes_file = replicate[genome_file]["gene_counts"]
                             genes_file_1 = genes_file+".tmp" 
-                            run_htseq_parallel(genome_annotation,replicate[genome_file]["bam"],genes_file,strand,"ID","gene",threads,pipeline_log)
-                            run_htseq_parallel(genome_annotation,replicate[genome_file]["bam"],genes_file_1,strand,"ID","pseudogene",threads,pipeline_log)
+                            if os.path.exists(genes_file):
+                                os.remove(genes_file) #the second feature type is appended
+                            run_htseq_shards(genome_annotation,replicate[genome_file]["bam"],genes_file,strand,"ID",HOST_GENE_FEATURES[0],threads,regions,pipeline_log,cur_wd)
+                            run_htseq_shards(genome_annotation,replicate[genome_file]["bam"],genes_file_1,strand,"ID",HOST_GENE_FEATURES[1],threads,regions,pipeline_log,cur_wd)
                             cf_open = open(genes_file,"a")
                             cf1_open = open(genes_file_1,"r")
                             cf1_lines = cf1_open.readlines()
@@ -195,15 +416,17 @@ def run_htseq_count(genome_list, condition_dict, parameters, job_data, output_di
                             cf_open.write("".join(cf1_lines))
                             cf_open.close()
                             os.remove(genes_file_1)
-                        if os.path.exists(replicate[genome_file]["transcript_counts"]):
+                            manifest.record(*gene_step)
+                        if transcript_counts_done:
                             sys.stderr.write("%s exists for genome file %s: skipping htseq-count for transcripts\n"%(replicate[genome_file]["transcript_counts"],genome_file))
                         else:
                             #Run transcript_count matrix parameters
-                            transcript_file = os.path.basename(replicate[genome_file]["transcript_counts"])
-                            feature_list = ["mRNA","lnc_RNA","transcript","snRNA","V_gene_segment","snoRNA","enhancer","biological_region","primary_transcript","miRNA","C_gene_segment","rRNA","tRNA"]
-                            for f in feature_list:
+                            transcript_file = replicate[genome_file]["transcript_counts"]
+                            if os.path.exists(transcript_file):
+                                os.remove(transcript_file) #every feature type is appended
+                            for f in HOST_TRANSCRIPT_FEATURES:
                                 transcript_file_tmp = transcript_file+".tmp" 
-                                run_htseq_parallel(genome_annotation,replicate[genome_file]["bam"],transcript_file_tmp,strand,"ID",f,threads,pipeline_log)
+                                run_htseq_shards(genome_annotation,replicate[genome_file]["bam"],transcript_file_tmp,strand,"ID",f,threads,regions,pipeline_log,cur_wd)
                                 tf_open = open(transcript_file,"a")
                                 tf1_open = open(transcript_file_tmp,"r") 
                                 tf1_lines = tf1_open.readlines()
@@ -211,21 +434,79 @@ def run_htseq_count(genome_list, condition_dict, parameters, job_data, output_di
                                 tf_open.write("".join(tf1_lines))
                                 tf_open.close()
                                 os.remove(transcript_file_tmp)
+                            manifest.record(*transcript_step)
                     else: #bacterial pipeline
-                        if os.path.exists(counts_file_path):
+                        if manifest.is_complete(*counts_step):
                             sys.stderr.write("%s exists for genome file %s: skipping htseq-count\n"%(counts_file,genome_file))
                         else:
-                            split_bam_file(replicate[genome_file]["bam"],threads, pipeline_log)
-                            run_htseq_parallel(genome_annotation,replicate[genome_file]["bam"],counts_file,strand,feature,feature_type,threads,pipeline_log)
-                    if os.path.exists("Split_Bams"):
-                        shutil.rmtree("Split_Bams")
+                            regions = shard_bam_file(replicate[genome_file]["bam"],threads,bam_split,pipeline_log,cur_wd)
+                            run_htseq_shards(genome_annotation,replicate[genome_file]["bam"],counts_file_path,strand,feature,feature_type,threads,regions,pipeline_log,cur_wd)
+                            manifest.record(*counts_step)
+                    if cur_wd.exists("Split_Bams"):
+                        shutil.rmtree(cur_wd.path("Split_Bams"))
                 else:
                     if recipe == "Host":
                         print("Host htseq pipeline not enabled for 1 thread, will take too long")
                         sys.exit(1)
+                    if manifest.is_complete(*counts_step):
+                        sys.stderr.write("%s exists for genome file %s: skipping htseq-count\n"%(counts_file,genome_file))
+                        continue
                     print("running htseq-count and writing to %s"%counts_file)
                     htseq_cmd = ["htseq-count","-t",feature_type,"-f","bam","-r","pos","-s",strand,"-i",feature,replicate[genome_file]["bam"],genome_annotation]
                     print(" ".join(htseq_cmd))
                     #prints to stdout, so redirect output to file
-                    with open(counts_file,"w") as cf:
-                        subprocess.check_call(htseq_cmd,stdout=cf)
+                    with open(counts_file_path,"w") as cf:
+                        pipeline_trace.check_call(htseq_cmd,stdout=cf)
+                    manifest.record(*counts_step)
+
+#Checkpoint step of one counts file made from replicate_bam, params: counting program and its options
+def get_counts_step(counts_file,replicate_bam,genome_annotation,params,tools=None):
+    return ["count "+counts_file,[replicate_bam,genome_annotation],[counts_file],params,tools]
+
+#Counts reads with the in-process counter (feature_counter.py) instead of htseq-count: "feature_count": "native"
+#Same counting rules and output files as run_htseq_count, but the annotation is parsed once and each bam is read once
+#for all feature types. With -p > 1 the bam is counted in region shards by that many worker processes
+def run_native_count(genome_list, condition_dict, parameters, job_data, output_dir, pipeline_log):
+    strand = job_data.get("htseq",{}).get("-s","no")
+    feature = job_data.get("htseq",{}).get("-i","ID")
+    feature_type = job_data.get("htseq",{}).get("-t","gene")
+    recipe = job_data.get("recipe","RNA-Rocket")
+    threads = int(parameters.get("htseq",{}).get("-p",scheduler.get_core_budget(job_data)))
+    for genome in genome_list:
+        genome_file = genome["genome"]
+        genome_annotation = genome["annotation"]
+        manifest = checkpoint.get_manifest(genome["output"],job_data)
+        #parsed annotation indices are cached on disk for later replicates and jobs
+        annotation_cache = annotation_index.get_cache_dir(job_data,genome_annotation)
+        for condition in condition_dict:
+            for replicate in condition_dict[condition]["replicates"]:
+                replicate_bam = replicate[genome_file]["bam"]
+                cur_dir = os.path.dirname(os.path.realpath(replicate_bam))
+                replicate[genome_file]["dir"] = cur_dir
+                counts_file_path = os.path.join(cur_dir,os.path.basename(replicate_bam).replace(".bam",".counts"))
+                #(output file, feature types appended to it in order)
+                if recipe == "Host":
+                    replicate[genome_file]["gene_counts"] = counts_file_path.replace(".counts",".gene.counts")
+                    replicate[genome_file]["transcript_counts"] = counts_file_path.replace(".counts",".transcript.counts")
+                    id_attr = "ID"
+                    outputs = [(replicate[genome_file]["gene_counts"],HOST_GENE_FEATURES),(replicate[genome_file]["transcript_counts"],HOST_TRANSCRIPT_FEATURES)]
+                else:
+                    replicate[genome_file]["counts"] = counts_file_path
+                    id_attr = feature
+                    outputs = [(counts_file_path,[feature_type])]
+                counts_steps = dict((o[0],get_counts_step(o[0],replicate_bam,genome_annotation,["native",o[1],id_attr,strand])) for o in outputs)
+                outputs = [o for o in outputs if not manifest.is_complete(*counts_steps[o[0]])]
+                if len(outputs) == 0:
+                    sys.stderr.write("counts files exist for %s: skipping feature counting\n"%replicate_bam)
+                    continue
+                feature_types = []
+                for counts_file,types in outputs:
+                    feature_types += types
+                shards = get_bam_regions(replicate_bam,threads,pipeline_log) if threads > 1 else None
+                count_cmd = "feature_counter -t "+",".join(feature_types)+" -m intersection-nonempty --nonunique=all -r pos -s "+strand+" -i "+id_attr+" -n "+str(threads)+" "+replicate_bam+" "+genome_annotation
+                print(count_cmd)
+                pipeline_log.append(count_cmd)
+                result = feature_counter.count_features(replicate_bam,genome_annotation,feature_types,id_attr,strand,shards,annotation_cache)
+                for counts_file,types in outputs:
+                    feature_counter.write_counts(counts_file,result,types)
+                    manifest.record(*counts_steps[counts_file])
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import pipeline_trace
+
+#fewest threads handed to a single aligner/samtools job when the budget is split automatically
+MIN_THREADS_PER_JOB = 2
+
+#Returns the number of cores the whole job may use
+#Set with --max-cores (stored in job_data as "max_cores"), defaults to every core on the node
+def get_core_budget(job_data):
+    max_cores = 0
+    if job_data:
+        max_cores = int(job_data.get("max_cores",0))
+    if max_cores <= 0:
+        max_cores = multiprocessing.cpu_count()
+    return max_cores
+
+#Splits max_cores between num_jobs jobs that can run at the same time
+#threads_per_job: thread count requested by the user (ex. bowtie2 -p), 0 lets the budget decide
+#Returns (number of concurrent jobs, threads per job)
+def split_cores(max_cores, num_jobs, threads_per_job=0):
+    num_jobs = max(1,num_jobs)
+    threads_per_job = int(threads_per_job)
+    if threads_per_job > 0:
+        num_workers = max(1,max_cores//threads_per_job)
+        return min(num_workers,num_jobs),threads_per_job
+    num_workers = min(num_jobs,max(1,max_cores//MIN_THREADS_PER_JOB))
+    return num_workers,max(1,max_cores//num_workers)
+
+#Calls func(*args) for each args tuple in arg_list, at most num_workers at a time
+#Jobs are expected to spend their time in subprocesses, so threads are enough
+#Returns the results in the order of arg_list no matter which job finishes first
+#The first exception raised by a job is re-raised here
+#Jobs keep the pipeline_trace step of the caller
+def run_parallel(func, arg_list, num_workers):
+    if num_workers <= 1 or len(arg_list) <= 1:
+        return [func(*args) for args in arg_list]
+    pool = ThreadPool(min(num_workers,len(arg_list)))
+    try:
+        step_func = pipeline_trace.with_step(func)
+        async_results = [pool.apply_async(step_func,args) for args in arg_list]
+        return [ar.get() for ar in async_results]
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+import os
+import pipeline_trace
+
+#Directory a pipeline step works in, used instead of os.chdir
+#The process working directory is shared by every thread, so steps that run on thread pools
+#build absolute paths with path() and start their commands with cwd set to the directory
+class WorkDir(object):
+    def __init__(self, path):
+        self.dir = os.path.abspath(path)
+
+    #Absolute path of a file in this directory
+    def path(self, *names):
+        return os.path.join(self.dir,*names)
+
+    def open(self, name, mode="r"):
+        return open(self.path(name),mode)
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def makedirs(self, name):
+        if not os.path.isdir(self.path(name)):
+            os.makedirs(self.path(name))
+        return self.path(name)
+
+    #subprocess wrappers that run the command in this directory, traced by pipeline_trace
+    #popen returns a pipeline_trace.Popen, finish it with pipeline_trace.wait
+    def check_call(self, cmd, **kwargs):
+        return pipeline_trace.check_call(cmd,cwd=self.dir,**kwargs)
+
+    def call(self, cmd, **kwargs):
+        return pipeline_trace.call(cmd,cwd=self.dir,**kwargs)
+
+    def popen(self, cmd, **kwargs):
+        return pipeline_trace.Popen(cmd,cwd=self.dir,**kwargs)
+
+    def __str__(self):
+        return self.dir
+
+#WorkDir of a genome's output directory
+def genome_dir(genome):
+    return WorkDir(genome["output"])